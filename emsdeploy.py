@@ -0,0 +1,1300 @@
+# Copyright (C) 2019 Ulas Baloglu <ulasbaloglu@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Deployment machinery shared by the fabfiles of the nodes: SSH sessions, the step ledger, batch, parallel and simulated
+runs, run reports, fleets, the artifact cache, readiness probes, host tuning, the firewall, exporter scrapes and streaming.
+A fabfile registers itself with configure, the shared code reads these names of it:
+NAME, CONFIG_FILE, SECTION, config, PROBES, artifacts(), DEPLOY_STEPS, STEP_INPUTS, STEP_DEPENDS, STEP_LOCKS, EXPORTERS,
+TUNING_SYSCTL, TUNING_HUGEPAGES, TUNING_READAHEAD_KB, TUNING_DATA_DIRS, TUNING_LIMIT_UNITS and TUNING_LIMITS
+'''
+
+import os
+import ast
+import csv
+import difflib
+import hashlib
+import ipaddress
+import json
+import operator
+import re
+import shlex
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from fabric import task, Connection
+from invoke import Context
+from invoke.exceptions import UnexpectedExit
+from invoke.runners import Result
+
+LEDGER_FILE = "/var/lib/emsdeploy/ledger"
+REPORT_DIR = "reports"
+APT_PROXY_FILE = "/etc/apt/apt.conf.d/01emsdeploy-proxy"
+ARTIFACT_CACHE = os.path.expanduser("~/.emsdeploy/artifacts")
+REMOTE_CACHE = "/var/cache/emsdeploy"
+ARTIFACT_PORT = "8765"
+APT_PROXY_PORT = "3142"
+SYSCTL_FILE = "/etc/sysctl.d/60-emsdeploy.conf"
+HUGEPAGES_UNIT = "/etc/systemd/system/emsdeploy-hugepages.service"
+READAHEAD_RULES = "/etc/udev/rules.d/60-emsdeploy-readahead.rules"
+JMX_EXPORTER_URL = "https://repo1.maven.org/maven2/io/prometheus/jmx/jmx_prometheus_javaagent/0.12.0/jmx_prometheus_javaagent-0.12.0.jar"
+JMX_EXPORTER_DIR = "/opt/jmx_exporter"
+
+OPERATORS = {
+	ast.Add: operator.add,
+	ast.Sub: operator.sub,
+	ast.Mult: operator.mul,
+	ast.Div: operator.truediv,
+	ast.FloorDiv: operator.floordiv,
+	ast.Mod: operator.mod,
+	ast.USub: operator.neg,
+	ast.UAdd: operator.pos,
+}
+FUNCTIONS = {'min': min, 'max': max, 'round': round}
+
+SIMULATED_OUTPUTS = [
+	(r'^(sudo )?test -f ' + LEDGER_FILE + '|^(sudo )?test -f /var/cache/', '', 1),
+	(r'until \(', '*** ready in 1ms\n', 0),
+	(r'^(sudo )?nproc$', '4\n', 0),
+	(r'MemTotal', 'MemTotal:        8167480 kB\n', 0),
+	(r'lsblk -dno NAME,ROTA,TYPE', 'sda 0 disk\n', 0),
+]
+
+role = None
+sessions = {}
+batches = {}
+report = {'steps': [], 'ready': []}
+tracking = threading.local()
+digests = {}
+artifactlock = threading.Lock()
+
+def configure(module):
+	'''
+	Register the fabfile of the node the shared tasks run for
+	:return:
+	'''
+	global role
+	role = module
+
+def nodesettings():
+	'''
+	Settings of the node section of the config
+	:return: dict
+	'''
+	return role.config._sections[role.SECTION]
+
+@task
+def deploy(ctx, force=False, batch=False, parallel=False):
+	'''
+	Execute full tasks at once, steps already completed with the same inputs are skipped unless forced
+	:return:
+	'''
+	ctx.force = force
+	ctx.batch = batch
+	ctx.parallel = parallel
+	staging(ctx)
+	try:
+		runsteps(ctx, role.DEPLOY_STEPS)
+	finally:
+		closesession(ctx)
+		writereport()
+
+@task
+def batch(ctx, tasks):
+	'''
+	Execute the comma separated tasks as one remote script
+	:return:
+	'''
+	ctx.batch = True
+	try:
+		runsteps(ctx, [getattr(role, name.strip()) for name in tasks.split(',')])
+	finally:
+		closesession(ctx)
+		writereport()
+
+@task
+def simulate(ctx, latency=20, bandwidth=100, modes='reconnect,sequential,batch,parallel'):
+	'''
+	Benchmark the deployment against an in-process simulated host with the given round trip latency (ms) and bandwidth
+	(Mbit/s), the modes are compared by wall time, round trips and uploaded bytes. The reconnect mode opens a new
+	connection for every step, the baseline of the shared session of the other modes
+	:return:
+	'''
+	ctx.simulate = True
+	ctx.simulate_latency = float(latency) / 1000
+	ctx.simulate_bandwidth = float(bandwidth) * 125000
+	ctx.force = True
+	ctx.restore = 'n'
+	summary = []
+	for mode in modes.split(','):
+		sys.stdout.write("\n*** Simulating a " + mode + " deployment, " + str(latency) + "ms latency, " + str(bandwidth) + "Mbit/s\n")
+		ctx.batch = mode == 'batch'
+		ctx.parallel = mode == 'parallel'
+		ctx.reconnect = mode == 'reconnect'
+		start = time.time()
+		staging(ctx)
+		try:
+			runsteps(ctx, role.DEPLOY_STEPS)
+		finally:
+			commands = sessions[ctx.host]['conn'].commands
+			closesession(ctx)
+		summary.append({'mode': mode, 'seconds': round(time.time() - start, 3),
+			'commands': sum(step['commands'] for step in report['steps']), 'bytes': sum(step['bytes'] for step in report['steps']),
+			'steps': dict((step['step'], step['seconds']) for step in report['steps'])})
+		os.makedirs(REPORT_DIR, exist_ok=True)
+		with open(os.path.join(REPORT_DIR, role.NAME + '-simulate-' + mode + '-commands.txt'), 'w') as f:
+			f.write('\n'.join(commands) + '\n')
+		writereport()
+	name = os.path.join(REPORT_DIR, role.NAME + '-simulate-' + time.strftime('%Y%m%d-%H%M%S'))
+	with open(name + '.json', 'w') as f:
+		json.dump({'latency_ms': float(latency), 'bandwidth_mbit': float(bandwidth), 'modes': summary}, f, indent=2)
+	sys.stdout.write("\n****************************\n")
+	sys.stdout.write("*** Simulated deployment benchmark\n")
+	sys.stdout.write("****************************\n")
+	sys.stdout.write("%-12s %10s %12s %12s\n" % ('mode', 'seconds', 'round trips', 'bytes'))
+	for mode in summary:
+		sys.stdout.write("%-12s %10.2f %12d %12d\n" % (mode['mode'], mode['seconds'], mode['commands'], mode['bytes']))
+	modes = dict((mode['mode'], mode) for mode in summary)
+	if 'reconnect' in modes and 'sequential' in modes:
+		before, after = modes['reconnect']['steps'], modes['sequential']['steps']
+		sys.stdout.write("\n%-24s %12s %12s\n" % ('step latency', 'reconnect', 'sequential'))
+		for step in before:
+			sys.stdout.write("%-24s %11.2fs %11.2fs\n" % (step, before[step], after.get(step, 0)))
+		sys.stdout.write("*** Shared session measured %.2fs faster than a connection per step ***\n"\
+		 % (sum(before.values()) - sum(after.values())))
+	sys.stdout.write("*** Report written to " + name + ".json ***\n")
+
+@task
+def staging(ctx):
+	'''
+	Setting up host credentials
+	:return:
+	'''
+	stagehost(ctx, nodesettings()['host'])
+
+def stagehost(ctx, host):
+	'''
+	Setting up credentials for a single host of the inventory
+	:return:
+	'''
+	ctx.name = 'staging'
+	ctx.user = nodesettings()['user']
+	ctx.connect_kwargs = {"key_filename":[nodesettings()['keyfile']]}
+	ctx.address = host
+	ctx.host = host + ':' + nodesettings()['port']
+	opensession(ctx)
+
+@contextmanager
+def session(ctx):
+	'''
+	Reuse the SSH session of the host opened in staging
+	:return: connection
+	'''
+	if ctx.host not in sessions:
+		opensession(ctx)
+	sessions[ctx.host]['uses'] += 1
+	yield batches.get(ctx.host, sessions[ctx.host]['conn'])
+
+def opensession(ctx):
+	'''
+	Open and authenticate one SSH session for the host, every task multiplexes its commands over it
+	:return:
+	'''
+	closesession(ctx)
+	if ctx.config.get('simulate'):
+		conn = SimulatedConnection(ctx.host, ctx.simulate_latency, ctx.simulate_bandwidth)
+	else:
+		conn = Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs)
+	start = time.time()
+	conn.open()
+	sessions[ctx.host] = {'handshake': time.time() - start, 'uses': 0, 'steps': [], 'ready': []}
+	sessions[ctx.host]['conn'] = TrackedConnection(conn)
+
+def reconnect(ctx):
+	'''
+	Close the connection of the host and open it again, the connection per step of the reconnect baseline
+	:return:
+	'''
+	conn = sessions[ctx.host]['conn']
+	conn.close()
+	start = time.time()
+	conn.open()
+	sessions[ctx.host]['handshake'] += time.time() - start
+
+class TrackedConnection(object):
+	'''
+	Session connection counting the round trips of commands and uploads and the uploaded bytes of the step running in
+	the thread
+	'''
+	def __init__(self, conn):
+		self.conn = conn
+
+	def run(self, command, **kwargs):
+		tracking.commands = getattr(tracking, 'commands', 0) + 1
+		return self.conn.run(command, **kwargs)
+
+	def sudo(self, command, **kwargs):
+		tracking.commands = getattr(tracking, 'commands', 0) + 1
+		return self.conn.sudo(command, **kwargs)
+
+	def put(self, local, *args, **kwargs):
+		tracking.commands = getattr(tracking, 'commands', 0) + 1
+		if isinstance(local, str) and os.path.isfile(local):
+			tracking.transferred = getattr(tracking, 'transferred', 0) + os.path.getsize(local)
+		return self.conn.put(local, *args, **kwargs)
+
+	def __getattr__(self, name):
+		return getattr(self.conn, name)
+
+def closesession(ctx):
+	'''
+	Close the SSH session of the host and move its step records to the run report
+	:return:
+	'''
+	if 'host' not in ctx.config or ctx.host not in sessions:
+		return
+	batches.pop(ctx.host, None)
+	entry = sessions.pop(ctx.host)
+	entry['conn'].close()
+	report['steps'].extend(entry['steps'])
+	report['ready'].extend({'host': ctx.host, 'service': name, 'seconds': seconds} for name, seconds in entry['ready'])
+	sys.stdout.write("*** " + ctx.host + ": one SSH handshake of %.2fs shared by %d tasks, an estimated %.2fs saved"\
+	 " (fab simulate measures it) ***\n" % (entry['handshake'], entry['uses'], entry['handshake'] * max(entry['uses'] - 1, 0)))
+
+def runstep(ctx, step):
+	'''
+	Execute one task of the deployment and keep its latency,
+	skip it when the ledger of the host has it completed with the same inputs
+	:return:
+	'''
+	entry = sessions[ctx.host]
+	tracking.commands = tracking.transferred = 0
+	start = time.time()
+	digest = stepdigest(step, ctx)
+	if not ctx.config.get('force') and readledger(ctx).get(step.name) == digest:
+		sys.stdout.write("*** " + step.name + " already completed on " + ctx.host + ", skipping ***\n")
+		recordstep(ctx, step.name, start, 'skipped')
+		return
+	entry['current'] = step.name
+	if ctx.config.get('reconnect'):
+		reconnect(ctx)
+	if ctx.host in batches:
+		batches[ctx.host].step = step.name
+	try:
+		step(ctx)
+	except UnexpectedExit as e:
+		recordstep(ctx, step.name, start, 'exit ' + str(e.result.exited))
+		raise
+	except Exception:
+		recordstep(ctx, step.name, start, 'failed')
+		raise
+	if ctx.host in batches:
+		batches[ctx.host].steps.append((step.name, digest, steprecord(ctx, step.name, start, 'ok')))
+		return
+	recordstep(ctx, step.name, start, 'ok')
+	writeledger(ctx, [(step.name, digest)])
+
+def writeledger(ctx, completed):
+	'''
+	Append completed steps with the digest of their inputs to the ledger of the host in one command, the digests of
+	password inputs must not be readable by other users so the ledger is only accessible to root
+	:return:
+	'''
+	if not completed:
+		return
+	sessions[ctx.host]['conn'].sudo('bash -c "umask 077 && mkdir -p ' + os.path.dirname(LEDGER_FILE) + ' && chmod 700 '\
+	 + os.path.dirname(LEDGER_FILE) + ' && printf \'%s %s\\n\' ' + ' '.join(name + ' ' + digest for name, digest in completed)\
+	 + ' >> ' + LEDGER_FILE + ' && chmod 600 ' + LEDGER_FILE + '"', hide=True)
+	if 'ledger' in sessions[ctx.host]:
+		sessions[ctx.host]['ledger'].update(completed)
+
+def recordstep(ctx, name, start, status):
+	'''
+	Keep wall time, remote command count, uploaded bytes and status of a step for the run report
+	:return:
+	'''
+	sessions[ctx.host]['steps'].append(steprecord(ctx, name, start, status))
+
+def steprecord(ctx, name, start, status):
+	'''
+	Record of a step for the run report
+	:return: dict
+	'''
+	return {'host': ctx.host, 'step': name, 'status': status, 'seconds': round(time.time() - start, 3),
+		'commands': tracking.commands, 'bytes': tracking.transferred}
+
+def writereport():
+	'''
+	Write the step records of the run as json and csv into the reports folder and print the summary table
+	:return:
+	'''
+	if not report['steps']:
+		return
+	os.makedirs(REPORT_DIR, exist_ok=True)
+	name = os.path.join(REPORT_DIR, role.NAME + '-' + time.strftime('%Y%m%d-%H%M%S'))
+	with open(name + '.json', 'w') as f:
+		json.dump(report, f, indent=2)
+	with open(name + '.csv', 'w', newline='') as f:
+		writer = csv.DictWriter(f, fieldnames=['host', 'step', 'status', 'seconds', 'commands', 'bytes'])
+		writer.writeheader()
+		writer.writerows(report['steps'])
+	sys.stdout.write("\n****************************\n")
+	sys.stdout.write("*** Run report\n")
+	sys.stdout.write("****************************\n")
+	sys.stdout.write("%-24s %-24s %-8s %10s %9s %12s\n" % ('host', 'step', 'status', 'seconds', 'commands', 'bytes'))
+	for step in report['steps']:
+		sys.stdout.write("%-24s %-24s %-8s %10.2f %9d %12d\n"\
+		 % (step['host'], step['step'], step['status'], step['seconds'], step['commands'], step['bytes']))
+	for ready in report['ready']:
+		sys.stdout.write("%-24s %-24s %-8s %10.2f\n" % (ready['host'], ready['service'], 'ready', ready['seconds']))
+	sys.stdout.write("*** Report written to " + name + ".json and " + name + ".csv ***\n")
+	report['steps'] = []
+	report['ready'] = []
+
+def runsteps(ctx, steps):
+	'''
+	Execute the steps of the host, in batch mode their commands run as one remote script
+	:return:
+	'''
+	if ctx.config.get('batch'):
+		batches[ctx.host] = BatchConnection(sessions[ctx.host]['conn'])
+		for step in steps:
+			runstep(ctx, step)
+		runbatch(ctx)
+	elif ctx.config.get('parallel'):
+		rungraph(ctx, steps)
+	else:
+		for step in steps:
+			runstep(ctx, step)
+
+def rungraph(ctx, steps):
+	'''
+	Execute each step as soon as the steps it depends on completed, steps holding the same lock never overlap.
+	After a failure no new step is started and the error is raised once the running steps finished.
+	:return:
+	'''
+	names = [step.name for step in steps]
+	locks = dict((lock, threading.Lock()) for step in steps for lock in role.STEP_LOCKS.get(step.name, []))
+	pending = list(steps)
+	running = {}
+	done = set()
+	errors = []
+	with ThreadPoolExecutor(max_workers=len(steps)) as pool:
+		while running or (pending and not errors):
+			for step in list(pending):
+				if not errors and all(name in done or name not in names for name in role.STEP_DEPENDS.get(step.name, [])):
+					pending.remove(step)
+					running[pool.submit(lockedstep, ctx, step, [locks[lock] for lock in sorted(role.STEP_LOCKS.get(step.name, []))])] = step
+			if not running:
+				raise RuntimeError('unresolvable step dependencies: ' + ', '.join(step.name for step in pending))
+			finished, _ = wait(running, return_when=FIRST_COMPLETED)
+			for future in finished:
+				step = running.pop(future)
+				if future.exception():
+					errors.append(future.exception())
+				else:
+					done.add(step.name)
+	if errors:
+		raise errors[0]
+
+def lockedstep(ctx, step, locks):
+	'''
+	Execute a step while holding its locks
+	:return:
+	'''
+	for lock in locks:
+		lock.acquire()
+	try:
+		runstep(ctx, step)
+	finally:
+		for lock in reversed(locks):
+			lock.release()
+
+class SimulatedConnection(object):
+	'''
+	In-process stand-in for the SSH connection of a simulated host, commands are recorded and answered from
+	SIMULATED_OUTPUTS after the simulated round trip, uploads take the time of the simulated bandwidth
+	'''
+	def __init__(self, host, latency, bandwidth):
+		self.host = host
+		self.latency = latency
+		self.bandwidth = bandwidth
+		self.commands = []
+
+	def open(self):
+		time.sleep(self.latency * 4)
+
+	def close(self):
+		pass
+
+	def run(self, command, **kwargs):
+		return self.answer(command, kwargs)
+
+	def sudo(self, command, **kwargs):
+		return self.answer('sudo ' + command, kwargs)
+
+	def put(self, local, remote=None, **kwargs):
+		size = os.path.getsize(local) if isinstance(local, str) and os.path.isfile(local) else 0
+		self.commands.append('put ' + str(local) + ' ' + str(remote or os.path.basename(str(local))))
+		time.sleep(self.latency + size / self.bandwidth)
+
+	def answer(self, command, kwargs):
+		self.commands.append(command)
+		time.sleep(self.latency)
+		stdout, exited = '', 0
+		for pattern, output, status in SIMULATED_OUTPUTS:
+			if re.search(pattern, command):
+				stdout, exited = output, status
+				break
+		if stdout and not kwargs.get('hide'):
+			sys.stdout.write(stdout)
+		result = Result(stdout=stdout, command=command, exited=exited)
+		if exited and not kwargs.get('warn'):
+			raise UnexpectedExit(result)
+		return result
+
+class BatchConnection(object):
+	'''
+	Stand-in for the session connection collecting the commands of the steps into one script,
+	files are still uploaded right away
+	'''
+	def __init__(self, conn):
+		self.conn = conn
+		self.step = ''
+		self.commands = []
+		self.steps = []
+
+	def run(self, command, **kwargs):
+		return self.add('sudo -u "$SUDO_USER" bash -c ' + shlex.quote(command), kwargs)
+
+	def sudo(self, command, **kwargs):
+		return self.add(('sudo ' if command.startswith('-') else '') + command, kwargs)
+
+	def put(self, *args, **kwargs):
+		return self.conn.put(*args, **kwargs)
+
+	def add(self, command, kwargs):
+		if kwargs.get('warn'):
+			command = command + ' || true'
+		self.commands.append((self.step, command))
+		return Result(command=command)
+
+def runbatch(ctx):
+	'''
+	Upload the collected commands as one script and execute it in a single round trip,
+	a failure is mapped back to its step and script line. The steps are recorded and written to the ledger
+	once the script returned, only the steps before a failure count as completed.
+	:return:
+	'''
+	batch = batches.pop(ctx.host)
+	if not batch.commands:
+		finishbatch(ctx, batch, batch.steps)
+		return
+	lines = ['#!/bin/bash', 'set -eE', 'trap \'echo "*** batch failed at command $BATCH_COMMAND"\' ERR']
+	where = []
+	for index, (step, command) in enumerate(batch.commands):
+		lines.append('BATCH_COMMAND=' + str(index))
+		where.append(len('\n'.join(lines).splitlines()) + 1)
+		lines.append(command)
+	tracking.commands = tracking.transferred = 0
+	start = time.time()
+	with tempfile.NamedTemporaryFile('w', suffix='.sh', delete=False) as script:
+		script.write('\n'.join(lines) + '\n')
+	remote = 'emsdeploy-batch.sh'
+	batch.conn.put(script.name, remote)
+	os.remove(script.name)
+	sys.stdout.write("*** Executing " + str(len(batch.commands)) + " commands as one script ***\n")
+	result = batch.conn.sudo('bash ' + remote, pty=True, warn=True)
+	batch.conn.run('rm -f ' + remote)
+	if result.ok:
+		finishbatch(ctx, batch, batch.steps)
+		recordstep(ctx, 'batch', start, 'ok')
+		return
+	failed = re.search(r'batch failed at command (\d+)', result.stdout + result.stderr)
+	if not failed:
+		recordstep(ctx, 'batch', start, 'exit ' + str(result.exited))
+		raise RuntimeError('batch script failed with exit code ' + str(result.exited))
+	step, command = batch.commands[int(failed.group(1))]
+	names = [name for name, digest, record in batch.steps]
+	finishbatch(ctx, batch, batch.steps[:names.index(step)])
+	record = batch.steps[names.index(step)][2]
+	record['status'] = 'failed'
+	sessions[ctx.host]['steps'].append(record)
+	recordstep(ctx, 'batch', start, 'exit ' + str(result.exited))
+	raise RuntimeError(step + ' failed at line ' + str(where[int(failed.group(1))]) + ' of the batch script: ' + command)
+
+def finishbatch(ctx, batch, completed):
+	'''
+	Record the completed steps of a batch and write the ones that ran commands to the ledger,
+	steps that skip themselves in batch mode run again next time
+	:return:
+	'''
+	ran = set(step for step, command in batch.commands)
+	writeledger(ctx, [(name, digest) for name, digest, record in completed if name in ran])
+	sessions[ctx.host]['steps'].extend(record for name, digest, record in completed)
+
+def stepdigest(step, ctx=None):
+	'''
+	Fingerprint of the inputs of a step, an input is a setting of the node section, a whole [section] or every
+	[prefix_*] section of the config, a local file or a function of the task context returning the value. Contents are
+	used for files.
+	:return: hex digest
+	'''
+	digest = hashlib.sha1(step.name.encode())
+	for key in role.STEP_INPUTS.get(step.name, []):
+		if callable(key):
+			digest.update((key.__name__ + '=' + str(key(ctx)) + '\n').encode())
+		elif key.startswith('['):
+			name = key.strip('[]')
+			for section in sorted(role.config.sections()):
+				if section == name or name.endswith('*') and section.startswith(name[:-1]):
+					digest.update(('[' + section + ']\n').encode())
+					for option, value in sorted(role.config._sections[section].items()):
+						digest.update((option + '=' + value + '\n').encode())
+		elif os.path.isfile(key):
+			digest.update((key + '\n').encode())
+			filecontent(digest, key)
+		else:
+			value = nodesettings().get(key, '')
+			digest.update((key + '=' + value + '\n').encode())
+			if os.path.isfile(value):
+				filecontent(digest, value)
+	return digest.hexdigest()
+
+def filecontent(digest, path):
+	'''
+	Add the contents of a local file to a digest
+	:return:
+	'''
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1048576), b''):
+			digest.update(chunk)
+
+def readledger(ctx):
+	'''
+	Completed steps of the host, read once per session
+	:return: dict of step name to input digest
+	'''
+	if 'ledger' not in sessions[ctx.host]:
+		result = sessions[ctx.host]['conn'].sudo('cat ' + LEDGER_FILE, hide=True, warn=True)
+		sessions[ctx.host]['ledger'] = dict(line.split()[:2] for line in result.stdout.splitlines() if len(line.split()) > 1)
+	return sessions[ctx.host]['ledger']
+
+def inventory():
+	'''
+	Hosts of the node, the comma separated hosts field or the single host field
+	:return: list of host addresses
+	'''
+	return clusterhosts(nodesettings())
+
+def clusterhosts(settings):
+	'''
+	Hosts of a node section, entries of the hosts field may carry a stable id as host:id
+	:return: list of host addresses
+	'''
+	return [host.split(':')[0].strip() for host in settings.get('hosts', settings['host']).split(',') if host.strip()]
+
+def kafkacluster(settings):
+	'''
+	Broker ids and ZooKeeper ensemble of the Kafka cluster of a node_kafka section. Clusters list their hosts as host:id,
+	the ensemble is zookeeper_hosts or the three hosts with the lowest ids, always an odd number of hosts.
+	:return: (dict of host to broker id, list of ZooKeeper hosts)
+	'''
+	entries = [host.strip() for host in settings.get('hosts', settings['host']).split(',') if host.strip()]
+	if len(entries) < 2:
+		return {entries[0].split(':')[0]: 1}, [entries[0].split(':')[0]]
+	missing = [host for host in entries if not re.match(r'^[^:]+:\d+$', host)]
+	if missing:
+		raise RuntimeError('hosts of a Kafka cluster need a stable broker id, list them as host:id: ' + ', '.join(missing))
+	brokers = dict((host.split(':')[0], int(host.split(':')[1])) for host in entries)
+	if len(set(brokers.values())) != len(entries):
+		raise RuntimeError('hosts of the Kafka cluster have duplicate hosts or broker ids: ' + ', '.join(entries))
+	if settings.get('zookeeper_hosts'):
+		ensemble = [host.strip() for host in settings['zookeeper_hosts'].split(',') if host.strip()]
+	else:
+		ensemble = sorted(brokers, key=brokers.get)[:3 if len(brokers) > 2 else 1]
+	unknown = [host for host in ensemble if host not in brokers]
+	if unknown:
+		raise RuntimeError('zookeeper_hosts are not hosts of the cluster: ' + ', '.join(unknown))
+	if len(ensemble) % 2 == 0:
+		raise RuntimeError('zookeeper_hosts needs an odd number of hosts for a quorum, ' + str(len(ensemble)) + ' are listed')
+	return brokers, ensemble
+
+def zookeeperconnect(settings):
+	'''
+	zookeeper.connect string of the Kafka cluster of a node_kafka section
+	:return:
+	'''
+	if len(clusterhosts(settings)) < 2:
+		return 'localhost:2181'
+	return ','.join(host + ':2181' for host in kafkacluster(settings)[1])
+
+def runfleet(ctx, hosts, workers):
+	'''
+	Execute full tasks on the hosts with the given number of workers, after preparing the seed host when there is one
+	:return:
+	'''
+	if nodesettings().get('seed'):
+		ctx.seed = nodesettings()['seed']
+		seedctx = Context(config=ctx.config.clone())
+		try:
+			stagehost(seedctx, ctx.seed)
+			seedhost(seedctx)
+		finally:
+			closesession(seedctx)
+	sys.stdout.write("*** Deploying " + str(len(hosts)) + " hosts with " + str(workers) + " workers\n")
+	start = time.time()
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		results = list(pool.map(lambda host: deployhost(ctx, host), hosts))
+	fleetsummary(results, time.time() - start)
+	writereport()
+	if any(result[1] != 'ok' for result in results):
+		sys.exit(1)
+
+def deployhost(ctx, host):
+	'''
+	Execute full tasks on one host, failures are kept to the host
+	:return: (host, status, elapsed seconds, failed step and error)
+	'''
+	hostctx = Context(config=ctx.config.clone())
+	start = time.time()
+	try:
+		stagehost(hostctx, host)
+		runsteps(hostctx, role.DEPLOY_STEPS)
+	except Exception as e:
+		step = sessions.get(hostctx.config.get('host'), {}).get('current', 'staging')
+		return (host, 'failed', time.time() - start, step + ': ' + (str(e).strip() or repr(e)))
+	finally:
+		closesession(hostctx)
+	return (host, 'ok', time.time() - start, '')
+
+def runrollout(ctx, concurrency, upgrade, kind):
+	'''
+	Restart the hosts of the inventory a few at a time with the rollhost of the role, the rollout stops after the group
+	in which a host failed
+	:return:
+	'''
+	hosts = inventory()
+	concurrency = int(concurrency) or int(nodesettings().get('rolling_concurrency', 1))
+	sys.stdout.write("*** Rolling " + ('upgrade' if upgrade else 'restart') + " of " + str(len(hosts)) + " " + kind + ", "\
+	 + str(concurrency) + " at a time\n")
+	start = time.time()
+	results = []
+	for index in range(0, len(hosts), concurrency):
+		with ThreadPoolExecutor(max_workers=concurrency) as pool:
+			results += list(pool.map(lambda host: rollouthost(ctx, host, upgrade), hosts[index:index + concurrency]))
+		if any(result[1] != 'ok' for result in results):
+			sys.stdout.write("*** Rollout stopped, not restarted: " + (', '.join(hosts[index + concurrency:]) or 'none') + "\n")
+			break
+	fleetsummary(results, time.time() - start)
+	writereport()
+	if any(result[1] != 'ok' for result in results):
+		sys.exit(1)
+
+def rollouthost(ctx, host, upgrade):
+	'''
+	Restart one host with the rollhost of the role, failures are kept to the host
+	:return: (host, status, elapsed seconds, error)
+	'''
+	hostctx = Context(config=ctx.config.clone())
+	start = time.time()
+	try:
+		stagehost(hostctx, host)
+		tracking.commands = tracking.transferred = 0
+		role.rollhost(hostctx, upgrade)
+		recordstep(hostctx, 'rollingrestart', start, 'ok')
+	except Exception as e:
+		if hostctx.config.get('host') in sessions:
+			recordstep(hostctx, 'rollingrestart', start, 'failed')
+		return (host, 'failed', time.time() - start, str(e).strip() or repr(e))
+	finally:
+		closesession(hostctx)
+	return (host, 'ok', time.time() - start, '')
+
+def fleetsummary(results, elapsed):
+	'''
+	Print the consolidated result of a fleet deployment
+	:return:
+	'''
+	sys.stdout.write("\n****************************\n")
+	sys.stdout.write("*** Fleet deployment summary\n")
+	sys.stdout.write("****************************\n")
+	for host, status, seconds, error in results:
+		sys.stdout.write("%-24s %-8s %8.1fs  %s\n" % (host, status, seconds, error.splitlines()[0] if error else ''))
+	failed = len([result for result in results if result[1] != 'ok'])
+	sys.stdout.write("*** " + str(len(results) - failed) + " succeeded, " + str(failed) + " failed in "\
+	 + "%.1fs ***\n" % elapsed)
+
+def cacheartifact(source, checksum=''):
+	'''
+	Keep a local file or a download in the local content addressed cache, verified by its sha256 checksum
+	:return: (local path, sha256)
+	'''
+	if os.path.isfile(source):
+		path = source
+	else:
+		os.makedirs(ARTIFACT_CACHE, exist_ok=True)
+		index = os.path.join(ARTIFACT_CACHE, hashlib.sha1(source.encode()).hexdigest() + '.url')
+		if not checksum and os.path.isfile(index):
+			with open(index) as f:
+				checksum = f.read().strip()
+		path = os.path.join(ARTIFACT_CACHE, checksum or 'unknown')
+		if not os.path.isfile(path):
+			sys.stdout.write("*** Downloading " + source + " into the artifact cache\n")
+			with tempfile.NamedTemporaryFile(dir=ARTIFACT_CACHE, delete=False) as partial:
+				with urllib.request.urlopen(source) as response:
+					shutil.copyfileobj(response, partial)
+			path = os.path.join(ARTIFACT_CACHE, filedigest(partial.name))
+			os.rename(partial.name, path)
+			with open(index, 'w') as f:
+				f.write(os.path.basename(path))
+	digest = filedigest(path)
+	if checksum and digest != checksum:
+		raise RuntimeError(source + ' has sha256 ' + digest + ', expected ' + checksum)
+	return path, digest
+
+def filedigest(path):
+	'''
+	sha256 of a local file, remembered while the file doesn't change
+	:return: hex digest
+	'''
+	key = (path, os.path.getmtime(path), os.path.getsize(path))
+	if key not in digests:
+		digest = hashlib.sha256()
+		with open(path, 'rb') as f:
+			for chunk in iter(lambda: f.read(1048576), b''):
+				digest.update(chunk)
+		digests[key] = digest.hexdigest()
+	return digests[key]
+
+def pushartifact(ctx, conn, source, checksum=''):
+	'''
+	Make an artifact available on the host under its checksum, pulled from the seed host when there is one,
+	uploaded from the local cache otherwise. Artifacts already on the host are not transferred again.
+	:return: remote path
+	'''
+	with artifactlock:
+		if ctx.config.get('simulate') and not os.path.isfile(source):
+			path, checksum = source, hashlib.sha256(source.encode()).hexdigest()
+		else:
+			path, checksum = cacheartifact(source, checksum)
+	remote = REMOTE_CACHE + '/' + checksum
+	if sessions[ctx.host]['conn'].run('test -f ' + remote, hide=True, warn=True).ok:
+		return remote
+	conn.sudo('mkdir -p ' + REMOTE_CACHE)
+	if ctx.config.get('seed') and ctx.seed != ctx.address:
+		conn.sudo('curl -fsS http://' + ctx.seed + ':' + ARTIFACT_PORT + '/' + checksum + ' -o ' + remote + '.part')
+	else:
+		conn.put(path, 'emsdeploy-' + checksum)
+		conn.sudo('mv emsdeploy-' + checksum + ' ' + remote + '.part')
+	conn.sudo('bash -c "echo \'' + checksum + '  ' + remote + '.part\' | sha256sum -c --quiet"')
+	conn.sudo('mv ' + remote + '.part ' + remote)
+	conn.sudo('chmod 644 ' + remote)
+	return remote
+
+def aptproxy(ctx, conn):
+	'''
+	Point apt of the host to the proxy of the seed host or to the configured apt_proxy
+	:return:
+	'''
+	proxy = nodesettings().get('apt_proxy', '')
+	if ctx.config.get('seed'):
+		proxy = 'http://' + ctx.seed + ':' + APT_PROXY_PORT
+	if proxy:
+		conn.sudo('bash -c ' + shlex.quote('echo ' + shlex.quote('Acquire::http::Proxy "' + proxy + '";') + ' > ' + APT_PROXY_FILE))
+	else:
+		conn.sudo('rm -f ' + APT_PROXY_FILE)
+
+def seedhost(ctx):
+	'''
+	Prepare the seed host, it serves an apt proxy and the artifacts of the node to the rest of the fleet and both ports
+	are only open to the hosts of the fleet
+	:return:
+	'''
+	with session(ctx) as conn:
+		sys.stdout.write("****************************\n")
+		sys.stdout.write("*** Preparing artifact seed " + ctx.address + "\n")
+		sys.stdout.write("****************************\n")
+		conn.sudo('apt-get update')
+		conn.sudo('DEBIAN_FRONTEND=noninteractive apt-get install -y apt-cacher-ng')
+		firewall(conn, [], restricted=[(port, host) for port in (APT_PROXY_PORT, ARTIFACT_PORT) for host in inventory()])
+		if not role.artifacts():
+			return
+		for source, checksum in role.artifacts():
+			pushartifact(ctx, conn, source, checksum)
+		conn.sudo('systemctl stop emsdeploy-artifacts', hide=True, warn=True)
+		conn.sudo('systemd-run --unit=emsdeploy-artifacts -p WorkingDirectory=' + REMOTE_CACHE\
+		 + ' python3 -m http.server ' + ARTIFACT_PORT)
+
+def waitfor(ctx, conn, name, check=None, deadline=120):
+	'''
+	Wait until a readiness probe succeeds on the host, retried with exponential backoff until the deadline
+	:return:
+	'''
+	script = 'start=$(date +%s%N); delay=0.1; '\
+	 + 'until (' + (check or role.PROBES[name]) + ') 2> /dev/null; do '\
+	 + 'if [ $(( ($(date +%s%N) - start) / 1000000000 )) -ge ' + str(deadline) + ' ]; then '\
+	 + 'echo "*** ' + name + ' not ready after ' + str(deadline) + 's"; exit 1; fi; '\
+	 + 'sleep $delay; delay=$(awk "BEGIN { print ($delay * 2 > 5) ? 5 : $delay * 2 }"); done; '\
+	 + 'echo "*** ' + name + ' ready in $(( ($(date +%s%N) - start) / 1000000 ))ms"'
+	result = conn.sudo('bash -c ' + shlex.quote(script))
+	ready = re.search(r'ready in (\d+)ms', result.stdout)
+	if ready:
+		sessions[ctx.host]['ready'].append((name, int(ready.group(1)) / 1000.0))
+
+def portprobe(port):
+	'''
+	Probe succeeding once the local port accepts connections
+	:return: shell check
+	'''
+	return 'exec 3<>/dev/tcp/127.0.0.1/' + str(port)
+
+def serviceprobe(service):
+	'''
+	Probe succeeding once the systemd service is active
+	:return: shell check
+	'''
+	return 'systemctl is-active --quiet ' + service
+
+@task
+def servertasks(ctx):
+	'''
+	Prepare the node, install updates
+	:return:
+	'''
+	with session(ctx) as conn:
+		sys.stdout.write("****************************\n")
+		sys.stdout.write("*** Starting Preperation of the Server\n")
+		sys.stdout.write("****************************\n")
+		aptproxy(ctx, conn)
+		conn.sudo('apt-get update')
+		conn.sudo('apt-get -y upgrade')
+		conn.sudo('mv /var/lib/dpkg/lock /var/lib/dpkg/lock_backup')
+		conn.sudo('apt-get install -y wget ca-certificates curl')
+		conn.sudo('rm -vf /var/lib/dpkg/lock_backup')
+		sys.stdout.write("*** Server prepared ***\n\n")
+
+@task
+def tunehost(ctx):
+	'''
+	Apply and persist the kernel, limit and mount settings of the node, verified in a before/after report
+	:return:
+	'''
+	with session(ctx) as conn:
+		sys.stdout.write("****************************\n")
+		sys.stdout.write("*** Tuning the host for " + role.NAME + "\n")
+		sys.stdout.write("****************************\n")
+		before = hoststate(ctx)
+		putcontent(conn, ''.join(key + ' = ' + value + '\n' for key, value in role.TUNING_SYSCTL), SYSCTL_FILE)
+		conn.sudo('sysctl -p ' + SYSCTL_FILE)
+		putcontent(conn, '\n'.join([
+			'[Unit]',
+			'Description=Transparent hugepage mode of emsdeploy',
+			'DefaultDependencies=no',
+			'After=sysinit.target local-fs.target',
+			'Before=basic.target',
+			'',
+			'[Service]',
+			'Type=oneshot',
+			"ExecStart=/bin/sh -c 'echo " + role.TUNING_HUGEPAGES + " > /sys/kernel/mm/transparent_hugepage/enabled && echo "\
+			 + role.TUNING_HUGEPAGES + " > /sys/kernel/mm/transparent_hugepage/defrag'",
+			'',
+			'[Install]',
+			'WantedBy=basic.target',
+		]) + '\n', HUGEPAGES_UNIT)
+		putcontent(conn, 'ACTION=="add|change", SUBSYSTEM=="block", KERNEL=="sd[a-z]|vd[a-z]|xvd[a-z]|nvme[0-9]n[0-9]", '\
+		 + 'ATTR{queue/read_ahead_kb}="' + role.TUNING_READAHEAD_KB + '"\n', READAHEAD_RULES)
+		for unit in role.TUNING_LIMIT_UNITS:
+			conn.sudo('mkdir -p /etc/systemd/system/' + unit + '.service.d')
+			putcontent(conn, '[Service]\n' + ''.join(key + '=' + value + '\n' for key, value in role.TUNING_LIMITS),
+			 '/etc/systemd/system/' + unit + '.service.d/limits.conf')
+		conn.sudo('systemctl daemon-reload')
+		conn.sudo('systemctl enable emsdeploy-hugepages')
+		conn.sudo('systemctl restart emsdeploy-hugepages')
+		conn.sudo('udevadm control --reload')
+		conn.sudo('udevadm trigger --subsystem-match=block --action=change')
+		conn.sudo('bash -c ' + shlex.quote('[ -f /etc/fstab.emsdeploy ] || cp /etc/fstab /etc/fstab.emsdeploy; '\
+		 + 'for dir in ' + ' '.join(role.TUNING_DATA_DIRS) + '; do '\
+		 + 'while [ ! -e "$dir" ]; do dir=$(dirname "$dir"); done; '\
+		 + 'findmnt -n -o OPTIONS --target "$dir" | grep -qw noatime && continue; '\
+		 + 'target=$(findmnt -n -o TARGET --target "$dir"); '\
+		 + 'awk -v target="$target" \'$2 == target && $4 !~ /noatime/ { $4 = $4 ",noatime" } { print }\' /etc/fstab > /etc/fstab.new '\
+		 + '&& mv /etc/fstab.new /etc/fstab; mount -o remount,noatime "$target"; echo "*** noatime on $target"; done'))
+		tuningreport(ctx, before, hoststate(ctx))
+
+def hoststate(ctx):
+	'''
+	Current values of the tuned settings, read in one command
+	:return: dict of setting to value, None in batch mode
+	'''
+	if ctx.host in batches:
+		return None
+	script = ''.join('echo "' + key + '=$(sysctl -n ' + key + ' | tr -s \'\\t \' \' \')"; ' for key, value in role.TUNING_SYSCTL)\
+	 + 'echo "transparent_hugepage=$(sed \'s/.*\\[\\(.*\\)\\].*/\\1/\' /sys/kernel/mm/transparent_hugepage/enabled)"; '\
+	 + 'for disk in $(lsblk -dno NAME,TYPE | awk \'$2 == "disk" && $1 ~ /^(sd|vd|xvd|nvme)/ { print $1 }\'); do '\
+	 + 'echo "read_ahead_kb $disk=$(cat /sys/block/$disk/queue/read_ahead_kb)"; done; '\
+	 + 'for dir in ' + ' '.join(role.TUNING_DATA_DIRS) + '; do path=$dir; while [ ! -e "$path" ]; do path=$(dirname "$path"); done; '\
+	 + 'echo "noatime $dir=$(findmnt -n -o OPTIONS --target "$path" | grep -qw noatime && echo yes || echo no)"; done; '\
+	 + 'for unit in ' + ' '.join(role.TUNING_LIMIT_UNITS) + '; do '\
+	 + 'loaded=$(systemctl show -p LoadState $unit | cut -d= -f2); '\
+	 + ''.join('echo "' + key + ' $unit=$([ "$loaded" = loaded ] && systemctl show -p ' + key\
+	 + ' $unit | cut -d= -f2 || echo not installed)"; ' for key, value in role.TUNING_LIMITS) + 'done'
+	result = sessions[ctx.host]['conn'].sudo('bash -c ' + shlex.quote(script), hide=True, warn=True)
+	return dict(line.split('=', 1) for line in result.stdout.splitlines() if '=' in line)
+
+def tuningtarget(key):
+	'''
+	Value a tuned setting should have
+	:return:
+	'''
+	targets = dict(role.TUNING_SYSCTL)
+	targets['transparent_hugepage'] = role.TUNING_HUGEPAGES
+	targets.update((key + ' ' + unit, value) for key, value in role.TUNING_LIMITS for unit in role.TUNING_LIMIT_UNITS)
+	if key.startswith('read_ahead_kb '):
+		return role.TUNING_READAHEAD_KB
+	if key.startswith('noatime '):
+		return 'yes'
+	return targets.get(key, '')
+
+def tuningreport(ctx, before, after):
+	'''
+	Print the settings before and after the tuning and write them into the reports folder,
+	settings of services not installed yet are pending
+	:return:
+	'''
+	if after is None:
+		sys.stdout.write("*** Host tuned, the before/after report is skipped in batch mode ***\n\n")
+		return
+	rows = []
+	for key in after:
+		target = tuningtarget(key)
+		status = 'ok' if after[key] == target else 'pending' if after[key] == 'not installed' else 'MISMATCH'
+		rows.append({'host': ctx.host, 'setting': key, 'before': before.get(key, ''), 'after': after[key], 'target': target, 'status': status})
+	os.makedirs(REPORT_DIR, exist_ok=True)
+	name = os.path.join(REPORT_DIR, role.NAME + '-tuning-' + ctx.address + '-' + time.strftime('%Y%m%d-%H%M%S'))
+	with open(name + '.json', 'w') as f:
+		json.dump(rows, f, indent=2)
+	sys.stdout.write("%-36s %-24s %-24s %s\n" % ('setting', 'before', 'after', 'status'))
+	for row in rows:
+		sys.stdout.write("%-36s %-24s %-24s %s\n" % (row['setting'], row['before'], row['after'], row['status']))
+	mismatches = len([row for row in rows if row['status'] == 'MISMATCH'])
+	sys.stdout.write("*** Host tuned, " + (str(mismatches) + " settings did not take effect" if mismatches else "all settings verified")\
+	 + ", report written to " + name + ".json ***\n\n")
+
+def putcontent(conn, content, path, owner='root:root', mode='644'):
+	'''
+	Upload content as a remote file, ownership and mode are set before it is moved into place
+	:return:
+	'''
+	with tempfile.NamedTemporaryFile('w', delete=False) as f:
+		f.write(content)
+	remote = 'emsdeploy-' + os.path.basename(f.name) + '-' + os.path.basename(path)
+	conn.put(f.name, remote)
+	os.remove(f.name)
+	conn.sudo('chown ' + owner + ' ' + remote)
+	conn.sudo('chmod ' + mode + ' ' + remote)
+	conn.sudo('mv ' + remote + ' ' + path)
+
+def hostfacts(conn):
+	'''
+	CPU count, memory and data disks of the host, the names tuning settings can use
+	:return: dict of facts
+	'''
+	cpus = int(conn.run('nproc', hide=True).stdout.strip())
+	memory = conn.run('grep MemTotal /proc/meminfo', hide=True).stdout.split()
+	disks = conn.run('lsblk -dno NAME,ROTA,TYPE', hide=True).stdout.splitlines()
+	disks = [disk.split() for disk in disks if disk.split()[-1:] == ['disk']]
+	return {
+		'cpus': cpus,
+		'ram_mb': int(memory[1]) // 1024,
+		'disks': max(len(disks), 1),
+		'ssd': int(all(disk[1] == '0' for disk in disks)),
+	}
+
+def evaluate(key, value, facts):
+	'''
+	Value of a tuning setting, an arithmetic expression of the host facts such as max(8, cpus * 2) or a plain value.
+	Values naming a fact or a function must parse as an expression, the error names the key otherwise.
+	:return: string value
+	'''
+	if not re.search(r'\b(' + '|'.join(list(facts) + list(FUNCTIONS)) + r')\b', value):
+		return value
+	try:
+		return str(arithmetic(ast.parse(value.strip(), mode='eval').body, facts))
+	except (SyntaxError, ValueError, TypeError, ZeroDivisionError) as e:
+		raise RuntimeError(key + ' = ' + value + ' is not an expression of the host facts '\
+		 + ', '.join(sorted(facts)) + ': ' + str(e))
+
+def arithmetic(node, facts):
+	'''
+	Evaluate a parsed expression made of numbers, host facts, arithmetic operators and min, max and round
+	:return: number
+	'''
+	if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+		return node.value
+	if isinstance(node, ast.Name) and node.id in facts:
+		return facts[node.id]
+	if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+		return OPERATORS[type(node.op)](arithmetic(node.left, facts), arithmetic(node.right, facts))
+	if isinstance(node, ast.UnaryOp) and type(node.op) in OPERATORS:
+		return OPERATORS[type(node.op)](arithmetic(node.operand, facts))
+	if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS and not node.keywords:
+		return FUNCTIONS[node.func.id](*[arithmetic(argument, facts) for argument in node.args])
+	if isinstance(node, ast.Name):
+		raise ValueError('unknown name ' + node.id)
+	raise ValueError('unsupported ' + type(node).__name__)
+
+def showdiff(current, rendered, path):
+	'''
+	Print the difference between the current and the rendered content of a remote file
+	:return: True when they differ
+	'''
+	diff = list(difflib.unified_diff(current.splitlines(), rendered.splitlines(), path, path + ' (rendered)', lineterm=''))
+	for line in diff:
+		sys.stdout.write(line + '\n')
+	return bool(diff)
+
+def firewall(conn, ports, scraped=(), restricted=()):
+	'''
+	Open the TCP ports of the node, the scraped ports only to scrape_source and the restricted (port, address) pairs
+	only to their address, other sources are dropped on those ports except on the loopback. Rules missing from the live
+	ruleset are added, duplicates left by earlier runs and rules opening a restricted port to any source are removed in
+	one iptables-restore, the ruleset is saved only when it changed
+	:return:
+	'''
+	source = scrapesource() if scraped else ''
+	entries = [str(port) + ',' for port in ports] + [str(port) + ',' + source for port in scraped]\
+	 + [str(port) + ',' + ipv4network(address, 'firewall source') for port, address in restricted]
+	conn.sudo('bash -c ' + shlex.quote('rules=$(iptables-save -t filter); delta=""; opened=""; removed=0; restricted=" "; '\
+	 + 'count() { printf "%s\\n" "$rules" | grep -cxF -- "-A $1"; }; '\
+	 + 'for entry in ' + ' '.join(entries) + '; do port=${entry%%,*}; source=${entry#*,}; '\
+	 + 'any="INPUT -p tcp -m tcp --dport $port -j ACCEPT"; '\
+	 + 'if [ -n "$source" ]; then rule="INPUT -s $source -p tcp -m tcp --dport $port -j ACCEPT"; '\
+	 + 'if [ "${restricted#* $port }" = "$restricted" ]; then restricted="$restricted$port "; '\
+	 + 'for stale in $(seq 1 "$(count "$any")"); do delta="$delta-D $any\\n"; removed=$((removed + 1)); done; '\
+	 + 'if grep -qx "### tuple ### allow tcp $port 0.0.0.0/0 any 0.0.0.0/0 in" /etc/ufw/user.rules 2> /dev/null; then '\
+	 + 'ufw delete allow $port/tcp > /dev/null; fi; '\
+	 + 'drop="INPUT ! -i lo -p tcp -m tcp --dport $port -j DROP"; '\
+	 + 'if [ "$(count "$drop")" -eq 0 ]; then delta="$delta-A $drop\\n"; fi; fi; '\
+	 + 'grep -qx "### tuple ### allow tcp $port 0.0.0.0/0 any ${source%/32} in" /etc/ufw/user.rules 2> /dev/null '\
+	 + '|| ufw allow from ${source%/32} to any port $port proto tcp > /dev/null; '\
+	 + 'else rule="$any"; '\
+	 + 'grep -qx "### tuple ### allow tcp $port 0.0.0.0/0 any 0.0.0.0/0 in" /etc/ufw/user.rules 2> /dev/null '\
+	 + '|| ufw allow $port/tcp > /dev/null; fi; '\
+	 + 'found=$(count "$rule"); '\
+	 + 'if [ "$found" -eq 0 ]; then delta="$delta-I $rule\\n"; opened="$opened $port${source:+ from $source}"; fi; '\
+	 + 'for extra in $(seq 2 "$found"); do delta="$delta-D $rule\\n"; removed=$((removed + 1)); done; done; '\
+	 + 'if ! dpkg -s iptables-persistent > /dev/null 2>&1; then '\
+	 + 'echo iptables-persistent iptables-persistent/autosave_v4 boolean true | debconf-set-selections; '\
+	 + 'echo iptables-persistent iptables-persistent/autosave_v6 boolean true | debconf-set-selections; '\
+	 + 'DEBIAN_FRONTEND=noninteractive apt-get install -y iptables-persistent > /dev/null; fi; '\
+	 + 'if [ -z "$delta" ]; then echo "*** Firewall unchanged"; exit 0; fi; '\
+	 + 'printf "*filter\\n${delta}COMMIT\\n" | iptables-restore --noflush; netfilter-persistent save; '\
+	 + 'echo "*** Firewall: opened${opened:- no ports}, removed $removed duplicate or open rules of restricted ports"'))
+
+def ipv4network(value, setting):
+	'''
+	IPv4 address or network of a firewall source, host names are resolved
+	:return: network in iptables-save notation
+	'''
+	try:
+		return str(ipaddress.IPv4Network(value, strict=False))
+	except ValueError:
+		pass
+	try:
+		return str(ipaddress.IPv4Network(socket.gethostbyname(value)))
+	except (OSError, ValueError) as e:
+		raise RuntimeError(setting + ' = ' + value + ' is not an IPv4 address, network or resolvable host: ' + str(e))
+
+def scrapesource():
+	'''
+	Address or network of the Prometheus server, set with scrape_source in the node section, the exporter ports are only
+	open to it
+	:return: network in iptables-save notation
+	'''
+	source = nodesettings().get('scrape_source', '').strip()
+	if not source:
+		raise RuntimeError('scrape_source must name the address or network of the Prometheus server, the exporter ports are'\
+		 + ' only open to it')
+	return ipv4network(source, 'scrape_source')
+
+def exporterpassword():
+	'''
+	Password of the database account of the exporters, set with exporter_password in the node section, it must differ
+	from the root password of the database
+	:return:
+	'''
+	settings = nodesettings()
+	password = settings.get('exporter_password', '')
+	if not password:
+		raise RuntimeError('exporter_password must be set, the database exporter logs in with its own account')
+	if password in (settings.get('sql_password'), settings.get('postgres_password')):
+		raise RuntimeError('exporter_password must differ from the root password of the database')
+	return password
+
+def exporters():
+	'''
+	Exporters are enabled with exporters = yes in the node section
+	:return:
+	'''
+	return nodesettings().get('exporters', 'no').lower() in ('yes', 'true', '1')
+
+@task
+def verifyexporters(ctx):
+	'''
+	Scrape every exporter of the node and check that the key throughput and latency series are exported
+	:return:
+	'''
+	if ctx.host in batches:
+		sys.stdout.write("*** verifyexporters needs the scraped metrics, run it after the batch\n")
+		return
+	with session(ctx):
+		missing = scrapeexporters(sessions[ctx.host]['conn'], role.EXPORTERS)
+	if missing:
+		raise RuntimeError('series missing from the exporters: ' + ', '.join(missing))
+	sys.stdout.write("*** All exporters verified ***\n\n")
+
+def scrapeexporters(conn, endpoints):
+	'''
+	Scrape the endpoints in one remote command and count the samples of every expected series
+	:return: list of missing series
+	'''
+	script = ''
+	for index, (name, port, series) in enumerate(endpoints):
+		script += 'metrics=$(curl -fsS --max-time 10 http://localhost:' + str(port) + '/metrics) || metrics=""; '\
+		 + ''.join('echo "' + str(index) + ' ' + str(number) + ' $(printf "%s\\n" "$metrics" | grep -cE ' + shlex.quote('^' + pattern)\
+		 + ')"; ' for number, pattern in enumerate(series))
+	counts = dict(((int(index), int(number)), int(count)) for index, number, count in
+	 [line.split() for line in conn.sudo('bash -c ' + shlex.quote(script), hide=True).stdout.splitlines() if len(line.split()) == 3])
+	missing = []
+	sys.stdout.write("%-12s %-6s %-72s %s\n" % ('exporter', 'port', 'series', 'samples'))
+	for index, (name, port, series) in enumerate(endpoints):
+		for number, pattern in enumerate(series):
+			count = counts.get((index, number), 0)
+			sys.stdout.write("%-12s %-6s %-72s %s\n" % (name, port, pattern.replace('\\', ''), count or 'MISSING'))
+			if not count:
+				missing.append(name + ':' + pattern.replace('\\', '').strip())
+	return missing
+
+def drain(read, keep=65536):
+	'''
+	Read a stream of a channel to its end in a background thread so the remote command never blocks on a full window
+	while this side reads or writes the other stream, the last keep bytes are kept for the error message
+	:return: function waiting for the end of the stream and returning its kept output
+	'''
+	kept = bytearray()
+	def reader():
+		for chunk in iter(read, b''):
+			kept.extend(chunk)
+			del kept[:-keep]
+	thread = threading.Thread(target=reader, daemon=True)
+	thread.start()
+	def output():
+		thread.join()
+		return kept.decode('utf-8', 'replace')
+	return output
+
+def pipeto(conn, command, path, compress):
+	'''
+	Stream a local file into the stdin of a remote command over its own channel of the session,
+	gzip compressed on the way when asked
+	:return: bytes sent
+	'''
+	channel = conn.client.get_transport().open_session()
+	channel.set_combine_stderr(True)
+	channel.exec_command(command)
+	output = drain(lambda: channel.recv(1048576))
+	compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+	sent = 0
+	with open(path, 'rb') as source:
+		for chunk in iter(lambda: source.read(1048576), b''):
+			if compressor:
+				chunk = compressor.compress(chunk)
+			channel.sendall(chunk)
+			sent += len(chunk)
+	if compressor:
+		chunk = compressor.flush()
+		channel.sendall(chunk)
+		sent += len(chunk)
+	channel.shutdown_write()
+	output = output()
+	status = channel.recv_exit_status()
+	channel.close()
+	if status != 0:
+		raise RuntimeError(command.split(' -p')[0] + ' exited with ' + str(status) + ': ' + output.strip())
+	return sent
+
+def pullfrom(conn, command, path):
+	'''
+	Stream the output of a remote command into a local file over its own channel of the session
+	:return: bytes received
+	'''
+	channel = conn.client.get_transport().open_session()
+	channel.exec_command(command)
+	errors = drain(lambda: channel.recv_stderr(1048576))
+	received = 0
+	with open(path, 'wb') as target:
+		for chunk in iter(lambda: channel.recv(1048576), b''):
+			target.write(chunk)
+			received += len(chunk)
+	errors = errors()
+	status = channel.recv_exit_status()
+	channel.close()
+	if status != 0:
+		raise RuntimeError(command.split(' -p')[0] + ' exited with ' + str(status) + ': ' + errors.strip())
+	return received
+
+def relay(source, command, target, restore):
+	'''
+	Stream the output of a command on one host into the stdin of a command on another host without a copy on either,
+	the data passes through this machine as it is, compressed when the commands compress it
+	:return: bytes relayed
+	'''
+	reader = source.client.get_transport().open_session()
+	reader.exec_command(command)
+	errors = drain(lambda: reader.recv_stderr(1048576))
+	writer = target.client.get_transport().open_session()
+	writer.set_combine_stderr(True)
+	writer.exec_command(restore)
+	output = drain(lambda: writer.recv(1048576))
+	relayed = 0
+	for chunk in iter(lambda: reader.recv(1048576), b''):
+		writer.sendall(chunk)
+		relayed += len(chunk)
+	writer.shutdown_write()
+	errors = errors()
+	output = output()
+	status = reader.recv_exit_status(), writer.recv_exit_status()
+	reader.close()
+	writer.close()
+	if status[0] != 0:
+		raise RuntimeError(command.split(' -p')[0] + ' exited with ' + str(status[0]) + ': ' + errors.strip())
+	if status[1] != 0:
+		raise RuntimeError(restore.split(' -p')[0] + ' exited with ' + str(status[1]) + ': ' + output.strip())
+	return relayed
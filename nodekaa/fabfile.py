@@ -22,59 +22,124 @@
 
 import os
 import configparser
+import glob
+import gzip
+import json
+import re
+import shlex
 import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from fabric import task, Connection
+from invoke import Context
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import emsdeploy
+from emsdeploy import deploy, batch, simulate, staging, servertasks, tunehost, verifyexporters, JMX_EXPORTER_DIR,\
+	JMX_EXPORTER_URL, REPORT_DIR, batches, closesession, clusterhosts, evaluate, exporterpassword, exporters, firewall,\
+	hostfacts, inventory, pipeto, portprobe, pullfrom, pushartifact, putcontent, relay, runfleet, runrollout,\
+	serviceprobe, session, sessions, showdiff, stagehost, tracking, waitfor, zookeeperconnect
+
+NAME = "kaa"
+SECTION = "node_kaa"
 CONFIG_FILE = "kaa.cfg"
 config = configparser.RawConfigParser()
 config.read(CONFIG_FILE)
 
-@task
-def deploy(ctx):
-	'''
-	Execute full tasks at once
-	:return:
-	'''
-	staging(ctx)
-	servertasks(ctx)
-	installjava(ctx)
-	installmariadb(ctx)
-	securemariadb(ctx)
-	createkaatables(ctx)
-	installzookeeper(ctx)
-	installmongodb(ctx)
-	installkaanode(ctx)
-	configurekaanode(ctx)
-	initiatekaanode(ctx)
-	finishdeployment(ctx)
+KAA_LOG = "/var/log/kaa/kaa-node.log"
+KAA_DEFAULTS = "/etc/default/kaa-node"
+MONGODB_CONF = "/etc/mongodb.conf"
+KAA_API = "http://localhost:8080/kaaAdmin/rest/api/"
+KAFKA_APPENDER_CLASS = "org.kaaproject.kaa.server.appenders.kafka.appender.KafkaLogAppender"
+KAFKA_SCRIPTS = "/home/kafka/kafka/bin/"
+APPENDER_ACKS = {'all': 'ALL', '-1': 'ALL', '1': 'ONE', '0': 'ZERO'}
+
+KAA_TUNING = [
+	('heap_mb', 'max(512, (ram_mb - 1024) * 35 // 100)'),
+	('gc_options', '-XX:+UseG1GC -XX:MaxGCPauseMillis=200 -XX:+ParallelRefProcEnabled'),
+	('wiredtiger_cache_gb', 'max(0.25, round((ram_mb - 1024) * 30 / 100 / 1024, 2))'),
+	('mongodb_database', 'kaa'),
+]
+KAA_INDEXES = [
+	('endpoint_profile', 'endpoint_key_hash, application_id'),
+	('endpoint_notification', 'endpoint_key_hash'),
+	('notification', 'topic_id+seq_num'),
+	('logs_*', 'header.endpointKeyHash, header.timestamp'),
+]
+
+TUNING_SYSCTL = [
+	('vm.swappiness', '1'),
+	('vm.dirty_background_ratio', '5'),
+	('vm.dirty_ratio', '15'),
+	('vm.max_map_count', '262144'),
+	('net.core.somaxconn', '4096'),
+	('net.core.rmem_max', '16777216'),
+	('net.core.wmem_max', '16777216'),
+	('net.ipv4.tcp_rmem', '4096 87380 16777216'),
+	('net.ipv4.tcp_wmem', '4096 65536 16777216'),
+	('net.ipv4.tcp_keepalive_time', '120'),
+]
+TUNING_HUGEPAGES = "never"
+TUNING_READAHEAD_KB = "16"
+TUNING_DATA_DIRS = ['/var/lib/mysql', '/var/lib/mongodb']
+TUNING_LIMIT_UNITS = ['mariadb', 'mongodb', 'kaa-node']
+TUNING_LIMITS = [('LimitNOFILE', '100000'), ('LimitNPROC', '65536')]
+FIREWALL_PORTS = [22, 8080, 9888, 9889, 9997, 9999]
+
+EXPORTERS = [
+	('node', 9100, [r'node_cpu(_seconds_total)?\{', r'node_disk_io_time(_ms|_seconds_total)?\{', r'node_network_receive_bytes(_total)?\{']),
+	('kaa', 7071, [r'jvm_memory_bytes_used\{', r'jvm_gc_collection_seconds_count\{', r'jvm_threads_current ']),
+	('zookeeper', 7072, [r'zookeeper_avgrequestlatency', r'zookeeper_packetsreceived', r'zookeeper_outstandingrequests']),
+	('mysqld', 9104, [r'mysql_up 1', r'mysql_global_status_queries ', r'mysql_global_status_threads_connected ']),
+	('mongodb', 9216, [r'mongodb_(mongod_)?op_counters_total\{', r'mongodb_(mongod_)?connections\{']),
+]
+JMX_RULES = {
+	'kaa': r'''lowercaseOutputName: true
+lowercaseOutputLabelNames: true
+rules:
+- pattern: '.*'
+''',
+	'zookeeper': r'''lowercaseOutputName: true
+rules:
+- pattern: 'org.apache.ZooKeeperService<name0=ReplicatedServer_id(\d+), name1=replica.(\d+), name2=(\w+)><>(\w+)'
+  name: zookeeper_$4
+  labels:
+    replica: '$2'
+    role: '$3'
+- pattern: 'org.apache.ZooKeeperService<name0=StandaloneServer_port(\d+)><>(\w+)'
+  name: zookeeper_$2
+''',
+}
+
+PROBES = {
+	'mariadb': 'mysqladmin ping > /dev/null 2>&1',
+	'zookeeper': 'exec 3<>/dev/tcp/127.0.0.1/2181 && echo ruok >&3 && timeout 2 cat <&3 | grep -q imok',
+	'mongodb': 'mongo --quiet --eval "db.runCommand({ connectionStatus: 1 }).ok" | grep -q 1',
+	'kaa-admin': 'curl -fsS -o /dev/null http://localhost:8080/kaaAdmin/',
+}
 
 @task
-def staging(ctx):
+def fleet(ctx, workers=0, force=False, batch=False, parallel=False):
 	'''
-	Setting up host credentials
+	Execute full tasks on every host of the inventory in parallel
 	:return:
 	'''
-	ctx.name = 'staging'
-	ctx.user = config._sections['node_kaa']['user']
-	ctx.connect_kwargs = {"key_filename":[config._sections['node_kaa']['keyfile']]}
-	ctx.host = config._sections['node_kaa']['host'] + ':' + config._sections['node_kaa']['port']
+	ctx.force = force
+	ctx.batch = batch
+	ctx.parallel = parallel
+	hosts = inventory()
+	workers = int(workers) or int(config._sections['node_kaa'].get('workers', len(hosts)))
+	restorechoice(ctx)
+	runfleet(ctx, hosts, workers)
 
-@task
-def servertasks(ctx):
+def artifacts():
 	'''
-	Prepare the node, install updates
-	:return:
+	Artifacts installed on the node
+	:return: list of (local file or url, sha256)
 	'''
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
-		sys.stdout.write("****************************\n")
-		sys.stdout.write("*** Starting Preperation of the Server\n")
-		sys.stdout.write("****************************\n")
-		conn.sudo('apt-get update')
-		conn.sudo('apt-get -y upgrade')
-		conn.sudo('mv /var/lib/dpkg/lock /var/lib/dpkg/lock_backup')
-		conn.sudo('apt-get install -y wget ca-certificates curl')
-		conn.sudo('rm -vf /var/lib/dpkg/lock_backup')
-		sys.stdout.write("*** Server prepared ***\n\n")
+	return [(config._sections['node_kaa']['kaa_tarfile'], config._sections['node_kaa'].get('kaa_sha256', ''))]
 
 @task
 def installjava(ctx):
@@ -82,7 +147,7 @@ def installjava(ctx):
 	Install OpenJDK 8
 	:return:
 	'''	
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
+	with session(ctx) as conn:
 		sys.stdout.write("****************************\n")
 		sys.stdout.write("*** Installing OpenJDK 8\n")
 		sys.stdout.write("****************************\n")
@@ -94,7 +159,7 @@ def installmariadb(ctx):
 	Install MariaDB 10.3
 	:return:
 	'''	
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
+	with session(ctx) as conn:
 		sys.stdout.write("****************************\n")
 		sys.stdout.write("*** MariaDB 10.3\n")
 		sys.stdout.write("****************************\n")
@@ -116,13 +181,13 @@ def securemariadb(ctx):
 	Secure MariaDB Installation
 	:return:
 	'''	
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
+	with session(ctx) as conn:
 		sys.stdout.write("****************************\n")
 		sys.stdout.write("*** Securing MYSQL installation\n")
 		sys.stdout.write("*** Root password remains UNCHANGED here, you can change it later in server console\n")
 		sys.stdout.write("*** Removing anonymous users, removing test database and reloading privilage tables\n")
 		sys.stdout.write("****************************\n")
-		conn.sudo('sleep 6')
+		waitfor(ctx, conn, 'mariadb')
 		conn.sudo('echo -e "' + config._sections['node_kaa']['sql_password'] + '\n'\
 		 + 'n\ny\nn\ny\ny\n " | mysql_secure_installation')
 		conn.sudo('netstat -ntlp | grep 3306')
@@ -134,7 +199,7 @@ def createkaatables(ctx):
 	Create SQL Tables for Kaa
 	:return:
 	'''	
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
+	with session(ctx) as conn:
 		sys.stdout.write("****************************\n")
 		sys.stdout.write("*** Creation of SQL Tables for Kaa\n")
 		sys.stdout.write("****************************\n")
@@ -150,13 +215,13 @@ def installzookeeper(ctx):
 	Install Apache Zookeeper
 	:return:
 	'''	
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
+	with session(ctx) as conn:
 		sys.stdout.write("****************************\n")
 		sys.stdout.write("*** Installing Zookeeper\n")
 		sys.stdout.write("****************************\n")
 		conn.sudo('apt-get -y install zookeeper')
 		conn.sudo('/usr/share/zookeeper/bin/zkServer.sh start')
-		conn.sudo('sleep 3')
+		waitfor(ctx, conn, 'zookeeper')
 		sys.stdout.write("*** Zookeper installed ***\n\n")
 		conn.run('netstat -ntlp | grep 2181')
 
@@ -166,35 +231,44 @@ def installmongodb(ctx):
 	Install MongoDB
 	:return:
 	'''	
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
+	with session(ctx) as conn:
 		sys.stdout.write("****************************\n")
 		sys.stdout.write("*** Installing MongoDB\n")
 		sys.stdout.write("****************************\n")
 		conn.sudo('apt-get remove mongodb* --purge')
 		conn.sudo('apt-get update')
 		conn.sudo('apt-get install -y mongodb')
-		conn.sudo('sleep 2')
+		waitfor(ctx, conn, 'mongodb-service', serviceprobe('mongodb'))
 		conn.sudo('systemctl status mongodb')
-		conn.sudo('sleep 1')
+		waitfor(ctx, conn, 'mongodb')
 		conn.run('mongo --eval \'db.runCommand({ connectionStatus: 1 })\'')
 		sys.stdout.write("*** MongoDB installed ***\n\n")
 
+@task
+def fetchkaanode(ctx):
+	'''
+	Transfer Kaa deb package to the node
+	:return:
+	'''
+	with session(ctx) as conn:
+		sys.stdout.write("*** Transferring Kaa deb package\n")
+		pushartifact(ctx, conn, *artifacts()[0])
+
 @task
 def installkaanode(ctx):
 	'''
 	Install Kaa Node
 	:return:
 	'''	
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
+	with session(ctx) as conn:
 		sys.stdout.write("****************************\n")
 		sys.stdout.write("*** Installing Kaa Node\n")
 		sys.stdout.write("****************************\n")
-		conn.put(config._sections['node_kaa']['kaa_tarfile'])
-		conn.sudo('tar -xvf kaa-deb-*.tar.gz')
+		tarfile = pushartifact(ctx, conn, *artifacts()[0])
+		conn.sudo('tar -xvf ' + tarfile)
 		conn.sudo('dpkg -i ./deb/kaa-node-*.deb')
 		conn.sudo('rm ./deb/flume*')
 		conn.sudo('rm ./deb/kaa*')
-		conn.sudo('rm ' + config._sections['node_kaa']['kaa_tarfile'])
 		sys.stdout.write("Controlling installation\n")
 		conn.run('cat /etc/kaa-node/conf/admin-dao.properties | grep jdbc_username')
 		conn.run('cat /etc/kaa-node/conf/admin-dao.properties | grep jdbc_password')
@@ -209,31 +283,21 @@ def configurekaanode(ctx):
 	Configure Kaa Node
 	:return:
 	'''	
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
+	with session(ctx) as conn:
 		sys.stdout.write("****************************\n")
 		sys.stdout.write("*** Configuring Kaa Node\n")
 		sys.stdout.write("****************************\n")
 		conn.sudo('sed -i \'s/transport_public_interface=localhost/transport_public_interface='\
-		 + config._sections['node_kaa']['host'] + '/g\' /etc/kaa-node/conf/kaa-node.properties')
-		conn.sudo('iptables -I INPUT -p tcp -m tcp --dport 22 -j ACCEPT')
-		conn.sudo('ufw allow from any to any port 22 proto tcp')
-		conn.sudo('iptables -I INPUT -p tcp -m tcp --dport 8080 -j ACCEPT')
-		conn.sudo('ufw allow from any to any port 8080 proto tcp')
-		conn.sudo('iptables -I INPUT -p tcp -m tcp --dport 9888 -j ACCEPT')
-		conn.sudo('ufw allow from any to any port 9888 proto tcp')
-		conn.sudo('iptables -I INPUT -p tcp -m tcp --dport 9889 -j ACCEPT')
-		conn.sudo('ufw allow from any to any port 9889 proto tcp')
-		conn.sudo('iptables -I INPUT -p tcp -m tcp --dport 9997 -j ACCEPT')
-		conn.sudo('ufw allow from any to any port 9997 proto tcp')
-		conn.sudo('iptables -I INPUT -p tcp -m tcp --dport 9999 -j ACCEPT')
-		conn.sudo('ufw allow from any to any port 9999 proto tcp')
-		sys.stdout.write("persistent installation\n")
-		conn.sudo('echo iptables-persistent iptables-persistent/autosave_v4 boolean true | sudo debconf-set-selections')
-		conn.sudo('echo iptables-persistent iptables-persistent/autosave_v6 boolean true | sudo debconf-set-selections')
-		conn.sudo('apt-get install -y iptables-persistent')
-		sys.stdout.write("starting persistent\n")
-		conn.sudo('service netfilter-persistent start')
-		conn.sudo('netfilter-persistent save')
+		 + ctx.address + '/g\' /etc/kaa-node/conf/kaa-node.properties')
+
+@task
+def setupiptables(ctx):
+	'''
+	Setup IP Tables open ports for outside access
+	:return:
+	'''
+	with session(ctx) as conn:
+		firewall(conn, FIREWALL_PORTS, [port for name, port, series in EXPORTERS] if exporters() else [])
 
 @task
 def initiatekaanode(ctx):
@@ -241,22 +305,214 @@ def initiatekaanode(ctx):
 	Initiate Kaa server from dump file or from stratch
 	:return:
 	'''	
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
+	with session(ctx) as conn:
+		if restorechoice(ctx) == 'y':
+			restoredump(ctx, conn, config._sections['node_kaa']['kaa_dumpfile'],\
+			 config._sections['node_kaa'].get('restore_mode', 'stream'),\
+			 int(config._sections['node_kaa'].get('restore_workers', 4)))
+		startkaanode(ctx)
+
+def restorechoice(ctx):
+	'''
+	Answer to the restore question of initiatekaanode, asked once per run before the step is fingerprinted so a
+	deployment answering differently than the recorded one runs the step again
+	:return: y or n
+	'''
+	choice = ctx.config.get('restore')
+	if choice is None:
 		sys.stdout.write("Would you like to restore kaa server from sql dump file? (y/n): ")
 		choice = input().lower()
-		yes = {'yes','y', 'ye', ''}
-		no = {'no','n'}
-		if choice in yes:
-			conn.put(config._sections['node_kaa']['kaa_dumpfile'])
-			conn.sudo('mysql -uroot -p' + config._sections['node_kaa']['sql_password']\
-			 + ' kaa < ' + config._sections['node_kaa']['kaa_dumpfile'])
-			conn.sudo('rm ' + config._sections['node_kaa']['kaa_dumpfile'])
-			startkaanode(ctx)
-		elif choice in no:
-   			startkaanode(ctx)
+	while choice not in {'yes', 'y', 'ye', '', 'no', 'n'}:
+		sys.stdout.write("Please respond with 'yes' or 'no': ")
+		choice = input().lower()
+	ctx.restore = 'y' if choice in {'yes', 'y', 'ye', ''} else 'n'
+	return ctx.restore
+
+@task
+def restorekaanode(ctx, dumpfile='', mode='', workers=0):
+	'''
+	Restore Kaa database from sql dump file, mode is upload, stream or parallel
+	:return:
+	'''
+	with session(ctx) as conn:
+		restoredump(ctx, conn, dumpfile or config._sections['node_kaa']['kaa_dumpfile'],\
+		 mode or config._sections['node_kaa'].get('restore_mode', 'stream'),\
+		 int(workers) or int(config._sections['node_kaa'].get('restore_workers', 4)))
+
+def restoredump(ctx, conn, dumpfile, mode, workers):
+	'''
+	Restore a plain or gzipped sql dump or a backup directory of backupkaanode into the kaa database.
+	upload: copy the dump to the node and load it from there
+	stream: compress on the fly and pipe it into mysql without a copy on the node
+	parallel: split it per table and stream the tables into mysql by several workers
+	:return:
+	'''
+	mysql = 'mysql -uroot -p' + config._sections['node_kaa']['sql_password']
+	load = "bash -c 'set -o pipefail; gunzip -c | " + mysql + " kaa'"
+	if os.path.isdir(dumpfile) and (mode == 'upload' or ctx.host in batches):
+		raise RuntimeError(dumpfile + ' is a backup directory, it is restored by streaming, not in upload or batch mode')
+	if mode == 'upload' or ctx.host in batches:
+		conn.put(dumpfile)
+		if dumpfile.endswith('.gz'):
+			conn.sudo('bash -c "set -o pipefail; gunzip -c ' + os.path.basename(dumpfile) + ' | ' + mysql + ' kaa"')
 		else:
-   			sys.stdout.write("Please respond with 'yes' or 'no'\n")
-   			initiatekaanode(ctx)
+			conn.sudo(mysql + ' kaa < ' + os.path.basename(dumpfile))
+		conn.sudo('rm ' + os.path.basename(dumpfile))
+		return
+	sys.stdout.write("****************************\n")
+	sys.stdout.write("*** Restoring " + dumpfile + " (" + mode + ")\n")
+	sys.stdout.write("****************************\n")
+	start = time.time()
+	if os.path.isdir(dumpfile):
+		tables = sorted(glob.glob(os.path.join(dumpfile, 'table-*.sql.gz')))
+		size = 0
+		sys.stdout.write("*** Loading " + str(len(tables)) + " tables with " + str(workers) + " workers\n")
+		with ThreadPoolExecutor(max_workers=workers) as pool:
+			sent = sum(pool.map(lambda path: pipeto(conn, load, path, False), tables))
+		for path in sorted(glob.glob(os.path.join(dumpfile, 'post-*.sql.gz'))):
+			sent += pipeto(conn, load, path, False)
+	elif mode == 'parallel':
+		with tempfile.TemporaryDirectory() as directory:
+			tables, others, size = splitdump(dumpfile, directory)
+			sys.stdout.write("*** Loading " + str(len(tables)) + " tables with " + str(workers) + " workers\n")
+			with ThreadPoolExecutor(max_workers=workers) as pool:
+				sent = sum(pool.map(lambda path: pipeto(conn, load, path, True), tables))
+			for path in others:
+				sent += pipeto(conn, load, path, True)
+	else:
+		size = os.path.getsize(dumpfile) if not dumpfile.endswith('.gz') else 0
+		sent = pipeto(conn, load, dumpfile, not dumpfile.endswith('.gz'))
+	elapsed = time.time() - start
+	tracking.transferred = getattr(tracking, 'transferred', 0) + sent
+	rows = conn.run(mysql + ' -N -e "SELECT COALESCE(SUM(TABLE_ROWS), 0) FROM information_schema.tables'\
+	 + ' WHERE table_schema = \'kaa\'"', hide=True).stdout.strip() or '0'
+	sys.stdout.write("*** Restored ~" + rows + " rows in %.1fs: %.0f rows/s, %.2f MB/s sent" \
+	 % (elapsed, int(rows) / elapsed, sent / elapsed / 1048576))
+	if size:
+		sys.stdout.write(", %.2f MB/s of sql" % (size / elapsed / 1048576))
+	sys.stdout.write(" ***\n")
+
+@task
+def backupkaanode(ctx, output='', workers=0, target='', online=False):
+	'''
+	Dump the kaa database table by table with several workers, gzip compressed on the node and streamed into a local
+	backup directory, or with a target host straight into the kaa database of that host. The tables are held with
+	FLUSH TABLES WITH READ LOCK during the dumps so they form one consistent snapshot, with online the writes go on and
+	every table is consistent on its own only.
+	:return:
+	'''
+	if ctx.host in batches:
+		sys.stdout.write("*** backupkaanode streams over its own channels, run it after the batch\n")
+		return
+	settings = config._sections['node_kaa']
+	workers = int(workers) or int(settings.get('restore_workers', 4))
+	mysql = 'mysql -uroot -p' + settings['sql_password']
+	dump = 'mysqldump -uroot -p' + settings['sql_password'] + ' --single-transaction --quick '
+	load = "bash -c 'set -o pipefail; gunzip -c | " + mysql + " kaa'"
+	with session(ctx):
+		conn = sessions[ctx.host]['conn']
+		tables = [line.split('\t') for line in conn.run(mysql + ' -N -e "SHOW FULL TABLES IN kaa"', hide=True).stdout.splitlines()]
+		views = [table[0] for table in tables if table[-1] == 'VIEW']
+		parts = [('table-' + table[0], dump + 'kaa ' + table[0]) for table in tables if table[-1] != 'VIEW']
+		others = [('post-1-routines', dump + '--no-create-info --no-data --no-create-db --skip-triggers --routines --events kaa')]\
+		 + ([('post-2-views', dump + 'kaa ' + ' '.join(views))] if views else [])
+		size = int(conn.run(mysql + ' -N -e "SELECT COALESCE(SUM(DATA_LENGTH + INDEX_LENGTH), 0) FROM information_schema.tables'\
+		 + ' WHERE table_schema = \'kaa\'"', hide=True).stdout.strip() or 0)
+		sys.stdout.write("****************************\n")
+		sys.stdout.write("*** Backing up " + str(len(parts)) + " tables of kaa with " + str(workers) + " workers into "\
+		 + (target or output or 'a local directory') + "\n")
+		sys.stdout.write("****************************\n")
+		if target:
+			targetctx = Context(config=ctx.config.clone())
+			stagehost(targetctx, target)
+			destination = sessions[targetctx.host]['conn']
+			destination.run(mysql + ' -e "CREATE DATABASE IF NOT EXISTS kaa"', hide=True)
+			move = lambda part: relay(conn, "bash -c 'set -o pipefail; " + part[1] + " | gzip -1'", destination, load)
+		else:
+			output = output or 'kaa-backup-' + ctx.address + '-' + time.strftime('%Y%m%d-%H%M%S')
+			os.makedirs(output)
+			move = lambda part: pullfrom(conn, "bash -c 'set -o pipefail; " + part[1] + " | gzip -1'",
+			 os.path.join(output, part[0] + '.sql.gz'))
+		start = time.time()
+		try:
+			with readlock(conn, mysql, online):
+				with ThreadPoolExecutor(max_workers=workers) as pool:
+					transferred = sum(pool.map(move, parts))
+				for part in others:
+					transferred += move(part)
+		finally:
+			if target:
+				closesession(targetctx)
+		elapsed = time.time() - start
+	sys.stdout.write("*** Backed up %d tables, %.1f MB of table data in %.1fs: %.2f MB/s of data, %.2f MB/s compressed into %s ***\n\n"\
+	 % (len(parts), size / 1048576.0, elapsed, size / elapsed / 1048576, transferred / elapsed / 1048576, target or output))
+
+@contextmanager
+def readlock(conn, mysql, online):
+	'''
+	Hold FLUSH TABLES WITH READ LOCK in a mysql session on its own channel until the block is left, writes to the
+	tables wait meanwhile. Nothing is locked for an online backup.
+	:return:
+	'''
+	if online:
+		sys.stdout.write("*** Online backup, the tables are consistent on their own, not with each other\n")
+		yield
+		return
+	channel = conn.client.get_transport().open_session()
+	channel.set_combine_stderr(True)
+	channel.exec_command(mysql + ' -N')
+	channel.sendall(b"FLUSH TABLES WITH READ LOCK; SELECT 'emsdeploy-locked';\n")
+	output = b''
+	while b'emsdeploy-locked' not in output:
+		chunk = channel.recv(4096)
+		if not chunk:
+			channel.close()
+			raise RuntimeError('FLUSH TABLES WITH READ LOCK failed: ' + output.decode('utf-8', 'replace').strip())
+		output += chunk
+	sys.stdout.write("*** Tables locked for a consistent snapshot, writes wait until the dumps finished\n")
+	try:
+		yield
+	finally:
+		channel.sendall(b'UNLOCK TABLES;\n')
+		channel.shutdown_write()
+		channel.recv_exit_status()
+		channel.close()
+
+def splitdump(dumpfile, directory):
+	'''
+	Split a mysqldump file into one file per table, each with the dump header and
+	foreign key and unique checks disabled. Views, routines and events are kept apart
+	to be loaded after the tables.
+	:return: (table files, other files, uncompressed size of the dump in bytes)
+	'''
+	prologue = 'SET FOREIGN_KEY_CHECKS=0;\nSET UNIQUE_CHECKS=0;\nSET autocommit=0;\n'
+	markers = ('-- Table structure for table', '-- Temporary table structure for view',\
+	 '-- Final view structure for view', '-- Dumping routines', '-- Dumping events')
+	header = []
+	tables = []
+	others = []
+	section = None
+	size = 0
+	opener = gzip.open if dumpfile.endswith('.gz') else open
+	with opener(dumpfile, 'rt', encoding='utf-8', errors='surrogateescape', newline='') as dump:
+		for line in dump:
+			size += len(line.encode('utf-8', 'surrogateescape'))
+			if line.startswith(markers):
+				if section:
+					section.write('COMMIT;\n')
+					section.close()
+				path = os.path.join(directory, str(len(tables) + len(others)) + '.sql')
+				(tables if line.startswith(markers[0]) else others).append(path)
+				section = open(path, 'w', encoding='utf-8', errors='surrogateescape', newline='')
+				section.write(''.join(header) + prologue)
+			if section:
+				section.write(line)
+			else:
+				header.append(line)
+	if section:
+		section.write('COMMIT;\n')
+		section.close()
+	return tables, others, size
 
 @task
 def startkaanode(ctx):
@@ -264,23 +520,401 @@ def startkaanode(ctx):
 	Start Kaa server
 	:return:
 	'''	
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
+	with session(ctx) as conn:
 		sys.stdout.write("starting kaa node\n")
 		conn.sudo('service kaa-node start')
+		waitfor(ctx, conn, 'kaa-admin', deadline=300)
 		sys.stdout.write("*** Kaa node configured ***\n")
 		sys.stdout.write("*** Node deployment finished ***\n")
-		sys.stdout.write("Open Administration UI http://" + config._sections['node_kaa']['host']\
+		sys.stdout.write("Open Administration UI http://" + ctx.address\
 		 + ":8080/kaaAdmin\n")
 
+@task
+def tunekaanode(ctx, dryrun=False):
+	'''
+	Split the memory of the host between the heap of the Kaa node and the WiredTiger cache of MongoDB, create the indexes
+	of the Kaa collections and verify the effective settings after the restart
+	:return:
+	'''
+	if ctx.host in batches:
+		sys.stdout.write("*** tunekaanode needs the installed Kaa node and MongoDB, run it after the batch\n")
+		return
+	with session(ctx) as conn:
+		sys.stdout.write("****************************\n")
+		sys.stdout.write("*** Tuning the Kaa node and MongoDB\n")
+		sys.stdout.write("****************************\n")
+		facts = hostfacts(sessions[ctx.host]['conn'])
+		settings = dict(KAA_TUNING)
+		if config.has_section('kaa_tuning'):
+			settings.update(config.items('kaa_tuning'))
+		heap = evaluate('[kaa_tuning] heap_mb', settings['heap_mb'], facts)
+		cache = evaluate('[kaa_tuning] wiredtiger_cache_gb', settings['wiredtiger_cache_gb'], facts)
+		options = '-Xms' + heap + 'm -Xmx' + heap + 'm ' + settings['gc_options']
+		sys.stdout.write("*** cpus=" + str(facts['cpus']) + ", ram_mb=" + str(facts['ram_mb']) + ": Kaa heap " + heap\
+		 + "MB, WiredTiger cache " + cache + "GB\n")
+		current = sessions[ctx.host]['conn'].sudo('cat ' + KAA_DEFAULTS, hide=True, warn=True).stdout
+		defaults = ''.join(line + '\n' for line in current.splitlines() if not line.endswith('# emsdeploy'))\
+		 + 'JAVA_OPTIONS="$JAVA_OPTIONS ' + options + '"  # emsdeploy\n'
+		changed = showdiff(current, defaults, KAA_DEFAULTS)
+		current = sessions[ctx.host]['conn'].sudo('cat ' + MONGODB_CONF, hide=True, warn=True).stdout
+		mongodb = ''.join(line + '\n' for line in current.splitlines() if not line.startswith('wiredTigerCacheSizeGB'))\
+		 + 'wiredTigerCacheSizeGB = ' + cache + '\n'
+		changed = showdiff(current, mongodb, MONGODB_CONF) or changed
+		if dryrun:
+			sys.stdout.write("*** Kaa node and MongoDB settings " + ("not applied (dry run)" if changed else "unchanged") + " ***\n")
+			return
+		if changed:
+			putcontent(conn, defaults, KAA_DEFAULTS)
+			putcontent(conn, mongodb, MONGODB_CONF)
+			conn.sudo('systemctl restart mongodb')
+			waitfor(ctx, conn, 'mongodb')
+		createindexes(conn, settings['mongodb_database'])
+		running = sessions[ctx.host]['conn'].sudo('service kaa-node status', hide=True, warn=True).ok
+		if changed and running:
+			conn.sudo('service kaa-node restart')
+			waitfor(ctx, conn, 'kaa-admin', deadline=300)
+		configured = sessions[ctx.host]['conn'].run('mongo --quiet --eval '\
+		 + shlex.quote('db.serverStatus().wiredTiger.cache["maximum bytes configured"]'), hide=True).stdout.strip()
+		effective = sessions[ctx.host]['conn'].sudo('bash -c ' + shlex.quote('ps -o args= -C java | grep kaa-node '\
+		 + '| grep -o -- "-Xmx[0-9]*[kKmMgG]" | tail -1'), hide=True, warn=True).stdout.strip() if running else ''
+		if ctx.config.get('simulate'):
+			sys.stdout.write("*** Simulated host, the effective settings are not verified ***\n\n")
+			return
+		if abs(float(configured or 0) - float(cache) * 1024 ** 3) > 1024 ** 2:
+			raise RuntimeError('MongoDB runs with a WiredTiger cache of ' + configured + ' bytes instead of ' + cache + 'GB')
+		sys.stdout.write("*** Verified WiredTiger cache of " + cache + "GB\n")
+		if not running:
+			sys.stdout.write("*** Kaa node not running, its heap takes effect on the next start ***\n\n")
+			return
+		if effective != '-Xmx' + heap + 'm':
+			raise RuntimeError('Kaa node runs with ' + (effective or 'no -Xmx') + ' instead of -Xmx' + heap + 'm')
+		sys.stdout.write("*** Verified Kaa node heap of " + heap + "MB\n")
+		sys.stdout.write("*** Kaa node and MongoDB tuned ***\n\n")
+
+def createindexes(conn, database):
+	'''
+	Create the indexes of [kaa_indexes] (or KAA_INDEXES) in the background, a collection ending with * stands for all
+	collections with that prefix and fields joined with + form a compound index
+	:return:
+	'''
+	indexes = config.items('kaa_indexes') if config.has_section('kaa_indexes') else KAA_INDEXES
+	specs = dict((collection, [index.strip() for index in value.split(',') if index.strip()]) for collection, value in indexes)
+	script = 'var specs = ' + json.dumps(specs) + '; '\
+	 + 'Object.keys(specs).forEach(function (pattern) { '\
+	 + 'var names = pattern.slice(-1) == "*" ? db.getCollectionNames().filter(function (name) { '\
+	 + 'return name.indexOf(pattern.slice(0, -1)) == 0; }) : [pattern]; '\
+	 + 'names.forEach(function (name) { specs[pattern].forEach(function (index) { '\
+	 + 'var key = {}; index.split("+").forEach(function (field) { key[field.trim()] = 1; }); '\
+	 + 'var result = db.getCollection(name).createIndex(key, { background: true }); '\
+	 + 'if (!result.ok) { print("*** index " + name + " " + JSON.stringify(key) + " failed: " + result.errmsg); quit(1); } '\
+	 + 'print("*** index " + name + " " + JSON.stringify(key) + (result.numIndexesAfter > result.numIndexesBefore ? '\
+	 + '" created" : " present")); }); }); });'
+	conn.run('mongo --quiet ' + database + ' --eval ' + shlex.quote(script))
+
+@task
+def installexporters(ctx):
+	'''
+	Install the node, MariaDB and MongoDB exporters and the JMX exporter agent of the Kaa node and ZooKeeper, verified by
+	a scrape (Optional)
+	:return:
+	'''
+	if not exporters():
+		sys.stdout.write("*** Exporters not enabled, set exporters = yes to install them\n")
+		return
+	settings = config._sections['node_kaa']
+	password = exporterpassword()
+	ports = dict((name, port) for name, port, series in EXPORTERS)
+	agent = '-javaagent:' + JMX_EXPORTER_DIR + '/jmx_prometheus_javaagent.jar='
+	with session(ctx) as conn:
+		sys.stdout.write("****************************\n")
+		sys.stdout.write("*** Installing the exporters\n")
+		sys.stdout.write("****************************\n")
+		conn.sudo('apt-get install -y prometheus-node-exporter prometheus-mysqld-exporter prometheus-mongodb-exporter')
+		conn.sudo('mysql -uroot -p' + settings['sql_password'] + ' -e ' + shlex.quote("CREATE USER IF NOT EXISTS 'exporter'@'localhost'"\
+		 + " IDENTIFIED BY '" + password + "' WITH MAX_USER_CONNECTIONS 3; ALTER USER 'exporter'@'localhost' IDENTIFIED BY '"\
+		 + password + "';"\
+		 + " GRANT PROCESS, REPLICATION CLIENT, SELECT ON *.* TO 'exporter'@'localhost';"))
+		conn.sudo('bash -c ' + shlex.quote('sed -i "/^DATA_SOURCE_NAME=/d" /etc/default/prometheus-mysqld-exporter; echo \'DATA_SOURCE_NAME="exporter:'\
+		 + password + '@(localhost:3306)/"\' >> /etc/default/prometheus-mysqld-exporter'))
+		conn.sudo('chmod 640 /etc/default/prometheus-mysqld-exporter')
+		putcontent(conn, 'ARGS="-web.listen-address=:' + str(ports['mongodb']) + ' -mongodb.uri=mongodb://localhost:27017"\n',
+		 '/etc/default/prometheus-mongodb-exporter')
+		for service in ('prometheus-node-exporter', 'prometheus-mysqld-exporter', 'prometheus-mongodb-exporter'):
+			conn.sudo('systemctl enable ' + service)
+			conn.sudo('systemctl restart ' + service)
+		jar = pushartifact(ctx, conn, settings.get('jmx_exporter_url', JMX_EXPORTER_URL))
+		conn.sudo('mkdir -p ' + JMX_EXPORTER_DIR)
+		conn.sudo('cp ' + jar + ' ' + JMX_EXPORTER_DIR + '/jmx_prometheus_javaagent.jar')
+		for service in ('zookeeper', 'kaa'):
+			putcontent(conn, JMX_RULES[service], JMX_EXPORTER_DIR + '/' + service + '.yml')
+		putcontent(conn, 'SERVER_JVMFLAGS="' + agent + str(ports['zookeeper']) + ':' + JMX_EXPORTER_DIR + '/zookeeper.yml"\n',
+		 '/etc/zookeeper/conf/java.env')
+		conn.sudo('/usr/share/zookeeper/bin/zkServer.sh restart')
+		waitfor(ctx, conn, 'zookeeper')
+		conn.sudo('bash -c ' + shlex.quote('sed -i "/# emsdeploy exporter$/d" ' + KAA_DEFAULTS + '; echo \'JAVA_OPTIONS="$JAVA_OPTIONS '\
+		 + agent + str(ports['kaa']) + ':' + JMX_EXPORTER_DIR + '/kaa.yml"  # emsdeploy exporter\' >> ' + KAA_DEFAULTS))
+		conn.sudo('service kaa-node restart')
+		waitfor(ctx, conn, 'kaa-admin', deadline=300)
+		sys.stdout.write("*** Exporters installed ***\n")
+	verifyexporters(ctx)
+
+@task
+def kafkaappender(ctx, application='', profile='', partitions=0):
+	'''
+	Register the Kafka log appender of a Kaa application with the brokers of kafka.cfg and a producer profile, create its
+	topic and measure the delivery rate into the topic
+	:return:
+	'''
+	settings = config._sections['kafka_appender'] if config.has_section('kafka_appender') else {}
+	application = application or settings.get('application', '')
+	profile = profile or settings.get('profile', 'throughput')
+	partitions = int(partitions) or int(settings.get('partitions', 6))
+	topic = settings.get('topic', 'kaa-logs')
+	if not config.has_section('appender_profile_' + profile):
+		raise RuntimeError('no [appender_profile_' + profile + '] section in ' + CONFIG_FILE)
+	producer = dict(config.items('appender_profile_' + profile))
+	if producer.get('acks', '1') not in APPENDER_ACKS:
+		raise RuntimeError('acks = ' + producer['acks'] + ' of [appender_profile_' + profile + '] is not one of '\
+		 + ', '.join(sorted(APPENDER_ACKS)))
+	if not application:
+		raise RuntimeError('no Kaa application given, set application in [kafka_appender] or pass --application')
+	if ctx.host in batches:
+		sys.stdout.write("*** kafkaappender needs the answers of the Kaa REST API, run it after the batch\n")
+		return
+	kafka, brokers, zookeeper = kafkanode(settings.get('kafka_config', '../nodekafka/kafka.cfg'))
+	try:
+		with session(ctx):
+			conn = sessions[ctx.host]['conn']
+			sys.stdout.write("****************************\n")
+			sys.stdout.write("*** Wiring " + application + " to Kafka " + ', '.join(brokers) + " with the " + profile + " profile\n")
+			sys.stdout.write("****************************\n")
+			kafka.sudo('su -l kafka -c "' + KAFKA_SCRIPTS + 'kafka-topics.sh --zookeeper ' + zookeeper + ' --create --if-not-exists'\
+			 + ' --topic ' + topic + ' --partitions ' + str(partitions) + ' --replication-factor ' + str(min(3, len(brokers))) + '"')
+			apps = [app for app in kaaapi(conn, settings, 'GET', 'applications') if application in (app['name'], app['applicationToken'])]
+			if not apps:
+				raise RuntimeError('no Kaa application named ' + application)
+			appenders = kaaapi(conn, settings, 'GET', 'logAppenders/' + apps[0]['applicationToken'])
+			appender = dict(([appender for appender in appenders if appender['name'] == 'emsdeploy-kafka'] or [{}])[0])
+			appender.update({
+				'applicationId': apps[0]['id'],
+				'applicationToken': apps[0]['applicationToken'],
+				'name': 'emsdeploy-kafka',
+				'description': 'Kafka log appender of emsdeploy, ' + profile + ' profile',
+				'pluginTypeName': 'Kafka',
+				'pluginClassName': KAFKA_APPENDER_CLASS,
+				'minLogSchemaVersion': appender.get('minLogSchemaVersion', 1),
+				'maxLogSchemaVersion': appender.get('maxLogSchemaVersion', 2147483647),
+				'confirmDelivery': True,
+				'headerStructure': ['KEYHASH', 'TIMESTAMP', 'TOKEN', 'VERSION', 'LSVERSION'],
+				'jsonConfiguration': json.dumps({
+					'kafkaServers': [{'host': broker, 'port': 9092} for broker in brokers],
+					'topic': topic,
+					'useDefaultPartitioner': True,
+					'partitionCount': partitions,
+					'kafkaKeyType': 'NULL',
+					'executorThreadPoolSize': int(producer.get('threads', 1)),
+					'bufferMemorySize': int(producer.get('buffer_memory', 33554432)),
+					'kafkaCompression': producer.get('compression', 'none').upper(),
+					'kafkaAcknowledgement': APPENDER_ACKS[producer.get('acks', '1')],
+					'retries': int(producer.get('retries', 0)),
+				}),
+			})
+			kaaapi(conn, settings, 'POST', 'logAppender', appender)
+			sys.stdout.write("*** Log appender emsdeploy-kafka " + ('updated' if 'id' in appender else 'registered') + "\n")
+			lines = conn.sudo('bash -c "cat ' + KAA_LOG + ' 2> /dev/null | wc -l"', hide=True).stdout.strip()
+			result = deliveryrate(kafka, zookeeper, topic, partitions, min(3, len(brokers)), producer, int(settings.get('records', 100000)),
+			 int(settings.get('record_size', 512)), int(settings.get('window', 30)))
+			errors = int(conn.sudo('bash -c "tail -n +' + str(int(lines or 0) + 1) + ' ' + KAA_LOG\
+			 + ' | grep ERROR | grep -c Kafka || true"', hide=True).stdout.strip() or 0)
+	finally:
+		kafka.close()
+	result.update({'host': ctx.host, 'application': application, 'profile': profile, 'partitions': partitions, 'appender_errors': errors})
+	os.makedirs(REPORT_DIR, exist_ok=True)
+	name = os.path.join(REPORT_DIR, 'kaa-appender-' + ctx.address + '-' + time.strftime('%Y%m%d-%H%M%S') + '.json')
+	with open(name, 'w') as f:
+		json.dump(result, f, indent=2)
+	sys.stdout.write("*** Synthetic broker load: %.0f records/s, %.2f MB/s, p99 %dms, %d of %d records delivered ***\n"\
+	 % (result['records_s'], result['mb_s'], result['p99_ms'], result['delivered'], result['records']))
+	sys.stdout.write("*** Endpoint logs: %.1f records/s over %ds, %d appender errors, report written to %s ***\n\n"\
+	 % (result['endpoint_records_s'], result['window_s'], errors, name))
+	if result['delivered'] < result['records']:
+		raise RuntimeError(str(result['records'] - result['delivered']) + ' synthetic records were not delivered')
+
+def kafkanode(path):
+	'''
+	SSH connection to the first broker of a kafka.cfg, the addresses of all brokers and the zookeeper.connect of the cluster
+	:return: (connection, brokers, zookeeper connect string)
+	'''
+	kafka = configparser.RawConfigParser()
+	if not kafka.read(path):
+		raise RuntimeError('Kafka configuration ' + path + ' not found')
+	node = kafka._sections['node_kafka']
+	brokers = clusterhosts(node)
+	keyfile = os.path.join(os.path.dirname(path), node['keyfile'])
+	return Connection(brokers[0] + ':' + node['port'], node['user'], connect_kwargs={"key_filename": [keyfile]}), brokers,\
+	 zookeeperconnect(node)
+
+def kaaapi(conn, settings, method, path, body=None):
+	'''
+	Call the REST API of the Kaa administration UI on the node with the tenant administrator of [kafka_appender]
+	:return: decoded answer
+	'''
+	command = 'curl -fsS -X ' + method + ' -u ' + shlex.quote(settings.get('admin_user', 'admin') + ':'\
+	 + settings.get('admin_password', '')) + ' -H "Content-Type: application/json" ' + KAA_API + path
+	if body is not None:
+		command += ' -d ' + shlex.quote(json.dumps(body))
+	answer = conn.run(command, hide=True).stdout
+	return json.loads(answer) if answer.strip() else None
+
+def deliveryrate(kafka, zookeeper, topic, partitions, replicas, producer, records, size, window):
+	'''
+	Send a synthetic load with the producer settings of the profile into a scratch copy of the topic and count the records
+	that arrive in its partitions, then count the endpoint logs the appender delivers into the topic during window seconds.
+	The synthetic load is produced on the broker and measures the brokers only, the Kaa node is covered by the endpoint logs.
+	:return: dict of results
+	'''
+	scratch = topic + '-emsdeploy-load'
+	kafka.sudo('su -l kafka -c "' + KAFKA_SCRIPTS + 'kafka-topics.sh --zookeeper ' + zookeeper + ' --create --if-not-exists'\
+	 + ' --topic ' + scratch + ' --partitions ' + str(partitions) + ' --replication-factor ' + str(replicas) + '"', hide=True)
+	try:
+		before = topicoffset(kafka, scratch)
+		produced = kafka.sudo('su -l kafka -c "' + KAFKA_SCRIPTS + 'kafka-producer-perf-test.sh --topic ' + scratch\
+		 + ' --num-records ' + str(records) + ' --record-size ' + str(size) + ' --throughput -1 --producer-props'\
+		 + ' bootstrap.servers=localhost:9092 acks=' + producer.get('acks', '1') + ' batch.size=' + producer.get('batch_size', '16384')\
+		 + ' linger.ms=' + producer.get('linger_ms', '0') + ' compression.type=' + producer.get('compression', 'none')\
+		 + ' buffer.memory=' + producer.get('buffer_memory', '33554432') + ' retries=' + producer.get('retries', '0') + '"',
+		 hide=True).stdout
+		delivered = topicoffset(kafka, scratch) - before
+	finally:
+		kafka.sudo('su -l kafka -c "' + KAFKA_SCRIPTS + 'kafka-topics.sh --zookeeper ' + zookeeper + ' --delete --topic ' + scratch + '"',
+		 hide=True, warn=True)
+	summary = re.search(r'([\d.]+) records/sec \(([\d.]+) MB/sec\).*?(\d+) ms 99th', produced)
+	if not summary:
+		raise RuntimeError('no producer summary in the output: ' + produced.strip()[-200:])
+	start = topicoffset(kafka, topic)
+	time.sleep(window)
+	return {
+		'records': records,
+		'records_s': float(summary.group(1)),
+		'mb_s': float(summary.group(2)),
+		'p99_ms': int(summary.group(3)),
+		'delivered': delivered,
+		'window_s': window,
+		'endpoint_records_s': (topicoffset(kafka, topic) - start) / float(window),
+	}
+
+def topicoffset(kafka, topic):
+	'''
+	Sum of the latest offsets of the partitions of a topic
+	:return:
+	'''
+	offsets = kafka.sudo('su -l kafka -c "' + KAFKA_SCRIPTS + 'kafka-run-class.sh kafka.tools.GetOffsetShell'\
+	 + ' --broker-list localhost:9092 --topic ' + topic + ' --time -1"', hide=True).stdout
+	return sum(int(line.rsplit(':', 1)[1]) for line in offsets.splitlines() if line.startswith(topic + ':'))
+
+@task
+def rollingrestart(ctx, concurrency=0, upgrade=False):
+	'''
+	Restart the Kaa nodes of the inventory a few at a time behind a health gate, with upgrade the Kaa node package of
+	kaa_tarfile is installed during the restart
+	:return:
+	'''
+	runrollout(ctx, concurrency, upgrade, 'Kaa nodes')
+
+def rollhost(ctx, upgrade):
+	'''
+	Restart the Kaa node of one host, wait until the administration UI and the transports answer and check the log for
+	errors during rolling_settle seconds
+	:return:
+	'''
+	settings = config._sections['node_kaa']
+	with session(ctx) as conn:
+		lines = conn.sudo('bash -c "cat ' + KAA_LOG + ' 2> /dev/null | wc -l"', hide=True).stdout.strip()
+		if upgrade:
+			tarfile = pushartifact(ctx, conn, *artifacts()[0])
+			conn.sudo('tar -xf ' + tarfile)
+			conn.sudo('dpkg -i ./deb/kaa-node-*.deb')
+			conn.sudo('rm -rf ./deb')
+		conn.sudo('service kaa-node restart')
+		waitfor(ctx, conn, 'kaa-node', portprobe(8080) + ' && ' + portprobe(9997) + ' && ' + PROBES['kaa-admin'],
+		 deadline=int(settings.get('rolling_deadline', 600)))
+		time.sleep(int(settings.get('rolling_settle', 30)))
+		errors = int(conn.sudo('bash -c "tail -n +' + str(int(lines or 0) + 1) + ' ' + KAA_LOG\
+		 + ' | grep -c ERROR || true"', hide=True).stdout.strip() or 0)
+		if errors > int(settings.get('max_errors', 0)):
+			raise RuntimeError(str(errors) + ' errors in ' + KAA_LOG + ' after the restart, rollout paused')
+
 @task
 def finishdeployment(ctx):
 	'''
 	Final tasks for the deployment
 	:return:
 	'''
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
+	with session(ctx) as conn:
 		conn.sudo('rm /var/lib/apt/lists/lock')
 		conn.sudo('rm /var/cache/apt/archives/lock')
 		conn.sudo('rm /var/lib/dpkg/lock')
 		conn.sudo('dpkg --configure -a')
 
+DEPLOY_STEPS = [
+	servertasks,
+	tunehost,
+	fetchkaanode,
+	installjava,
+	installmariadb,
+	securemariadb,
+	createkaatables,
+	installzookeeper,
+	installmongodb,
+	installkaanode,
+	configurekaanode,
+	setupiptables,
+	initiatekaanode,
+	tunekaanode,
+	installexporters,
+	finishdeployment,
+]
+
+STEP_INPUTS = {
+	'installmariadb': ['sql_password'],
+	'securemariadb': ['sql_password'],
+	'createkaatables': ['kaa_sqlfile', 'sql_password'],
+	'fetchkaanode': ['kaa_tarfile', 'kaa_sha256'],
+	'installkaanode': ['kaa_tarfile', 'kaa_sha256'],
+	'initiatekaanode': ['kaa_dumpfile', 'sql_password', 'restore_mode', restorechoice],
+	'tunekaanode': ['[kaa_tuning]', '[kaa_indexes]'],
+	'installexporters': ['exporters', 'exporter_password', 'jmx_exporter_url'],
+	'setupiptables': ['exporters', 'scrape_source'],
+}
+
+STEP_DEPENDS = {
+	'tunehost': ['servertasks'],
+	'fetchkaanode': ['servertasks'],
+	'installjava': ['servertasks'],
+	'installmariadb': ['servertasks'],
+	'securemariadb': ['installmariadb'],
+	'createkaatables': ['securemariadb'],
+	'installzookeeper': ['servertasks'],
+	'installmongodb': ['servertasks'],
+	'installkaanode': ['installjava', 'createkaatables', 'installzookeeper', 'installmongodb', 'fetchkaanode'],
+	'configurekaanode': ['installkaanode'],
+	'initiatekaanode': ['configurekaanode'],
+	'setupiptables': ['servertasks'],
+	'tunekaanode': ['initiatekaanode'],
+	'installexporters': ['tunekaanode'],
+	'finishdeployment': ['tunehost', 'installexporters', 'setupiptables'],
+}
+
+STEP_LOCKS = {
+	'servertasks': ['dpkg'],
+	'installjava': ['dpkg'],
+	'installmariadb': ['dpkg'],
+	'installzookeeper': ['dpkg'],
+	'installmongodb': ['dpkg'],
+	'installkaanode': ['dpkg'],
+	'setupiptables': ['dpkg'],
+	'installexporters': ['dpkg'],
+	'finishdeployment': ['dpkg'],
+}
+
+emsdeploy.configure(sys.modules[__name__])
@@ -22,56 +22,125 @@
 
 import os
 import configparser
+import csv
+import json
+import re
+import shlex
+import shutil
 import sys
-from fabric import task, Connection
+import time
+from fabric import task
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import emsdeploy
+from emsdeploy import deploy, batch, simulate, staging, servertasks, tunehost, verifyexporters, JMX_EXPORTER_DIR,\
+	JMX_EXPORTER_URL, REPORT_DIR, batches, evaluate, exporters, firewall, hostfacts, inventory, kafkacluster,\
+	pushartifact, putcontent, runfleet, runrollout, serviceprobe, session, sessions, showdiff, waitfor, zookeeperconnect
+
+NAME = "kafka"
+SECTION = "node_kafka"
 CONFIG_FILE = "kafka.cfg"
+KAFKA_URL = "http://www-eu.apache.org/dist/kafka/2.1.1/kafka_2.12-2.1.1.tgz"
+KAFKA_PROPERTIES = "/home/kafka/kafka/config/server.properties"
+KAFKA_HEAP_OVERRIDE = "/etc/systemd/system/kafka.service.d/heap.conf"
+ZOOKEEPER_PROPERTIES = "/home/kafka/kafka/config/zookeeper.properties"
+ZOOKEEPER_DATA = "/home/kafka/zookeeper"
+BENCHMARK_BASELINE = "kafka-benchmark-baseline.json"
 config = configparser.RawConfigParser()
 config.read(CONFIG_FILE)
 
+TUNING_SYSCTL = [
+	('vm.swappiness', '1'),
+	('vm.dirty_background_ratio', '5'),
+	('vm.dirty_ratio', '60'),
+	('vm.max_map_count', '262144'),
+	('net.core.somaxconn', '4096'),
+	('net.core.netdev_max_backlog', '5000'),
+	('net.core.rmem_max', '16777216'),
+	('net.core.wmem_max', '16777216'),
+	('net.ipv4.tcp_rmem', '4096 87380 16777216'),
+	('net.ipv4.tcp_wmem', '4096 65536 16777216'),
+]
+TUNING_HUGEPAGES = "never"
+TUNING_READAHEAD_KB = "512"
+TUNING_DATA_DIRS = ['/opt/kafka', ZOOKEEPER_DATA, '/var/lib/zookeeper']
+TUNING_LIMIT_UNITS = ['kafka', 'zookeeper']
+TUNING_LIMITS = [('LimitNOFILE', '100000'), ('LimitNPROC', '65536')]
+FIREWALL_PORTS = [22, 9092, 2181, 2888, 3888]
+
+EXPORTERS = [
+	('node', 9100, [r'node_cpu(_seconds_total)?\{', r'node_disk_io_time(_ms|_seconds_total)?\{', r'node_network_receive_bytes(_total)?\{']),
+	('kafka', 7071, [r'kafka_server_brokertopicmetrics_messagesin_total ', r'kafka_server_brokertopicmetrics_bytesin_total ',
+	 r'kafka_network_requestmetrics_totaltimems\{.*request="Produce"', r'kafka_server_replicamanager_underreplicatedpartitions ']),
+	('zookeeper', 7072, [r'zookeeper_avgrequestlatency', r'zookeeper_packetsreceived', r'zookeeper_outstandingrequests']),
+]
+JMX_RULES = {
+	'kafka': r'''lowercaseOutputName: true
+rules:
+- pattern: 'kafka.server<type=(.+), name=(.+)PerSec\w*, topic=(.+)><>Count'
+  name: kafka_server_$1_$2_total
+  labels:
+    topic: '$3'
+  type: COUNTER
+- pattern: 'kafka.server<type=(.+), name=(.+)PerSec\w*><>Count'
+  name: kafka_server_$1_$2_total
+  type: COUNTER
+- pattern: 'kafka.server<type=(.+), name=(.+)><>Value'
+  name: kafka_server_$1_$2
+  type: GAUGE
+- pattern: 'kafka.network<type=(.+), name=(.+), request=(\w+)><>(\d+)thPercentile'
+  name: kafka_network_$1_$2
+  labels:
+    request: '$3'
+    quantile: '0.$4'
+  type: GAUGE
+- pattern: 'kafka.network<type=(.+), name=(.+), request=(\w+)><>Count'
+  name: kafka_network_$1_$2_count
+  labels:
+    request: '$3'
+  type: COUNTER
+''',
+	'zookeeper': r'''lowercaseOutputName: true
+rules:
+- pattern: 'org.apache.ZooKeeperService<name0=ReplicatedServer_id(\d+), name1=replica.(\d+), name2=(\w+)><>(\w+)'
+  name: zookeeper_$4
+  labels:
+    replica: '$2'
+    role: '$3'
+- pattern: 'org.apache.ZooKeeperService<name0=StandaloneServer_port(\d+)><>(\w+)'
+  name: zookeeper_$2
+''',
+}
+
+PROBES = {
+	'zookeeper': 'exec 3<>/dev/tcp/127.0.0.1/2181 && echo ruok >&3 && timeout 2 cat <&3 | grep -q imok',
+	'kafka': '/home/kafka/kafka/bin/kafka-broker-api-versions.sh --bootstrap-server localhost:9092 > /dev/null 2>&1',
+}
+
 @task
-def deploy(ctx):
-	'''
-	Execute full tasks at once
-	:return:
-	'''
-	staging(ctx)
-	servertasks(ctx)
-	installjava(ctx)
-	installkafka(ctx)
-	installzookeeper(ctx)
-	startkafka(ctx)
-	installkafkat(ctx)
-	setupiptables(ctx)
-	finishdeployment(ctx)
-	
-@task
-def staging(ctx):
+def fleet(ctx, workers=0, force=False, batch=False, parallel=False):
 	'''
-	Setting up host credentials
+	Execute full tasks on every host of the inventory in parallel
 	:return:
 	'''
-	ctx.name = 'staging'
-	ctx.user = config._sections['node_kafka']['user']
-	ctx.connect_kwargs = {"key_filename":[config._sections['node_kafka']['keyfile']]}
-	ctx.host = config._sections['node_kafka']['host'] + ':' + config._sections['node_kafka']['port']
+	ctx.force = force
+	ctx.batch = batch
+	ctx.parallel = parallel
+	hosts = inventory()
+	workers = int(workers) or int(config._sections['node_kafka'].get('workers', len(hosts)))
+	if 'kafka_password' not in config._sections['node_kafka']:
+		sys.stdout.write("*** Set kafka_password in " + CONFIG_FILE + ", passwd can not prompt for parallel hosts\n")
+		sys.exit(1)
+	if 1 < workers < len(hosts):
+		sys.stdout.write("*** Brokers of a cluster wait for the ZooKeeper quorum, use at least " + str(len(hosts)) + " workers\n")
+	runfleet(ctx, hosts, workers)
 
-@task
-def servertasks(ctx):
+def artifacts():
 	'''
-	Prepare the node, install updates
-	:return:
+	Artifacts installed on the node
+	:return: list of (local file or url, sha256)
 	'''
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
-		sys.stdout.write("****************************\n")
-		sys.stdout.write("*** Starting Preperation of the Server\n")
-		sys.stdout.write("****************************\n")
-		conn.sudo('apt-get update')
-		conn.sudo('apt-get -y upgrade')
-		conn.sudo('mv /var/lib/dpkg/lock /var/lib/dpkg/lock_backup')
-		conn.sudo('apt-get install -y wget ca-certificates curl')
-		conn.sudo('rm -vf /var/lib/dpkg/lock_backup')
-		sys.stdout.write("*** Server prepared ***\n\n")
+	return [(config._sections['node_kafka'].get('kafka_url', KAFKA_URL), config._sections['node_kafka'].get('kafka_sha256', ''))]
 
 @task
 def installjava(ctx):
@@ -79,7 +148,7 @@ def installjava(ctx):
 	Install OpenJDK 8
 	:return:
 	'''	
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
+	with session(ctx) as conn:
 		sys.stdout.write("****************************\n")
 		sys.stdout.write("*** Installing OpenJDK 8\n")
 		sys.stdout.write("****************************\n")
@@ -91,21 +160,23 @@ def installkafka(ctx):
 	Install Kafka 2.12-2.1.1
 	:return:
 	'''	
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
+	with session(ctx) as conn:
 		sys.stdout.write("****************************\n")
 		sys.stdout.write("*** Installing Kafka 2.12-2.1.1\n")
 		sys.stdout.write("****************************\n")
 		sys.stdout.write("*** Creating a new user as kafka\n")
-		sys.stdout.write("*** Specify the password: \n")
-		conn.sudo('useradd kafka -m')
-		conn.sudo('passwd kafka')
+		conn.sudo('bash -c "id -u kafka > /dev/null 2>&1 || useradd kafka -m"')
+		if 'kafka_password' in config._sections['node_kafka']:
+			conn.sudo('bash -c "echo kafka:' + config._sections['node_kafka']['kafka_password'] + ' | chpasswd"')
+		else:
+			sys.stdout.write("*** Specify the password: \n")
+			conn.sudo('passwd kafka')
 		conn.sudo('adduser kafka sudo')
-		conn.sudo('su -l kafka -c "mkdir ~/Downloads"')
-		conn.sudo('su -l kafka -c "curl \"http://www-eu.apache.org/dist/kafka/2.1.1/kafka_2.12-2.1.1.tgz\"\
-		 -o ~/Downloads/kafka.tgz"')
-		conn.sudo('su -l kafka -c "mkdir ~/kafka"')
-		conn.sudo('su -l kafka -c "tar -xvzf ~/Downloads/kafka.tgz -C ~/kafka --strip 1"')
-		conn.sudo('su -l kafka -c "sed -i  \'$ a delete.topic.enable = true\' ~/kafka/config/server.properties"')
+		tarfile = pushartifact(ctx, conn, *artifacts()[0])
+		conn.sudo('su -l kafka -c "mkdir -p ~/kafka"')
+		conn.sudo('su -l kafka -c "tar -xvzf ' + tarfile + ' -C ~/kafka --strip 1"')
+		conn.sudo('su -l kafka -c "grep -q ^delete.topic.enable ~/kafka/config/server.properties\
+		 || sed -i  \'$ a delete.topic.enable = true\' ~/kafka/config/server.properties"')
 		conn.put(config._sections['node_kafka']['kafka_servicefile'])
 		conn.sudo('cp ' + config._sections['node_kafka']['kafka_servicefile'] + ' /etc/systemd/system/kafka.service')
 
@@ -115,7 +186,7 @@ def installzookeeper(ctx):
 	Install Apache Zookeeper
 	:return:
 	'''	
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
+	with session(ctx) as conn:
 		sys.stdout.write("****************************\n")
 		sys.stdout.write("*** Installing Zookeeper\n")
 		sys.stdout.write("****************************\n")
@@ -123,7 +194,7 @@ def installzookeeper(ctx):
 		conn.put(config._sections['node_kafka']['zookeeper_servicefile'])
 		conn.sudo('cp ' + config._sections['node_kafka']['zookeeper_servicefile'] + ' /etc/systemd/system/zookeeper.service')
 		conn.sudo('/usr/share/zookeeper/bin/zkServer.sh start')
-		conn.sudo('sleep 3')
+		waitfor(ctx, conn, 'zookeeper')
 		sys.stdout.write("*** Zookeper installed ***\n\n")
 		conn.run('netstat -ntlp | grep 2181')
 		conn.sudo('rm ' + config._sections['node_kafka']['kafka_servicefile'])
@@ -135,20 +206,351 @@ def startkafka(ctx):
 	Start Kafka node
 	:return:
 	'''	
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
+	with session(ctx) as conn:
 		sys.stdout.write("starting kafka node\n")
 		conn.sudo('systemctl start kafka')
-		conn.sudo('sleep 10')
+		waitfor(ctx, conn, 'kafka')
 		conn.sudo('journalctl -u kafka')
 		conn.sudo('systemctl enable kafka')
 
+@task
+def rollingrestart(ctx, concurrency=0, upgrade=False):
+	'''
+	Restart the brokers of the inventory a few at a time behind a health gate, with upgrade the Kafka of kafka_url is
+	installed during the restart
+	:return:
+	'''
+	runrollout(ctx, concurrency, upgrade, 'brokers')
+
+def rollhost(ctx, upgrade):
+	'''
+	Restart the broker of one host with a controlled shutdown once the cluster is healthy, and wait until it is healthy again
+	:return:
+	'''
+	with session(ctx) as conn:
+		rollgate(ctx, conn, 'cluster healthy')
+		if upgrade:
+			tarfile = pushartifact(ctx, conn, *artifacts()[0])
+			conn.sudo('su -l kafka -c "rm -rf ~/kafka.upgrade && mkdir ~/kafka.upgrade && tar -xzf ' + tarfile\
+			 + ' -C ~/kafka.upgrade --strip 1"')
+		sys.stdout.write("*** " + ctx.address + ": stopping the broker, leadership moves with the controlled shutdown\n")
+		conn.sudo('systemctl stop kafka')
+		if upgrade:
+			conn.sudo('su -l kafka -c "rm -rf ~/kafka/bin ~/kafka/libs && mv ~/kafka.upgrade/bin ~/kafka.upgrade/libs ~/kafka/'\
+			 + ' && rm -rf ~/kafka.upgrade"')
+		conn.sudo('systemctl start kafka')
+		waitfor(ctx, conn, 'kafka')
+		rollgate(ctx, conn, 'replicas in sync')
+
+def rollgate(ctx, conn, name):
+	'''
+	Health gate of the rollout, it pauses while partitions are under-replicated or offline or the consumer lag is above
+	max_consumer_lag, and fails when the cluster does not recover within rolling_deadline seconds
+	:return:
+	'''
+	settings = config._sections['node_kafka']
+	topics = '/home/kafka/kafka/bin/kafka-topics.sh --zookeeper ' + zookeeperconnect(config._sections['node_kafka']) + ' --describe'
+	check = 'out=$(' + topics + ' --under-replicated-partitions) || exit 1; [ -z "$out" ] || exit 1; '\
+	 + 'out=$(' + topics + ' --unavailable-partitions) || exit 1; [ -z "$out" ]'
+	if 'max_consumer_lag' in settings:
+		groups = '/home/kafka/kafka/bin/kafka-consumer-groups.sh --bootstrap-server localhost:9092'
+		check += ' || exit 1; list=$(' + groups + ' --list) || exit 1; lag=0; for group in $list; do '\
+		 + 'out=$(' + groups + ' --describe --group $group) || exit 1; '\
+		 + 'lag=$((lag + $(printf "%s\\n" "$out" | awk \'{ for (i = 1; i <= NF; i++) if ($i == "LAG") column = i }'\
+		 + ' column && $column ~ /^[0-9]+$/ { lag += $column } END { print lag + 0 }\'))); done; '\
+		 + '[ "$lag" -le ' + str(int(settings['max_consumer_lag'])) + ' ]'
+	waitfor(ctx, conn, name, check, deadline=int(settings.get('rolling_deadline', 600)))
+
+@task
+def configurecluster(ctx):
+	'''
+	Configure the broker and the ZooKeeper ensemble member of a multi-host cluster, a single broker only moves ZooKeeper
+	from the installation instance to the zookeeper unit
+	:return:
+	'''
+	hosts = inventory()
+	if len(hosts) < 2:
+		sys.stdout.write("*** Single broker, no cluster configuration needed\n")
+		with session(ctx) as conn:
+			zookeeperunit(ctx, conn)
+		return
+	brokers, ensemble = kafkacluster(config._sections['node_kafka'])
+	if ctx.address not in brokers:
+		raise RuntimeError(ctx.address + ' is not one of the hosts of ' + CONFIG_FILE + ', add it as host:id to make it a broker')
+	with session(ctx) as conn:
+		myid = str(brokers[ctx.address])
+		replicas = clusterreplicas(hosts)
+		sys.stdout.write("****************************\n")
+		sys.stdout.write("*** Configuring broker " + myid + " of a " + str(len(hosts)) + " node cluster, ZooKeeper on "\
+		 + ', '.join(ensemble) + "\n")
+		sys.stdout.write("****************************\n")
+		setproperties(conn, KAFKA_PROPERTIES, [
+			('broker.id', myid),
+			('advertised.listeners', 'PLAINTEXT://' + ctx.address + ':9092'),
+			('zookeeper.connect', zookeeperconnect(config._sections['node_kafka'])),
+			('zookeeper.connection.timeout.ms', '60000'),
+			('default.replication.factor', replicas[0]),
+			('min.insync.replicas', replicas[1]),
+			('offsets.topic.replication.factor', replicas[0]),
+			('transaction.state.log.replication.factor', replicas[0]),
+			('transaction.state.log.min.isr', replicas[1]),
+		])
+		if ctx.address not in ensemble:
+			sys.stdout.write("*** Not a ZooKeeper member, the broker uses the ensemble\n")
+			conn.sudo('/usr/share/zookeeper/bin/zkServer.sh stop', warn=True)
+			conn.sudo('sed -i \'/zookeeper.service/d\' /etc/systemd/system/kafka.service')
+			conn.sudo('systemctl daemon-reload')
+			conn.sudo('systemctl disable zookeeper', warn=True)
+			conn.sudo('systemctl stop zookeeper', warn=True)
+			return
+		settings = ['tickTime=2000', 'initLimit=10', 'syncLimit=5', 'dataDir=' + ZOOKEEPER_DATA, 'clientPort=2181', 'maxClientCnxns=0']
+		settings += ['server.' + str(brokers[host]) + '=' + host + ':2888:3888' for host in ensemble]
+		putcontent(conn, '\n'.join(settings) + '\n', ZOOKEEPER_PROPERTIES)
+		conn.sudo('mkdir -p ' + ZOOKEEPER_DATA)
+		conn.sudo('bash -c "echo ' + myid + ' > ' + ZOOKEEPER_DATA + '/myid"')
+		conn.sudo('chown -R kafka:kafka ' + ZOOKEEPER_DATA + ' ' + ZOOKEEPER_PROPERTIES)
+		sys.stdout.write("*** Switching to the ZooKeeper ensemble\n")
+		zookeeperunit(ctx, conn)
+
+def zookeeperunit(ctx, conn):
+	'''
+	Serve ZooKeeper from the zookeeper systemd unit, the instance started by zkServer.sh at the installation holds the
+	client port and is stopped first, the probe only passes once the unit itself is active
+	:return:
+	'''
+	conn.sudo('/usr/share/zookeeper/bin/zkServer.sh stop', warn=True)
+	conn.sudo('systemctl daemon-reload')
+	conn.sudo('systemctl restart zookeeper')
+	conn.sudo('systemctl enable zookeeper')
+	waitfor(ctx, conn, 'zookeeper', serviceprobe('zookeeper') + ' && ' + PROBES['zookeeper'])
+
+@task
+def rebalancekafka(ctx):
+	'''
+	Spread the partitions over every broker of the cluster with KafkaT, after brokers are added
+	:return:
+	'''
+	hosts = inventory()
+	with session(ctx) as conn:
+		sys.stdout.write("****************************\n")
+		sys.stdout.write("*** Rebalancing partitions over " + str(len(hosts)) + " brokers\n")
+		sys.stdout.write("****************************\n")
+		brokers = ','.join(str(broker) for broker in sorted(kafkacluster(config._sections['node_kafka'])[0].values()))
+		conn.sudo('su -l kafka -c "yes | kafkat reassign --brokers ' + brokers + ' --replicas ' + clusterreplicas(hosts)[0] + '"')
+		waitfor(ctx, conn, 'replicas in sync', '[ -z "$(/home/kafka/kafka/bin/kafka-topics.sh --zookeeper '\
+		 + zookeeperconnect(config._sections['node_kafka']) + ' --describe --under-replicated-partitions)" ]', deadline=3600)
+		conn.sudo('su -l kafka -c "kafkat partitions"')
+
+def clusterreplicas(hosts):
+	'''
+	Replication factor and minimum in sync replicas of the cluster, configurable in kafka.cfg
+	:return: (replication factor, min in sync replicas) as strings
+	'''
+	factor = int(config._sections['node_kafka'].get('replication_factor', min(3, len(hosts))))
+	insync = int(config._sections['node_kafka'].get('min_insync_replicas', max(1, factor - 1)))
+	return str(factor), str(insync)
+
+def setproperties(conn, path, settings):
+	'''
+	Set keys of a remote properties file in one command, existing lines of the keys are replaced
+	:return:
+	'''
+	deletes = ' '.join("-e '/^" + key.replace('.', '\\.') + "=/d'" for key, value in settings)
+	lines = ' '.join("'" + key + '=' + value + "'" for key, value in settings)
+	conn.sudo('bash -c ' + shlex.quote('sed -i ' + deletes + ' ' + path + " && printf '%s\\n' " + lines + ' >> ' + path))
+
+@task
+def tunekafka(ctx, profile='', dryrun=False):
+	'''
+	Render server.properties and the heap of the Kafka service from a profile of kafka.cfg sized to the host
+	:return:
+	'''
+	profile = profile or config._sections['node_kafka'].get('kafka_profile', '')
+	if not profile:
+		sys.stdout.write("*** No kafka_profile configured, keeping stock Kafka settings\n")
+		return
+	if ctx.host in batches:
+		sys.stdout.write("*** tunekafka needs the installed server.properties, run it after the batch\n")
+		return
+	with session(ctx) as conn:
+		sys.stdout.write("****************************\n")
+		sys.stdout.write("*** Tuning Kafka with the " + profile + " profile\n")
+		sys.stdout.write("****************************\n")
+		facts = hostfacts(sessions[ctx.host]['conn'])
+		sys.stdout.write("*** " + ', '.join(key + '=' + str(facts[key]) for key in sorted(facts)) + "\n")
+		settings = dict((key, evaluate('[kafka_profile_' + profile + '] ' + key, value, facts))
+		 for key, value in config.items('kafka_profile_' + profile))
+		heap = settings.pop('heap_mb', '')
+		current = sessions[ctx.host]['conn'].sudo('cat ' + KAFKA_PROPERTIES, hide=True).stdout
+		rendered = renderproperties(current, settings, profile)
+		changed = showdiff(current, rendered, KAFKA_PROPERTIES)
+		override = ''
+		if heap:
+			current = sessions[ctx.host]['conn'].sudo('cat ' + KAFKA_HEAP_OVERRIDE, hide=True, warn=True).stdout
+			override = '[Service]\nEnvironment="KAFKA_HEAP_OPTS=-Xmx' + heap + 'm -Xms' + heap + 'm"\n'
+			changed = showdiff(current, override, KAFKA_HEAP_OVERRIDE) or changed
+		if dryrun or not changed:
+			sys.stdout.write("*** Kafka settings " + ("not applied (dry run)" if changed else "unchanged") + " ***\n")
+			return
+		putcontent(conn, rendered, KAFKA_PROPERTIES)
+		conn.sudo('chown kafka:kafka ' + KAFKA_PROPERTIES)
+		if override:
+			conn.sudo('mkdir -p ' + os.path.dirname(KAFKA_HEAP_OVERRIDE))
+			putcontent(conn, override, KAFKA_HEAP_OVERRIDE)
+		conn.sudo('systemctl daemon-reload')
+		if sessions[ctx.host]['conn'].sudo('systemctl is-active --quiet kafka', warn=True).ok:
+			conn.sudo('systemctl restart kafka')
+			waitfor(ctx, conn, 'kafka')
+		sys.stdout.write("*** Kafka tuned ***\n\n")
+
+def profilesettings(ctx=None):
+	'''
+	Settings of the [kafka_profile_<name>] section selected by kafka_profile, an input of tunekafka
+	:return: list of (key, value)
+	'''
+	section = 'kafka_profile_' + config._sections['node_kafka'].get('kafka_profile', '')
+	return sorted(config.items(section)) if config.has_section(section) else []
+
+def renderproperties(current, settings, profile):
+	'''
+	Replace the profile settings in a properties file, settings not in the file are appended
+	:return: rendered file
+	'''
+	lines = []
+	pending = dict(settings)
+	for line in current.splitlines():
+		key = line.split('=', 1)[0].strip()
+		if not line.lstrip().startswith('#') and '=' in line and key in settings:
+			if key in pending:
+				lines.append(key + '=' + pending.pop(key))
+			continue
+		lines.append(line)
+	if pending:
+		lines.append('')
+		lines.append('# ' + profile + ' profile')
+		lines.extend(key + '=' + pending[key] for key in sorted(pending))
+	return '\n'.join(lines) + '\n'
+
+@task
+def benchmark(ctx, records=0, baseline=False):
+	'''
+	Measure producer and consumer throughput and latency over the [kafka_benchmark] matrix, compared with the baseline
+	:return:
+	'''
+	settings = dict(config.items('kafka_benchmark')) if config.has_section('kafka_benchmark') else {}
+	records = int(records or settings.get('records', 1000000))
+	matrix = [(int(size), int(batchsize), acks, codec)
+	 for size in settings.get('record_sizes', '100, 1024').split(',')
+	 for batchsize in settings.get('batch_sizes', '16384, 262144').split(',')
+	 for acks in [value.strip() for value in settings.get('acks', '1, all').split(',')]
+	 for codec in [value.strip() for value in settings.get('compression', 'none, lz4').split(',')]]
+	hosts = inventory()
+	scripts = '/home/kafka/kafka/bin/'
+	with session(ctx):
+		conn = sessions[ctx.host]['conn']
+		sys.stdout.write("****************************\n")
+		sys.stdout.write("*** Benchmarking Kafka, " + str(len(matrix)) + " cases of " + str(records) + " records\n")
+		sys.stdout.write("****************************\n")
+		results = []
+		for index, (size, batchsize, acks, codec) in enumerate(matrix):
+			topic = 'emsdeploy-benchmark-' + str(index)
+			conn.sudo('su -l kafka -c "' + scripts + 'kafka-topics.sh --zookeeper ' + zookeeperconnect(config._sections['node_kafka']) + ' --create --if-not-exists'\
+			 + ' --topic ' + topic + ' --partitions ' + settings.get('partitions', '6')\
+			 + ' --replication-factor ' + clusterreplicas(hosts)[0] + '"', hide=True)
+			try:
+				produced = conn.sudo('su -l kafka -c "' + scripts + 'kafka-producer-perf-test.sh --topic ' + topic\
+				 + ' --num-records ' + str(records) + ' --record-size ' + str(size) + ' --throughput -1'\
+				 + ' --producer-props bootstrap.servers=localhost:9092 acks=' + acks + ' batch.size=' + str(batchsize)\
+				 + ' linger.ms=5 compression.type=' + codec + '"', hide=True).stdout
+				consumed = conn.sudo('su -l kafka -c "' + scripts + 'kafka-consumer-perf-test.sh --broker-list localhost:9092'\
+				 + ' --topic ' + topic + ' --messages ' + str(records) + ' --timeout 60000"', hide=True).stdout
+			finally:
+				conn.sudo('su -l kafka -c "' + scripts + 'kafka-topics.sh --zookeeper ' + zookeeperconnect(config._sections['node_kafka'])\
+				 + ' --delete --topic ' + topic + '"', hide=True, warn=True)
+			result = dict([('host', ctx.host), ('case', '%d/%d/%s/%s' % (size, batchsize, acks, codec))]\
+			 + perfresults(produced, consumed))
+			results.append(result)
+			sys.stdout.write("*** %s: %.0f records/s, %.2f MB/s, p99 %dms ***\n"\
+			 % (result['case'], result['records_s'], result['mb_s'], result['p99_ms']))
+	benchmarkreport(results, baseline, float(settings.get('tolerance', 10)))
+
+def perfresults(produced, consumed):
+	'''
+	Figures of the final lines of kafka-producer-perf-test.sh and kafka-consumer-perf-test.sh
+	:return: list of (name, value)
+	'''
+	summary = re.search(r'([\d.]+) records/sec \(([\d.]+) MB/sec\), ([\d.]+) ms avg latency, ([\d.]+) ms max latency, '\
+	 + r'(\d+) ms 50th, (\d+) ms 95th, (\d+) ms 99th, (\d+) ms 99.9th', produced)
+	if not summary:
+		raise RuntimeError('no producer summary in the output: ' + produced.strip()[-200:])
+	consumer = consumed.strip().splitlines()[-1].split(',')
+	return [
+		('records_s', float(summary.group(1))),
+		('mb_s', float(summary.group(2))),
+		('avg_ms', float(summary.group(3))),
+		('p50_ms', int(summary.group(5))),
+		('p99_ms', int(summary.group(7))),
+		('p999_ms', int(summary.group(8))),
+		('consumer_records_s', float(consumer[5])),
+		('consumer_mb_s', float(consumer[3])),
+	]
+
+def benchmarkreport(results, baseline, tolerance):
+	'''
+	Write the benchmark results into the reports folder and flag cases slower than the baseline by more than tolerance percent,
+	with baseline the results become the new baseline
+	:return:
+	'''
+	os.makedirs(REPORT_DIR, exist_ok=True)
+	name = os.path.join(REPORT_DIR, 'kafka-benchmark-' + time.strftime('%Y%m%d-%H%M%S'))
+	reference = {}
+	if os.path.isfile(os.path.join(REPORT_DIR, BENCHMARK_BASELINE)) and not baseline:
+		with open(os.path.join(REPORT_DIR, BENCHMARK_BASELINE)) as f:
+			reference = dict((result['case'], result) for result in json.load(f))
+	for result in results:
+		before = reference.get(result['case'])
+		regressions = []
+		if before:
+			for key in ('records_s', 'mb_s', 'consumer_records_s', 'consumer_mb_s'):
+				if result[key] < before[key] * (1 - tolerance / 100):
+					regressions.append(key)
+			for key in ('p99_ms', 'p999_ms'):
+				if result[key] > max(before[key], 1) * (1 + tolerance / 100):
+					regressions.append(key)
+		result['regression'] = ' '.join(regressions)
+	with open(name + '.json', 'w') as f:
+		json.dump(results, f, indent=2)
+	with open(name + '.csv', 'w', newline='') as f:
+		writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+		writer.writeheader()
+		writer.writerows(results)
+	if baseline:
+		shutil.copyfile(name + '.json', os.path.join(REPORT_DIR, BENCHMARK_BASELINE))
+	sys.stdout.write("\n****************************\n")
+	sys.stdout.write("*** Benchmark report\n")
+	sys.stdout.write("****************************\n")
+	sys.stdout.write("%-24s %-22s %12s %9s %7s %7s %8s %12s  %s\n"\
+	 % ('host', 'size/batch/acks/codec', 'records/s', 'MB/s', 'p50', 'p99', 'p99.9', 'consumer/s', 'regression'))
+	for result in results:
+		sys.stdout.write("%-24s %-22s %12.0f %9.2f %7d %7d %8d %12.0f  %s\n"\
+		 % (result['host'], result['case'], result['records_s'], result['mb_s'], result['p50_ms'], result['p99_ms'],
+		 result['p999_ms'], result['consumer_records_s'], result['regression']))
+	sys.stdout.write("*** Report written to " + name + ".json and " + name + ".csv ***\n")
+	if baseline:
+		sys.stdout.write("*** Stored as the baseline ***\n")
+	elif not reference:
+		sys.stdout.write("*** No baseline to compare with, store one with --baseline ***\n")
+	elif any(result['regression'] for result in results):
+		sys.stdout.write("*** Regressions of more than " + str(tolerance) + "% against the baseline ***\n")
+		sys.exit(1)
+
 @task
 def installkafkat(ctx):
 	'''
 	Install KafkaT (Optional)
 	:return:
 	'''	
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
+	with session(ctx) as conn:
 		sys.stdout.write("****************************\n")
 		sys.stdout.write("*** Installing KafkaT\n")
 		sys.stdout.write("****************************\n")
@@ -156,44 +558,140 @@ def installkafkat(ctx):
 		conn.sudo('gem install kafkat')
 		conn.put(config._sections['node_kafka']['kafkat_cfgfile'])
 		conn.sudo('cp ' + config._sections['node_kafka']['kafkat_cfgfile'] + ' /home/kafka/.kafkatcfg')
+		conn.sudo('sed -i \'s/"zk_path": ".*"/"zk_path": "' + zookeeperconnect(config._sections['node_kafka']) + '"/\' /home/kafka/.kafkatcfg')
 		conn.sudo('rm ' + config._sections['node_kafka']['kafkat_cfgfile'])
 		conn.sudo('su -l kafka -c "kafkat partitions"')
 		conn.sudo('deluser kafka sudo')
 		conn.sudo('passwd kafka -l')
-		conn.sudo('systemctl stop kafka')
-		conn.sudo('cp -R /tmp/kafka-logs ~/kafla-log-backup')
-		conn.sudo('mkdir -p /opt/kafka')
-		conn.sudo('cp -R /tmp/kafka-logs /opt/kafka/')
-		conn.sudo('chown -R kafka:kafka /opt/kafka')
-		conn.sudo('sed -i \'s/log.dirs=\\/tmp\\/kafka-logs/log.dirs=\\/opt\\/kafka\\/logs/g\' /home/kafka/kafka/config/server.properties')
-		conn.sudo('systemctl start kafka')
+		migratelogs(ctx)
 		conn.sudo('systemctl enable zookeeper')
 		setupiptables(ctx)
 
+@task
+def migratelogs(ctx, logdirs='', passes=3):
+	'''
+	Move the Kafka log.dirs to new directories with rsync passes while the broker runs, partitions are balanced over
+	several (JBOD) directories, the broker is only stopped for the final pass
+	:return:
+	'''
+	targets = [target.strip() for target in (logdirs or config._sections['node_kafka'].get('kafka_log_dirs', '/opt/kafka/logs')).split(',')]
+	with session(ctx) as conn:
+		sys.stdout.write("****************************\n")
+		sys.stdout.write("*** Migrating the Kafka logs to " + ','.join(targets) + "\n")
+		sys.stdout.write("****************************\n")
+		script = '\n'.join([
+			'set -e -o pipefail',
+			'props=' + KAFKA_PROPERTIES,
+			'current=$(sed -n "s/^log.dirs=//p" $props)',
+			'if [ "$current" = "' + ','.join(targets) + '" ]; then echo "*** log.dirs already ' + ','.join(targets) + '"; exit 0; fi',
+			'sources=$(echo "$current" | tr , " ")',
+			'targets="' + ' '.join(targets) + '"',
+			'command -v rsync > /dev/null || apt-get install -y rsync > /dev/null',
+			'mkdir -p $targets && chown kafka:kafka $targets',
+			# partitions keep the directory they were copied to, new ones go to the directory holding the fewest bytes
+			'plan() {',
+			'  for source in $sources; do if [ -d "$source" ]; then du -s --block-size=1 "$source"/*/ 2> /dev/null || true; fi; done | sort -rn | awk -v targets="$targets" \'',
+			'  BEGIN { n = split(targets, target, " ") }',
+			'  { sub(/\\/$/, "", $2); name = $2; sub(/.*\\//, "", name); best = 0',
+			'    for (i = 1; i <= n; i++) if (system("test -d " target[i] "/" name) == 0) best = i',
+			'    if (!best) { best = 1; for (i = 2; i <= n; i++) if (used[i] < used[best]) best = i }',
+			'    used[best] += $1; print $2, target[best] }\'',
+			'}',
+			# segments deleted or rolled by the running broker vanish during the live passes (rsync exit 24), the final
+			# pass with the broker stopped copies them consistently and fails on any rsync error
+			'copy() {',
+			'  bytes=0',
+			'  while read partition target; do',
+			'    status=0',
+			'    stats=$(rsync -a --delete --stats "$partition" "$target"/) || status=$?',
+			'    if [ $status -eq 24 ] && [ "$1" = live ]; then echo "*** files of $partition vanished during the copy";',
+			'    elif [ $status -ne 0 ]; then echo "*** rsync of $partition failed with exit $status"; return $status; fi',
+			'    sent=$(printf "%s\\n" "$stats" | sed -n "s/^Total transferred file size: \\([0-9,]*\\).*/\\1/p" | tr -d ,)',
+			'    bytes=$((bytes + ${sent:-0}))',
+			'  done < <(plan)',
+			'  copied=$((copied + bytes))',
+			'}',
+			# partitions deleted from the sources since an earlier pass are removed from the targets
+			'prune() {',
+			'  for target in $targets; do for partition in "$target"/*-[0-9]*/; do',
+			'    if [ ! -d "$partition" ]; then continue; fi',
+			'    name=$(basename "$partition"); found=0',
+			'    for source in $sources; do if [ -d "$source/$name" ]; then found=1; fi; done',
+			'    if [ $found -eq 0 ]; then rm -rf "$partition"; echo "*** removed $name, deleted during the migration"; fi',
+			'  done; done',
+			'}',
+			'copied=0',
+			'for pass in $(seq 1 ' + str(int(passes)) + '); do',
+			'  copy live; echo "*** pass $pass copied $bytes bytes while the broker runs"',
+			'  if [ $bytes -lt 67108864 ]; then break; fi',
+			'done',
+			'start=$(date +%s%N)',
+			'systemctl stop kafka',
+			'trap "systemctl start kafka" ERR',
+			'copy final; prune; echo "*** final pass copied $bytes bytes"',
+			'for checkpoint in recovery-point-offset-checkpoint replication-offset-checkpoint log-start-offset-checkpoint cleaner-offset-checkpoint; do',
+			'  entries=$(for source in $sources; do if [ -f "$source/$checkpoint" ]; then tail -n +3 "$source/$checkpoint"; fi; done)',
+			'  if [ -z "$entries" ]; then continue; fi',
+			'  for target in $targets; do printf "0\\n%s\\n%s\\n" "$(echo "$entries" | wc -l)" "$entries" > "$target/$checkpoint"; done',
+			'done',
+			'for target in $targets; do',
+			'  for source in $sources; do if [ -f "$source/meta.properties" ]; then cp "$source/meta.properties" "$target"/; fi; done',
+			'  if [ -f "${sources%% *}/.kafka_cleanshutdown" ]; then touch "$target/.kafka_cleanshutdown"; fi',
+			'done',
+			'chown -R kafka:kafka $targets',
+			'trap - ERR',
+			'sed -i "s|^log.dirs=.*|log.dirs=' + ','.join(targets) + '|" $props',
+			'systemctl start kafka',
+			'until (' + PROBES['kafka'] + ') 2> /dev/null; do',
+			'  if [ $(( ($(date +%s%N) - start) / 1000000000 )) -ge 300 ]; then echo "*** kafka not ready after the migration"; exit 1; fi',
+			'  sleep 0.2',
+			'done',
+			'echo "*** migrated $copied bytes, downtime $(( ($(date +%s%N) - start) / 1000000 ))ms, the old log.dirs $current are kept"',
+		])
+		result = conn.sudo('bash -c ' + shlex.quote(script))
+		downtime = re.search(r'downtime (\d+)ms', result.stdout or '')
+		if downtime:
+			sessions[ctx.host]['ready'].append(('kafka log migration downtime', int(downtime.group(1)) / 1000.0))
+
+@task
+def installexporters(ctx):
+	'''
+	Install the node exporter and the JMX exporter agent of Kafka and ZooKeeper, verified by a scrape (Optional)
+	:return:
+	'''
+	if not exporters():
+		sys.stdout.write("*** Exporters not enabled, set exporters = yes to install them\n")
+		return
+	ports = dict((name, port) for name, port, series in EXPORTERS)
+	with session(ctx) as conn:
+		sys.stdout.write("****************************\n")
+		sys.stdout.write("*** Installing the exporters\n")
+		sys.stdout.write("****************************\n")
+		conn.sudo('apt-get install -y prometheus-node-exporter')
+		conn.sudo('systemctl enable prometheus-node-exporter')
+		conn.sudo('systemctl restart prometheus-node-exporter')
+		jar = pushartifact(ctx, conn, config._sections['node_kafka'].get('jmx_exporter_url', JMX_EXPORTER_URL))
+		conn.sudo('mkdir -p ' + JMX_EXPORTER_DIR)
+		conn.sudo('cp ' + jar + ' ' + JMX_EXPORTER_DIR + '/jmx_prometheus_javaagent.jar')
+		for service in ('zookeeper', 'kafka'):
+			putcontent(conn, JMX_RULES[service], JMX_EXPORTER_DIR + '/' + service + '.yml')
+			conn.sudo('mkdir -p /etc/systemd/system/' + service + '.service.d')
+			putcontent(conn, '[Service]\nEnvironment="KAFKA_OPTS=-javaagent:' + JMX_EXPORTER_DIR + '/jmx_prometheus_javaagent.jar='\
+			 + str(ports[service]) + ':' + JMX_EXPORTER_DIR + '/' + service + '.yml"\n', '/etc/systemd/system/' + service + '.service.d/exporter.conf')
+		zookeeperunit(ctx, conn)
+		conn.sudo('systemctl restart kafka')
+		waitfor(ctx, conn, 'kafka')
+		sys.stdout.write("*** Exporters installed ***\n")
+	verifyexporters(ctx)
+
 @task
 def setupiptables(ctx):
 	'''
 	Setup IP Tables open ports for outside access
 	:return:
 	'''
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
-		conn.sudo('iptables -I INPUT -p tcp -m tcp --dport 22 -j ACCEPT')
-		conn.sudo('ufw allow from any to any port 22 proto tcp')
-		conn.sudo('iptables -I INPUT -p tcp -m tcp --dport 9092 -j ACCEPT')
-		conn.sudo('ufw allow from any to any port 9092 proto tcp')
-		conn.sudo('iptables -I INPUT -p tcp -m tcp --dport 2181 -j ACCEPT')
-		conn.sudo('ufw allow from any to any port 2181 proto tcp')
-		conn.sudo('iptables -I INPUT -p tcp -m tcp --dport 2888 -j ACCEPT')
-		conn.sudo('ufw allow from any to any port 2888 proto tcp')
-		conn.sudo('iptables -I INPUT -p tcp -m tcp --dport 3888 -j ACCEPT')
-		conn.sudo('ufw allow from any to any port 3888 proto tcp')
-		sys.stdout.write("persistent installation\n")
-		conn.sudo('echo iptables-persistent iptables-persistent/autosave_v4 boolean true | sudo debconf-set-selections')
-		conn.sudo('echo iptables-persistent iptables-persistent/autosave_v6 boolean true | sudo debconf-set-selections')
-		conn.sudo('apt-get install -y iptables-persistent')
-		sys.stdout.write("starting persistent\n")
-		conn.sudo('service netfilter-persistent start')
-		conn.sudo('netfilter-persistent save')
+	with session(ctx) as conn:
+		firewall(conn, FIREWALL_PORTS, [port for name, port, series in EXPORTERS] if exporters() else [])
 
 @task
 def finishdeployment(ctx):
@@ -201,7 +699,7 @@ def finishdeployment(ctx):
 	Final tasks for the deployment
 	:return:
 	'''
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
+	with session(ctx) as conn:
 		conn.sudo('rm /var/lib/apt/lists/lock')
 		conn.sudo('rm /var/cache/apt/archives/lock')
 		conn.sudo('rm /var/lib/dpkg/lock')
@@ -209,3 +707,53 @@ def finishdeployment(ctx):
 		sys.stdout.write("*** Kafka node successfully installed ***\n")
 		sys.stdout.write("*** Node deployment finished ***\n")
 
+DEPLOY_STEPS = [
+	servertasks,
+	tunehost,
+	installjava,
+	installkafka,
+	installzookeeper,
+	configurecluster,
+	tunekafka,
+	startkafka,
+	installkafkat,
+	installexporters,
+	setupiptables,
+	finishdeployment,
+]
+
+STEP_INPUTS = {
+	'installkafka': ['kafka_servicefile', 'kafka_password', 'kafka_url', 'kafka_sha256'],
+	'installzookeeper': ['zookeeper_servicefile', 'kafka_servicefile'],
+	'installkafkat': ['kafkat_cfgfile', 'kafka_log_dirs'],
+	'tunekafka': ['kafka_profile', profilesettings],
+	'configurecluster': ['hosts', 'zookeeper_hosts', 'replication_factor', 'min_insync_replicas', 'kafka_servicefile'],
+	'installexporters': ['exporters', 'jmx_exporter_url'],
+	'setupiptables': ['exporters', 'scrape_source'],
+}
+
+STEP_DEPENDS = {
+	'tunehost': ['servertasks'],
+	'installjava': ['servertasks'],
+	'installkafka': ['servertasks'],
+	'installzookeeper': ['installkafka'],
+	'configurecluster': ['installzookeeper'],
+	'tunekafka': ['configurecluster'],
+	'startkafka': ['installjava', 'installzookeeper', 'tunekafka', 'tunehost'],
+	'installkafkat': ['startkafka'],
+	'installexporters': ['installkafkat'],
+	'setupiptables': ['servertasks'],
+	'finishdeployment': ['tunehost', 'installexporters', 'setupiptables'],
+}
+
+STEP_LOCKS = {
+	'servertasks': ['dpkg'],
+	'installjava': ['dpkg'],
+	'installzookeeper': ['dpkg'],
+	'installkafkat': ['dpkg'],
+	'installexporters': ['dpkg'],
+	'setupiptables': ['dpkg'],
+	'finishdeployment': ['dpkg'],
+}
+
+emsdeploy.configure(sys.modules[__name__])
@@ -22,53 +22,84 @@
 
 import os
 import configparser
+import csv
+import hashlib
+import json
+import re
+import shlex
 import sys
-from fabric import task, Connection
+import time
+import urllib.parse
+from fabric import task
+from invoke import Context
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import emsdeploy
+from emsdeploy import deploy, batch, simulate, staging, servertasks, tunehost, verifyexporters, REPORT_DIR, batches,\
+	closesession, clusterhosts, exporterpassword, exporters, firewall, inventory, pipeto, pullfrom, putcontent, relay, runfleet, session, sessions,\
+	stagehost, waitfor
+
+NAME = "timescaledb"
+SECTION = "node_timescaledb"
 CONFIG_FILE = "timescaledb.cfg"
 config = configparser.RawConfigParser()
 config.read(CONFIG_FILE)
 
-@task
-def deploy(ctx):
-	'''
-	Execute full tasks at once
-	:return:
-	'''
-	staging(ctx)
-	servertasks(ctx)
-	installpostgresql(ctx)
-	installtimescaledb(ctx)
-	setupiptables(ctx)
-	finishdeployment(ctx)
+BENCHMARK_DATABASE = "emsdeploy_benchmark"
+BENCHMARK_DIR = "/var/lib/postgresql"
+PGBOUNCER_DIR = "/etc/pgbouncer"
+INGEST_SCRIPT = "kafkaingest.py"
+INGEST_SERVICE = "kafkaingestservice"
+INGEST_DIR = "/opt/emsdeploy"
+INGEST_CONFIG = "/etc/emsdeploy/kafkaingest.cfg"
+BACKUP_DIR = "/var/backups/emsdeploy"
+
+TUNING_SYSCTL = [
+	('vm.swappiness', '1'),
+	('vm.dirty_background_ratio', '3'),
+	('vm.dirty_ratio', '10'),
+	('net.core.somaxconn', '1024'),
+	('net.core.rmem_max', '4194304'),
+	('net.core.wmem_max', '4194304'),
+	('net.ipv4.tcp_rmem', '4096 87380 4194304'),
+	('net.ipv4.tcp_wmem', '4096 65536 4194304'),
+	('net.ipv4.tcp_keepalive_time', '300'),
+]
+TUNING_HUGEPAGES = "never"
+TUNING_READAHEAD_KB = "2048"
+TUNING_DATA_DIRS = ['/var/lib/postgresql']
+TUNING_LIMIT_UNITS = ['postgresql@11-main', 'pgbouncer']
+TUNING_LIMITS = [('LimitNOFILE', '100000'), ('LimitNPROC', '65536')]
+FIREWALL_PORTS = [22, 5432]
+
+EXPORTERS = [
+	('node', 9100, [r'node_cpu(_seconds_total)?\{', r'node_disk_io_time(_ms|_seconds_total)?\{', r'node_network_receive_bytes(_total)?\{']),
+	('postgres', 9187, [r'pg_up 1', r'pg_stat_database_xact_commit\{', r'pg_stat_database_tup_inserted\{', r'pg_stat_bgwriter_buffers_backend ']),
+]
+
+PROBES = {
+	'postgresql': 'pg_isready -q',
+}
 
 @task
-def staging(ctx):
+def fleet(ctx, workers=0, force=False, batch=False, parallel=False):
 	'''
-	Setting up host credentials
+	Execute full tasks on every host of the inventory in parallel
 	:return:
 	'''
-	ctx.name = 'staging'
-	ctx.user = config._sections['node_timescaledb']['user']
-	ctx.connect_kwargs = {"key_filename":[config._sections['node_timescaledb']['keyfile']]}
-	ctx.host = config._sections['node_timescaledb']['host'] + ':' + config._sections['node_timescaledb']['port']
+	ctx.force = force
+	ctx.batch = batch
+	ctx.parallel = parallel
+	hosts = inventory()
+	workers = int(workers) or int(config._sections['node_timescaledb'].get('workers', len(hosts)))
+	runfleet(ctx, hosts, workers)
 
-@task
-def servertasks(ctx):
+def artifacts():
 	'''
-	Prepare the node, install updates
-	:return:
+	Artifacts installed on the node, its packages come from apt
+	:return: list of (local file or url, sha256)
 	'''
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
-		sys.stdout.write("****************************\n")
-		sys.stdout.write("*** Starting Preperation of the Server\n")
-		sys.stdout.write("****************************\n")
-		conn.sudo('apt-get update')
-		conn.sudo('apt-get -y upgrade')
-		conn.sudo('mv /var/lib/dpkg/lock /var/lib/dpkg/lock_backup')
-		conn.sudo('apt-get install -y wget ca-certificates curl')
-		conn.sudo('rm -vf /var/lib/dpkg/lock_backup')
-		sys.stdout.write("*** Server prepared ***\n\n")
+	return []
 
 @task
 def installpostgresql(ctx):
@@ -76,7 +107,7 @@ def installpostgresql(ctx):
 	Install PostgreSQL 11
 	:return:
 	'''	
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
+	with session(ctx) as conn:
 		sys.stdout.write("****************************\n")
 		sys.stdout.write("*** Installing PostgreSQL 11\n")
 		sys.stdout.write("****************************\n")
@@ -87,6 +118,7 @@ def installpostgresql(ctx):
 		conn.sudo('apt-get update')
 		conn.sudo('apt-get install -y postgresql-11')
 		conn.sudo('apt-get install -y postgresql-contrib')
+		waitfor(ctx, conn, 'postgresql')
 		sys.stdout.write("***Changing postgres password \n")
 		conn.sudo('-u postgres psql -U postgres -d postgres -c "alter user postgres with password \''\
 		 + config._sections['node_timescaledb']['postgres_password'] + '\';"')
@@ -94,18 +126,582 @@ def installpostgresql(ctx):
 @task
 def installtimescaledb(ctx):
 	'''
-	Install TimescaleDB 1.2.2
+	Install TimescaleDB, 1.2.2 unless timescaledb_package selects another package
 	:return:
 	'''
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
+	package = config._sections['node_timescaledb'].get('timescaledb_package', 'timescaledb-postgresql-11')
+	with session(ctx) as conn:
 		sys.stdout.write("****************************\n")
-		sys.stdout.write("*** Installing TimescaleDB 1.2.2\n")
+		sys.stdout.write("*** Installing TimescaleDB (" + package + ")\n")
 		sys.stdout.write("****************************\n")
 		conn.sudo('add-apt-repository ppa:timescale/timescaledb-ppa')
 		conn.sudo('apt-get update')
-		conn.sudo('apt install -y timescaledb-postgresql-11')
+		conn.sudo('apt install -y ' + package)
 		conn.sudo('timescaledb-tune --quiet --yes')
 		conn.sudo('service postgresql restart')
+		waitfor(ctx, conn, 'postgresql')
+
+@task
+def installpgbouncer(ctx):
+	'''
+	Install PgBouncer with transaction pooling in front of PostgreSQL (Optional)
+	:return:
+	'''
+	if not pgbouncer():
+		sys.stdout.write("*** PgBouncer not enabled, clients connect to PostgreSQL directly\n")
+		return
+	settings = config._sections['node_timescaledb']
+	with session(ctx) as conn:
+		sys.stdout.write("****************************\n")
+		sys.stdout.write("*** Installing PgBouncer\n")
+		sys.stdout.write("****************************\n")
+		conn.sudo('apt-get install -y pgbouncer')
+		secret = 'md5' + hashlib.md5((settings['postgres_password'] + 'postgres').encode()).hexdigest()
+		putcontent(conn, '"postgres" "' + secret + '"\n', PGBOUNCER_DIR + '/userlist.txt', 'postgres:postgres', '640')
+		putcontent(conn, '\n'.join([
+			'[databases]',
+			'* = host=127.0.0.1 port=5432',
+			'',
+			'[pgbouncer]',
+			'listen_addr = *',
+			'listen_port = ' + settings.get('pgbouncer_port', '6432'),
+			'unix_socket_dir = /var/run/postgresql',
+			'auth_type = md5',
+			'auth_file = ' + PGBOUNCER_DIR + '/userlist.txt',
+			'admin_users = postgres',
+			'stats_users = postgres',
+			'pool_mode = transaction',
+			'max_client_conn = ' + settings.get('pgbouncer_max_client_conn', '1000'),
+			'default_pool_size = @POOL@',
+			'reserve_pool_size = @RESERVE@',
+			'max_db_connections = @LIMIT@',
+			'server_idle_timeout = 60',
+			'ignore_startup_parameters = extra_float_digits',
+			'logfile = /var/log/postgresql/pgbouncer.log',
+			'pidfile = /var/run/postgresql/pgbouncer.pid',
+		]) + '\n', PGBOUNCER_DIR + '/pgbouncer.ini', 'postgres:postgres', '640')
+		sys.stdout.write("*** Sizing the pools from the CPU count and max_connections\n")
+		conn.sudo('bash -c ' + shlex.quote('cpus=$(nproc); '\
+		 + 'limit=$(( $(sudo -u postgres psql -X -A -t -c "SHOW max_connections") - 10 )); '\
+		 + 'pool=$(( cpus * 2 < limit ? cpus * 2 : limit )); reserve=$(( cpus / 2 > 1 ? cpus / 2 : 1 )); '\
+		 + 'sed -i -e "s/@POOL@/$pool/" -e "s/@RESERVE@/$reserve/" -e "s/@LIMIT@/$limit/" ' + PGBOUNCER_DIR + '/pgbouncer.ini; '\
+		 + 'echo "*** default_pool_size=$pool reserve_pool_size=$reserve max_db_connections=$limit"'))
+		conn.sudo('sed -i "s/^START=0/START=1/" /etc/default/pgbouncer', warn=True)
+		conn.sudo('systemctl enable pgbouncer')
+		conn.sudo('systemctl restart pgbouncer')
+		waitfor(ctx, conn, 'pgbouncer', 'pg_isready -q -h 127.0.0.1 -p ' + settings.get('pgbouncer_port', '6432'))
+		sys.stdout.write("*** PgBouncer listening on port " + settings.get('pgbouncer_port', '6432') + " ***\n\n")
+
+def pgbouncer():
+	'''
+	PgBouncer is enabled with pgbouncer = yes in timescaledb.cfg
+	:return:
+	'''
+	return config._sections['node_timescaledb'].get('pgbouncer', 'no').lower() in ('yes', 'true', '1')
+
+@task
+def installingest(ctx):
+	'''
+	Install the Kafka to TimescaleDB ingest service for the topics of the [ingest_<topic>] sections (Optional)
+	:return:
+	'''
+	topics = ingesttopics()
+	if not topics:
+		sys.stdout.write("*** No [ingest_<topic>] sections configured, no ingest service to install\n")
+		return
+	settings = ingestsettings()
+	database = settings.get('database', config._sections['node_timescaledb'].get('schema_database', ''))
+	if not database:
+		raise RuntimeError('no database to ingest into, set schema_database or database in [kafka_ingest]')
+	port = settings.get('metrics_port', '9898')
+	lines = [
+		'[ingest]',
+		'brokers = ' + ingestbrokers(),
+		'group = ' + settings.get('group', 'emsdeploy-ingest'),
+		'database = ' + database,
+		'batch_rows = ' + settings.get('batch_rows', '5000'),
+		'batch_seconds = ' + settings.get('batch_seconds', '2'),
+		'metrics_port = ' + port,
+	]
+	for section in topics:
+		lines += ['', '[topic_' + section[len('ingest_'):] + ']'] + [key + ' = ' + value for key, value in config.items(section)]
+	with session(ctx) as conn:
+		sys.stdout.write("****************************\n")
+		sys.stdout.write("*** Installing the Kafka ingest of " + ', '.join(section[len('ingest_'):] for section in topics) + "\n")
+		sys.stdout.write("****************************\n")
+		conn.sudo('apt-get install -y python3-kafka python3-psycopg2')
+		conn.sudo('mkdir -p ' + INGEST_DIR + ' ' + os.path.dirname(INGEST_CONFIG))
+		with open(INGEST_SCRIPT) as f:
+			putcontent(conn, f.read(), INGEST_DIR + '/' + INGEST_SCRIPT, mode='755')
+		putcontent(conn, '\n'.join(lines) + '\n', INGEST_CONFIG, 'root:postgres', '640')
+		with open(INGEST_SERVICE) as f:
+			putcontent(conn, f.read(), '/etc/systemd/system/kafkaingest.service')
+		conn.sudo('systemctl daemon-reload')
+		conn.sudo('systemctl enable kafkaingest')
+		conn.sudo('systemctl restart kafkaingest')
+		waitfor(ctx, conn, 'kafkaingest', 'curl -fsS http://localhost:' + port + '/metrics | grep -q kafkaingest_rows_total')
+		sys.stdout.write("*** Kafka ingest running, metrics on http://" + ctx.address + ":" + port + "/metrics ***\n\n")
+
+def ingesttopics():
+	'''
+	Sections of the topics the ingest service consumes
+	:return: list of section names
+	'''
+	return [section for section in config.sections() if section.startswith('ingest_')]
+
+def ingestsettings():
+	'''
+	Settings of the ingest service in [kafka_ingest]
+	:return: dict
+	'''
+	return dict(config.items('kafka_ingest')) if config.has_section('kafka_ingest') else {}
+
+def ingestbrokers(ctx=None):
+	'''
+	Brokers the ingest service consumes from, brokers of [kafka_ingest] or the Kafka nodes of its kafka_config
+	:return: comma separated host:port list, empty without ingest topics
+	'''
+	if not ingesttopics():
+		return ''
+	settings = ingestsettings()
+	return settings.get('brokers') or kafkabrokers(settings.get('kafka_config', '../nodekafka/kafka.cfg'))
+
+def kafkabrokers(path):
+	'''
+	Bootstrap servers of the Kafka nodes of a kafka.cfg
+	:return: comma separated host:port list
+	'''
+	kafka = configparser.RawConfigParser()
+	if not kafka.read(path):
+		raise RuntimeError('Kafka configuration ' + path + ' not found, set brokers in [kafka_ingest]')
+	node = kafka._sections['node_kafka']
+	return ','.join(host + ':9092' for host in clusterhosts(node))
+
+@task
+def applyschema(ctx, dryrun=False):
+	'''
+	Create the hypertables, continuous aggregates and policies declared in timescaledb.cfg, existing objects are kept
+	:return:
+	'''
+	database = config._sections['node_timescaledb'].get('schema_database', '')
+	if not database:
+		sys.stdout.write("*** No schema_database configured, no schema to apply\n")
+		return
+	if ctx.host in batches:
+		sys.stdout.write("*** applyschema needs a running PostgreSQL, run it after the batch\n")
+		return
+	with session(ctx) as conn:
+		sys.stdout.write("****************************\n")
+		sys.stdout.write("*** Applying the schema of " + database + "\n")
+		sys.stdout.write("****************************\n")
+		changes = schemachanges(sessions[ctx.host]['conn'], database)
+		for description, statements, target in changes:
+			sys.stdout.write("*** " + description + "\n")
+		if dryrun or not changes:
+			sys.stdout.write("*** Schema " + ("not applied (dry run)" if changes else "unchanged") + " ***\n")
+			return
+		for description, statements, target in changes:
+			for statement in statements:
+				psql(conn, statement, target)
+		sys.stdout.write("*** Schema applied, " + str(len(changes)) + " changes ***\n\n")
+
+def psql(conn, sql, database='postgres', **kwargs):
+	'''
+	Execute SQL as the postgres user, rows are printed unaligned with | between the columns
+	:return: result
+	'''
+	return conn.sudo('-u postgres psql -X -q -A -t -v ON_ERROR_STOP=1 -d ' + database + ' -c ' + shlex.quote(sql), **kwargs)
+
+def literal(value):
+	'''
+	SQL string literal of a value
+	:return:
+	'''
+	return "'" + value.replace("'", "''") + "'"
+
+def interval(value):
+	'''
+	SQL interval of a config value such as 7 days
+	:return:
+	'''
+	return 'INTERVAL ' + literal(value)
+
+def schemaobjects(kind):
+	'''
+	Declared objects of a kind, the [hypertable_<name>] or [aggregate_<name>] sections of timescaledb.cfg
+	:return: list of (name, settings)
+	'''
+	return [(section[len(kind) + 1:], dict(config.items(section))) for section in config.sections()
+	 if section.startswith(kind + '_')]
+
+def policycheck(name, proc, settings):
+	'''
+	Query finding the background job of a policy of a hypertable or continuous aggregate with the given settings
+	:return: SQL
+	'''
+	return "SELECT 1 FROM timescaledb_information.jobs j LEFT JOIN timescaledb_information.continuous_aggregates c"\
+	 + " ON c.materialization_hypertable_name = j.hypertable_name WHERE j.proc_name = " + literal(proc)\
+	 + " AND coalesce(c.view_name, j.hypertable_name) = " + literal(name)\
+	 + ''.join(' AND ' + column + ' = ' + interval(value) for column, value in settings)
+
+def schemachanges(conn, database):
+	'''
+	Compare the declared schema with the catalogs of the database in one query
+	:return: list of (description, statements, database) still to apply
+	'''
+	changes = []
+	if not psql(conn, 'SELECT 1 FROM pg_database WHERE datname = ' + literal(database), hide=True).stdout.strip():
+		changes.append(('create database ' + database, ['CREATE DATABASE ' + database], 'postgres'))
+		version = ''
+	else:
+		version = psql(conn, "SELECT extversion FROM pg_extension WHERE extname = 'timescaledb'", database, hide=True).stdout.strip()
+	if not version:
+		available = psql(conn, "SELECT default_version FROM pg_available_extensions WHERE name = 'timescaledb'", hide=True).stdout.strip()
+		if not available.split('.')[0].isdigit() or int(available.split('.')[0]) < 2:
+			raise RuntimeError('compression and policies need TimescaleDB 2, available: ' + (available or 'none')\
+			 + ', select it with timescaledb_package')
+		changes.append(('create extension timescaledb ' + available, ['CREATE EXTENSION IF NOT EXISTS timescaledb'], database))
+	elif int(version.split('.')[0]) < 2:
+		raise RuntimeError('compression and policies need TimescaleDB 2, installed in ' + database + ': ' + version)
+	checks = {}
+	for name, table in schemaobjects('hypertable'):
+		checks['table ' + name] = "SELECT 1 FROM pg_tables WHERE schemaname = 'public' AND tablename = " + literal(name)
+		checks['hypertable ' + name] = 'SELECT 1 FROM timescaledb_information.hypertables WHERE hypertable_name = ' + literal(name)
+		checks['compression ' + name] = checks['hypertable ' + name] + ' AND compression_enabled'
+		if 'chunk_time_interval' in table:
+			checks['chunk_time_interval ' + name] = 'SELECT 1 FROM timescaledb_information.dimensions WHERE hypertable_name = '\
+			 + literal(name) + ' AND time_interval = ' + interval(table['chunk_time_interval'])
+		if 'number_partitions' in table:
+			checks['number_partitions ' + name] = 'SELECT 1 FROM timescaledb_information.dimensions WHERE hypertable_name = '\
+			 + literal(name) + ' AND column_name = ' + literal(table['partitioning_column'])\
+			 + ' AND num_partitions = ' + str(int(table['number_partitions']))
+		if 'compress_after' in table:
+			checks['compression policy ' + name] = policycheck(name, 'policy_compression',
+			 [("(j.config->>'compress_after')::interval", table['compress_after'])])
+		if 'retention' in table:
+			checks['retention policy ' + name] = policycheck(name, 'policy_retention',
+			 [("(j.config->>'drop_after')::interval", table['retention'])])
+	for name, aggregate in schemaobjects('aggregate'):
+		checks['aggregate ' + name] = 'SELECT 1 FROM timescaledb_information.continuous_aggregates WHERE view_name = ' + literal(name)
+		if 'refresh_interval' in aggregate:
+			checks['refresh policy ' + name] = policycheck(name, 'policy_refresh_continuous_aggregate', [
+				("(j.config->>'start_offset')::interval", aggregate['refresh_start_offset']),
+				("(j.config->>'end_offset')::interval", aggregate['refresh_end_offset']),
+				('j.schedule_interval', aggregate['refresh_interval']),
+			])
+		if 'retention' in aggregate:
+			checks['retention policy ' + name] = policycheck(name, 'policy_retention',
+			 [("(j.config->>'drop_after')::interval", aggregate['retention'])])
+	present = set()
+	if version and checks:
+		names = sorted(checks)
+		query = ' UNION ALL '.join('SELECT ' + str(index) + ' WHERE EXISTS (' + checks[key] + ')' for index, key in enumerate(names))
+		present = set(names[int(index)] for index in psql(conn, query, database, hide=True).stdout.split())
+	for name, table in schemaobjects('hypertable'):
+		if 'table ' + name not in present:
+			changes.append(('create table ' + name, ['CREATE TABLE IF NOT EXISTS ' + name + ' (' + table['columns'] + ')'], database))
+		if 'hypertable ' + name not in present:
+			arguments = [literal(name), literal(table.get('time_column', 'time'))]
+			if 'partitioning_column' in table:
+				arguments.append('partitioning_column => ' + literal(table['partitioning_column']))
+				arguments.append('number_partitions => ' + str(int(table.get('number_partitions', 1))))
+			if 'chunk_time_interval' in table:
+				arguments.append('chunk_time_interval => ' + interval(table['chunk_time_interval']))
+			changes.append(('convert ' + name + ' into a hypertable',
+			 ['SELECT create_hypertable(' + ', '.join(arguments) + ', if_not_exists => TRUE, migrate_data => TRUE)'], database))
+		else:
+			if 'chunk_time_interval ' + name in checks and 'chunk_time_interval ' + name not in present:
+				changes.append(('set the chunk_time_interval of ' + name + ' to ' + table['chunk_time_interval'],
+				 ['SELECT set_chunk_time_interval(' + literal(name) + ', ' + interval(table['chunk_time_interval']) + ')'], database))
+			if 'number_partitions ' + name in checks and 'number_partitions ' + name not in present:
+				changes.append(('set the number_partitions of ' + name + ' to ' + table['number_partitions'],
+				 ['SELECT set_number_partitions(' + literal(name) + ', ' + str(int(table['number_partitions'])) + ')'], database))
+		if ('compress_segmentby' in table or 'compress_orderby' in table) and 'compression ' + name not in present:
+			options = ['timescaledb.compress']
+			options += ['timescaledb.' + key + ' = ' + literal(table[key]) for key in ('compress_segmentby', 'compress_orderby') if key in table]
+			changes.append(('enable compression of ' + name, ['ALTER TABLE ' + name + ' SET (' + ', '.join(options) + ')'], database))
+		if 'compression policy ' + name in checks and 'compression policy ' + name not in present:
+			changes.append(('compress chunks of ' + name + ' after ' + table['compress_after'], [
+				'SELECT remove_compression_policy(' + literal(name) + ', if_exists => TRUE)',
+				'SELECT add_compression_policy(' + literal(name) + ', ' + interval(table['compress_after']) + ')',
+			], database))
+		if 'retention policy ' + name in checks and 'retention policy ' + name not in present:
+			changes.append(('drop chunks of ' + name + ' after ' + table['retention'], [
+				'SELECT remove_retention_policy(' + literal(name) + ', if_exists => TRUE)',
+				'SELECT add_retention_policy(' + literal(name) + ', ' + interval(table['retention']) + ')',
+			], database))
+	for name, aggregate in schemaobjects('aggregate'):
+		source = dict(schemaobjects('hypertable')).get(aggregate['hypertable'], {})
+		if 'aggregate ' + name not in present:
+			changes.append(('create continuous aggregate ' + name, ['CREATE MATERIALIZED VIEW IF NOT EXISTS ' + name\
+			 + ' WITH (timescaledb.continuous) AS SELECT time_bucket(' + interval(aggregate['bucket']) + ', '\
+			 + source.get('time_column', 'time') + ') AS bucket, ' + aggregate['columns'] + ' FROM ' + aggregate['hypertable']\
+			 + ' GROUP BY bucket' + (', ' + aggregate['group_by'] if aggregate.get('group_by') else '') + ' WITH NO DATA'], database))
+		if 'refresh policy ' + name in checks and 'refresh policy ' + name not in present:
+			changes.append(('refresh ' + name + ' every ' + aggregate['refresh_interval'], [
+				'SELECT remove_continuous_aggregate_policy(' + literal(name) + ', if_exists => TRUE)',
+				'SELECT add_continuous_aggregate_policy(' + literal(name) + ', start_offset => '\
+				 + interval(aggregate['refresh_start_offset']) + ', end_offset => ' + interval(aggregate['refresh_end_offset'])\
+				 + ', schedule_interval => ' + interval(aggregate['refresh_interval']) + ')',
+			], database))
+		if 'retention policy ' + name in checks and 'retention policy ' + name not in present:
+			changes.append(('drop chunks of ' + name + ' after ' + aggregate['retention'], [
+				'SELECT remove_retention_policy(' + literal(name) + ', if_exists => TRUE)',
+				'SELECT add_retention_policy(' + literal(name) + ', ' + interval(aggregate['retention']) + ')',
+			], database))
+	return changes
+
+@task
+def benchmark(ctx, devices=0, rows=0):
+	'''
+	Measure COPY and batched INSERT ingest and range, last point and aggregate query latencies on a scratch hypertable
+	:return:
+	'''
+	settings = dict(config.items('timescaledb_benchmark')) if config.has_section('timescaledb_benchmark') else {}
+	devices = int(devices or settings.get('devices', 1000))
+	rows = int(rows or settings.get('rows', 2000000))
+	size = int(settings.get('insert_batch', 1000))
+	runs = int(settings.get('query_runs', 50))
+	end = "(timestamptz '2019-01-01 00:00:00+00' + interval '" + str(rows // devices * 10) + " seconds')"
+	generated = "SELECT n, timestamptz '2019-01-01 00:00:00+00' + (n / " + str(devices)\
+	 + ") * interval '10 seconds' AS time, n % " + str(devices) + " AS device_id, round((random() * 100)::numeric, 3) AS value"\
+	 + " FROM generate_series(0, " + str(rows - 1) + ") n"
+	copyfile = BENCHMARK_DIR + '/emsdeploy-benchmark.csv'
+	insertfile = BENCHMARK_DIR + '/emsdeploy-benchmark.sql'
+	with session(ctx):
+		conn = sessions[ctx.host]['conn']
+		sys.stdout.write("****************************\n")
+		sys.stdout.write("*** Benchmarking TimescaleDB, " + str(rows) + " rows of " + str(devices) + " devices\n")
+		sys.stdout.write("****************************\n")
+		results = [(name, setting, '') for name, setting in [line.split('|') for line in psql(conn, "SELECT name, setting || coalesce(unit, '')"\
+		 + " FROM pg_settings WHERE name IN ('shared_buffers', 'effective_cache_size', 'work_mem', 'max_wal_size',"\
+		 + " 'max_worker_processes', 'max_parallel_workers', 'timescaledb.max_background_workers')", hide=True).stdout.splitlines()]]
+		psql(conn, 'DROP DATABASE IF EXISTS ' + BENCHMARK_DATABASE, hide=True)
+		psql(conn, 'CREATE DATABASE ' + BENCHMARK_DATABASE, hide=True)
+		try:
+			psql(conn, 'CREATE EXTENSION IF NOT EXISTS timescaledb', BENCHMARK_DATABASE, hide=True)
+			for table in ('benchmark_copy', 'benchmark_insert'):
+				psql(conn, 'CREATE TABLE ' + table + ' (time timestamptz NOT NULL, device_id integer NOT NULL, value double precision)',
+				 BENCHMARK_DATABASE, hide=True)
+				psql(conn, "SELECT create_hypertable('" + table + "', 'time', chunk_time_interval => interval '"\
+				 + settings.get('chunk_time_interval', '1 day') + "')", BENCHMARK_DATABASE, hide=True)
+				psql(conn, 'CREATE INDEX ON ' + table + ' (device_id, time DESC)', BENCHMARK_DATABASE, hide=True)
+			sys.stdout.write("*** Generating the synthetic series\n")
+			psql(conn, "COPY (SELECT time, device_id, value FROM (" + generated + ") g) TO '" + copyfile + "' WITH (FORMAT csv)",
+			 BENCHMARK_DATABASE, hide=True)
+			psql(conn, "COPY (SELECT 'INSERT INTO benchmark_insert VALUES ' || string_agg(format('(%L, %s, %s)', time, device_id, value), ', ')"\
+			 + " || ';' FROM (" + generated + ") g GROUP BY n / " + str(size) + " ORDER BY n / " + str(size) + ") TO '" + insertfile + "'",
+			 BENCHMARK_DATABASE, hide=True)
+			sys.stdout.write("*** Ingesting with COPY\n")
+			seconds = sum(timings(conn, ['-c', "COPY benchmark_copy FROM '" + copyfile + "' WITH (FORMAT csv)"])) / 1000
+			results.append(('copy', '%.0f' % (rows / seconds), 'rows/s'))
+			sys.stdout.write("*** Ingesting with INSERT batches of " + str(size) + " rows\n")
+			seconds = sum(timings(conn, ['-f', insertfile])) / 1000
+			results.append(('insert', '%.0f' % (rows / seconds), 'rows/s'))
+			queries = [
+				('range query', 'SELECT time, value FROM benchmark_copy WHERE device_id = %d AND time > ' + end + " - interval '1 hour'"),
+				('last point query', 'SELECT time, value FROM benchmark_copy WHERE device_id = %d ORDER BY time DESC LIMIT 1'),
+				('aggregate query', "SELECT time_bucket('1 hour', time) AS bucket, avg(value), max(value) FROM benchmark_copy"\
+				 + ' WHERE device_id = %d AND time > ' + end + " - interval '1 day' GROUP BY bucket"),
+			]
+			psql(conn, 'ANALYZE', BENCHMARK_DATABASE, hide=True)
+			for name, query in queries:
+				sys.stdout.write("*** Running the " + name + " " + str(runs) + " times\n")
+				commands = []
+				for run in range(runs):
+					commands += ['-c', query % (run * 7919 % devices)]
+				latencies = sorted(timings(conn, commands))
+				results.append((name + ' p50', '%.2f' % latencies[len(latencies) // 2], 'ms'))
+				results.append((name + ' p95', '%.2f' % latencies[min(len(latencies) - 1, len(latencies) * 95 // 100)], 'ms'))
+		finally:
+			conn.sudo('rm -f ' + copyfile + ' ' + insertfile, warn=True)
+			psql(conn, 'DROP DATABASE IF EXISTS ' + BENCHMARK_DATABASE, hide=True, warn=True)
+	benchmarkreport(ctx.host, results)
+
+def timings(conn, commands):
+	'''
+	Run psql commands in the benchmark database with timing on, query output is discarded
+	:return: list of the milliseconds of every statement
+	'''
+	result = conn.sudo('-u postgres psql -X -q -v ON_ERROR_STOP=1 -d ' + BENCHMARK_DATABASE + ' -c ' + shlex.quote('\\timing on')\
+	 + ' -c ' + shlex.quote('\\o /dev/null') + ' ' + ' '.join(shlex.quote(command) for command in commands), hide=True)
+	return [float(value) for value in re.findall(r'Time: ([\d.]+) ms', result.stdout)]
+
+def benchmarkreport(host, results):
+	'''
+	Write the benchmark results into the reports folder and print them
+	:return:
+	'''
+	os.makedirs(REPORT_DIR, exist_ok=True)
+	name = os.path.join(REPORT_DIR, 'timescaledb-benchmark-' + time.strftime('%Y%m%d-%H%M%S'))
+	records = [{'host': host, 'metric': metric, 'value': value, 'unit': unit} for metric, value, unit in results]
+	with open(name + '.json', 'w') as f:
+		json.dump(records, f, indent=2)
+	with open(name + '.csv', 'w', newline='') as f:
+		writer = csv.DictWriter(f, fieldnames=['host', 'metric', 'value', 'unit'])
+		writer.writeheader()
+		writer.writerows(records)
+	sys.stdout.write("\n****************************\n")
+	sys.stdout.write("*** Benchmark report\n")
+	sys.stdout.write("****************************\n")
+	for record in records:
+		sys.stdout.write("%-24s %-36s %14s %s\n" % (record['host'], record['metric'], record['value'], record['unit']))
+	sys.stdout.write("*** Report written to " + name + ".json and " + name + ".csv ***\n")
+
+@task
+def backuptimescaledb(ctx, database='', mode='', output='', target='', jobs=0, force=False):
+	'''
+	Back up a database of the node, mode is directory, stream or base.
+	directory: parallel pg_dump in directory format with compressed table files into BACKUP_DIR on the node
+	stream: compressed pg_dump streamed into a local file, or with a target host straight into pg_restore on that host
+	base: compressed base backup of the whole cluster streamed into a local file
+	:return:
+	'''
+	settings = config._sections['node_timescaledb']
+	database = database or settings.get('schema_database', '')
+	mode = mode or settings.get('backup_mode', 'directory')
+	jobs = int(jobs) or int(settings.get('backup_jobs', 4))
+	level = settings.get('backup_compression', '1')
+	stamp = time.strftime('%Y%m%d-%H%M%S')
+	if not database and mode != 'base':
+		raise RuntimeError('no database to back up, set schema_database or pass --database')
+	if ctx.host in batches:
+		sys.stdout.write("*** backuptimescaledb streams over its own channels, run it after the batch\n")
+		return
+	with session(ctx):
+		conn = sessions[ctx.host]['conn']
+		size = int(psql(conn, "SELECT " + ("pg_database_size(" + literal(database) + ")" if mode != 'base' else\
+		 "sum(pg_database_size(datname)) FROM pg_database"), hide=True).stdout.strip() or 0)
+		sys.stdout.write("****************************\n")
+		sys.stdout.write("*** Backing up " + (database or 'the cluster') + " (" + mode + ")\n")
+		sys.stdout.write("****************************\n")
+		start = time.time()
+		if mode == 'directory':
+			destination = BACKUP_DIR + '/' + database + '-' + stamp
+			conn.sudo('install -d -o postgres -g postgres -m 700 ' + BACKUP_DIR)
+			conn.sudo('-u postgres pg_dump -Fd -j ' + str(jobs) + ' -Z ' + level + ' -f ' + destination + ' ' + database)
+			transferred = int(conn.sudo('du -sb ' + destination, hide=True).stdout.split()[0])
+			destination = ctx.address + ':' + destination
+		elif mode == 'stream' and target:
+			targetctx = Context(config=ctx.config.clone())
+			stagehost(targetctx, target)
+			try:
+				restoring = sessions[targetctx.host]['conn']
+				prerestore(restoring, database, force)
+				transferred = relay(conn, 'sudo -u postgres pg_dump -Fc -Z ' + level + ' ' + database, restoring,
+				 'sudo -u postgres pg_restore -d ' + database)
+				postrestore(restoring, database)
+			finally:
+				closesession(targetctx)
+			destination = target + ':' + database
+		elif mode == 'stream':
+			destination = output or database + '-' + ctx.address + '-' + stamp + '.dump'
+			transferred = pullfrom(conn, 'sudo -u postgres pg_dump -Fc -Z ' + level + ' ' + database, destination)
+		elif mode == 'base':
+			destination = output or 'basebackup-' + ctx.address + '-' + stamp + '.tar.gz'
+			transferred = pullfrom(conn, 'sudo -u postgres pg_basebackup -D - -Ft -X fetch -c fast -z -Z ' + level, destination)
+		else:
+			raise RuntimeError('unknown backup mode ' + mode + ', use directory, stream or base')
+		elapsed = time.time() - start
+	sys.stdout.write("*** Backed up %.1f MB in %.1fs: %.2f MB/s of data, %.2f MB/s compressed into %s ***\n\n"\
+	 % (size / 1048576.0, elapsed, size / elapsed / 1048576, transferred / elapsed / 1048576, destination))
+
+@task
+def restoretimescaledb(ctx, source='', database='', jobs=0, force=False):
+	'''
+	Restore a backup of backuptimescaledb: a directory in BACKUP_DIR on the node with parallel jobs, a local dump file
+	streamed into pg_restore, or with force a local base backup replacing the whole cluster
+	:return:
+	'''
+	settings = config._sections['node_timescaledb']
+	database = database or settings.get('schema_database', '')
+	jobs = int(jobs) or int(settings.get('backup_jobs', 4))
+	if not source:
+		raise RuntimeError('no backup to restore, pass --source')
+	if ctx.host in batches:
+		sys.stdout.write("*** restoretimescaledb streams over its own channels, run it after the batch\n")
+		return
+	with session(ctx):
+		conn = sessions[ctx.host]['conn']
+		sys.stdout.write("****************************\n")
+		sys.stdout.write("*** Restoring " + source + " into " + (database if not source.endswith('.tar.gz') else 'the cluster') + "\n")
+		sys.stdout.write("****************************\n")
+		start = time.time()
+		if source.endswith('.tar.gz'):
+			if not force:
+				raise RuntimeError('a base backup replaces the whole cluster of ' + ctx.address + ', restore it with --force')
+			directory = psql(conn, 'SHOW data_directory', hide=True).stdout.strip()
+			conn.sudo('systemctl stop postgresql')
+			conn.sudo('mv ' + directory + ' ' + directory + '.emsdeploy-' + time.strftime('%Y%m%d-%H%M%S'))
+			conn.sudo('install -d -o postgres -g postgres -m 700 ' + directory)
+			transferred = pipeto(conn, 'sudo -u postgres tar -xz -C ' + directory, source, False)
+			conn.sudo('systemctl start postgresql')
+			waitfor(ctx, conn, 'postgresql')
+			database = 'postgres'
+		elif os.path.isfile(source):
+			prerestore(conn, database, force)
+			transferred = pipeto(conn, 'sudo -u postgres pg_restore -d ' + database, source, False)
+			postrestore(conn, database)
+		else:
+			prerestore(conn, database, force)
+			conn.sudo('-u postgres pg_restore -Fd -j ' + str(jobs) + ' -d ' + database + ' ' + source)
+			postrestore(conn, database)
+			transferred = int(conn.sudo('du -sb ' + source, hide=True).stdout.split()[0])
+		elapsed = time.time() - start
+		size = int(psql(conn, "SELECT " + ("pg_database_size(" + literal(database) + ")" if not source.endswith('.tar.gz') else\
+		 "sum(pg_database_size(datname)) FROM pg_database"), hide=True).stdout.strip() or 0)
+	sys.stdout.write("*** Restored %.1f MB in %.1fs: %.2f MB/s of data, %.2f MB/s of backup read ***\n\n"\
+	 % (size / 1048576.0, elapsed, size / elapsed / 1048576, transferred / elapsed / 1048576))
+
+def prerestore(conn, database, force):
+	'''
+	Create the database to restore into with the timescaledb extension in restoring mode, an existing database is only
+	replaced with force
+	:return:
+	'''
+	if psql(conn, "SELECT 1 FROM pg_database WHERE datname = " + literal(database), hide=True).stdout.strip():
+		if not force:
+			raise RuntimeError(database + ' exists, restore with --force to replace it')
+		psql(conn, 'DROP DATABASE ' + database)
+	psql(conn, 'CREATE DATABASE ' + database)
+	psql(conn, 'CREATE EXTENSION IF NOT EXISTS timescaledb', database)
+	psql(conn, 'SELECT timescaledb_pre_restore()', database, hide=True)
+
+def postrestore(conn, database):
+	'''
+	Leave the restoring mode of timescaledb and refresh the statistics
+	:return:
+	'''
+	psql(conn, 'SELECT timescaledb_post_restore()', database, hide=True)
+	psql(conn, 'ANALYZE', database)
+
+@task
+def installexporters(ctx):
+	'''
+	Install the node and PostgreSQL exporters, verified by a scrape (Optional)
+	:return:
+	'''
+	if not exporters():
+		sys.stdout.write("*** Exporters not enabled, set exporters = yes to install them\n")
+		return
+	password = exporterpassword()
+	with session(ctx) as conn:
+		sys.stdout.write("****************************\n")
+		sys.stdout.write("*** Installing the exporters\n")
+		sys.stdout.write("****************************\n")
+		conn.sudo('apt-get install -y prometheus-node-exporter prometheus-postgres-exporter')
+		psql(conn, "DO $$BEGIN IF NOT EXISTS (SELECT FROM pg_roles WHERE rolname = 'exporter') THEN CREATE ROLE exporter; END IF; END$$;"\
+		 + ' ALTER ROLE exporter WITH LOGIN NOSUPERUSER CONNECTION LIMIT 3 PASSWORD ' + literal(password) + ';'\
+		 + ' GRANT pg_monitor TO exporter', hide=True)
+		conn.sudo('bash -c ' + shlex.quote('sed -i "/^DATA_SOURCE_NAME=/d" /etc/default/prometheus-postgres-exporter; '\
+		 + 'echo \'DATA_SOURCE_NAME="postgresql://exporter:' + urllib.parse.quote(password, safe='')\
+		 + '@localhost:5432/postgres?sslmode=disable"\' >> /etc/default/prometheus-postgres-exporter'))
+		conn.sudo('chmod 640 /etc/default/prometheus-postgres-exporter')
+		for service in ('prometheus-node-exporter', 'prometheus-postgres-exporter'):
+			conn.sudo('systemctl enable ' + service)
+			conn.sudo('systemctl restart ' + service)
+		sys.stdout.write("*** Exporters installed ***\n")
+	verifyexporters(ctx)
 
 @task
 def setupiptables(ctx):
@@ -113,18 +709,10 @@ def setupiptables(ctx):
 	Setup IP Tables open ports for outside access
 	:return:
 	'''
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
-		conn.sudo('iptables -I INPUT -p tcp -m tcp --dport 22 -j ACCEPT')
-		conn.sudo('ufw allow from any to any port 22 proto tcp')
-		conn.sudo('iptables -I INPUT -p tcp -m tcp --dport 5432 -j ACCEPT')
-		conn.sudo('ufw allow from any to any port 5432 proto tcp')
-		sys.stdout.write("persistent installation\n")
-		conn.sudo('echo iptables-persistent iptables-persistent/autosave_v4 boolean true | sudo debconf-set-selections')
-		conn.sudo('echo iptables-persistent iptables-persistent/autosave_v6 boolean true | sudo debconf-set-selections')
-		conn.sudo('apt-get install -y iptables-persistent')
-		sys.stdout.write("starting persistent\n")
-		conn.sudo('service netfilter-persistent start')
-		conn.sudo('netfilter-persistent save')
+	with session(ctx) as conn:
+		firewall(conn, FIREWALL_PORTS + ([config._sections['node_timescaledb'].get('pgbouncer_port', '6432')] if pgbouncer() else []),
+		 ([ingestsettings().get('metrics_port', '9898')] if ingesttopics() else [])\
+		 + ([port for name, port, series in EXPORTERS] if exporters() else []))
 
 @task
 def finishdeployment(ctx):
@@ -132,7 +720,7 @@ def finishdeployment(ctx):
 	Final tasks for the deployment
 	:return:
 	'''
-	with Connection(ctx.host, ctx.user, connect_kwargs=ctx.connect_kwargs) as conn:
+	with session(ctx) as conn:
 		conn.sudo('rm /var/lib/apt/lists/lock')
 		conn.sudo('rm /var/cache/apt/archives/lock')
 		conn.sudo('rm /var/lib/dpkg/lock')
@@ -145,3 +733,50 @@ def finishdeployment(ctx):
 		sys.stdout.write("*** host    all             all             10.0.3.2/32            md5\n")
 		sys.stdout.write("*** host    all             all             0.0.0.0/0            md5\n")
 
+DEPLOY_STEPS = [
+	servertasks,
+	tunehost,
+	installpostgresql,
+	installtimescaledb,
+	installpgbouncer,
+	applyschema,
+	installingest,
+	installexporters,
+	setupiptables,
+	finishdeployment,
+]
+
+STEP_INPUTS = {
+	'installpostgresql': ['repository_file', 'postgres_password'],
+	'installtimescaledb': ['timescaledb_package'],
+	'installpgbouncer': ['postgres_password', 'pgbouncer', 'pgbouncer_port', 'pgbouncer_max_client_conn'],
+	'applyschema': ['schema_database', '[hypertable_*]', '[aggregate_*]'],
+	'installingest': ['schema_database', '[kafka_ingest]', '[ingest_*]', ingestbrokers, INGEST_SCRIPT, INGEST_SERVICE],
+	'installexporters': ['exporters', 'exporter_password'],
+	'setupiptables': ['pgbouncer', 'pgbouncer_port', 'exporters', 'scrape_source', '[kafka_ingest]', '[ingest_*]'],
+}
+
+STEP_DEPENDS = {
+	'tunehost': ['servertasks'],
+	'installpostgresql': ['servertasks'],
+	'installtimescaledb': ['installpostgresql'],
+	'setupiptables': ['servertasks'],
+	'installpgbouncer': ['installtimescaledb'],
+	'applyschema': ['installtimescaledb'],
+	'installingest': ['applyschema'],
+	'installexporters': ['installingest'],
+	'finishdeployment': ['tunehost', 'installpgbouncer', 'installexporters', 'setupiptables'],
+}
+
+STEP_LOCKS = {
+	'servertasks': ['dpkg'],
+	'installpostgresql': ['dpkg'],
+	'installtimescaledb': ['dpkg'],
+	'installpgbouncer': ['dpkg'],
+	'installingest': ['dpkg'],
+	'installexporters': ['dpkg'],
+	'setupiptables': ['dpkg'],
+	'finishdeployment': ['dpkg'],
+}
+
+emsdeploy.configure(sys.modules[__name__])
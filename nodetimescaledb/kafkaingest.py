@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+# Copyright (C) 2019 Ulas Baloglu <ulasbaloglu@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Kafka to TimescaleDB ingest service installed by installingest: consumes the configured topics in a consumer group,
+decodes the JSON records into rows and writes them with batched COPY, offsets are committed after the write.
+Run it with --test to check it against a stand-in broker and database.
+'''
+
+import argparse
+import configparser
+import csv
+import io
+import json
+import random
+import signal
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+CONFIG_FILE = "/etc/emsdeploy/kafkaingest.cfg"
+
+class Metrics(object):
+	'''
+	Counters and gauges of the service, served in the Prometheus text format
+	'''
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.values = {'records': 0, 'rows': 0, 'flushes': 0, 'failures': 0, 'decode_errors': 0, 'rows_s': 0.0, 'flush_s': 0.0}
+		self.lag = {}
+
+	def add(self, **values):
+		with self.lock:
+			for name, value in values.items():
+				self.values[name] += value
+
+	def set(self, lag=None, **values):
+		with self.lock:
+			self.values.update(values)
+			if lag is not None:
+				self.lag = lag
+
+	def render(self):
+		with self.lock:
+			lines = [
+				'# TYPE kafkaingest_records_total counter',
+				'kafkaingest_records_total ' + str(self.values['records']),
+				'# TYPE kafkaingest_rows_total counter',
+				'kafkaingest_rows_total ' + str(self.values['rows']),
+				'# TYPE kafkaingest_flushes_total counter',
+				'kafkaingest_flushes_total ' + str(self.values['flushes']),
+				'# TYPE kafkaingest_write_failures_total counter',
+				'kafkaingest_write_failures_total ' + str(self.values['failures']),
+				'# TYPE kafkaingest_decode_errors_total counter',
+				'kafkaingest_decode_errors_total ' + str(self.values['decode_errors']),
+				'# TYPE kafkaingest_rows_per_second gauge',
+				'kafkaingest_rows_per_second %.1f' % self.values['rows_s'],
+				'# TYPE kafkaingest_flush_seconds gauge',
+				'kafkaingest_flush_seconds %.3f' % self.values['flush_s'],
+				'# TYPE kafkaingest_lag gauge',
+			]
+			lines += ['kafkaingest_lag{topic="%s",partition="%d"} %d' % (topic, partition, lag)
+			 for (topic, partition), lag in sorted(self.lag.items())]
+		return '\n'.join(lines) + '\n'
+
+class Ingest(object):
+	'''
+	Buffer decoded rows per table and flush them when batch_rows rows or batch_seconds have been reached, the offsets of
+	the flushed records are committed after the write, a failed write rewinds the partitions to the committed offsets.
+	Undecodable records are counted with the batch they belong to, so a record read again after a rewind counts once
+	'''
+	def __init__(self, source, sink, topics, batch_rows, batch_seconds, metrics):
+		self.source = source
+		self.sink = sink
+		self.topics = topics
+		self.batch_rows = batch_rows
+		self.batch_seconds = batch_seconds
+		self.metrics = metrics
+		self.buffer = {}
+		self.first = {}
+		self.next = {}
+		self.size = 0
+		self.errors = 0
+		self.backoff = min(batch_seconds, 5)
+		self.started = time.time()
+
+	def run(self, stop, timeout=0.5):
+		while not stop.is_set():
+			self.step(timeout)
+		self.flush()
+
+	def step(self, timeout=0.5):
+		for topic, partition, offset, value in self.source.poll(timeout):
+			self.first.setdefault((topic, partition), offset)
+			self.next[(topic, partition)] = offset + 1
+			self.metrics.add(records=1)
+			try:
+				table, columns, row = self.decode(topic, value)
+			except (ValueError, KeyError, TypeError):
+				self.errors += 1
+				continue
+			self.buffer.setdefault((table, columns), []).append(row)
+			self.size += 1
+		if self.size >= self.batch_rows or (self.next and time.time() - self.started >= self.batch_seconds):
+			self.flush()
+
+	def decode(self, topic, value):
+		'''
+		Row of a JSON record, a column is read from the field of the same name or from the dotted path after its colon
+		:return: (table, columns, row)
+		'''
+		spec = self.topics[topic]
+		record = json.loads(value)
+		row = []
+		for column, path in spec['columns']:
+			field = record
+			for key in path.split('.'):
+				field = field[key]
+			if column in spec['epoch_ms']:
+				field = datetime.fromtimestamp(float(field) / 1000, timezone.utc).isoformat()
+			elif isinstance(field, (dict, list)):
+				field = json.dumps(field)
+			row.append(field)
+		return spec['table'], tuple(column for column, path in spec['columns']), row
+
+	def flush(self):
+		'''
+		Write the buffered rows in one transaction and commit the offsets
+		:return: True when the write succeeded
+		'''
+		if not self.next:
+			self.started = time.time()
+			return True
+		start = time.time()
+		try:
+			self.sink.write(self.buffer)
+		except Exception as e:
+			sys.stderr.write('write failed, rewinding ' + str(len(self.first)) + ' partitions: ' + str(e).strip() + '\n')
+			self.metrics.add(failures=1)
+			self.source.rewind(self.first)
+			self.reset()
+			time.sleep(self.backoff)
+			return False
+		self.source.commit(self.next)
+		elapsed = time.time() - self.started
+		self.metrics.add(rows=self.size, flushes=1, decode_errors=self.errors)
+		self.metrics.set(rows_s=self.size / max(elapsed, 0.001), flush_s=time.time() - start, lag=self.source.lag())
+		self.reset()
+		return True
+
+	def reset(self):
+		self.buffer = {}
+		self.first = {}
+		self.next = {}
+		self.size = 0
+		self.errors = 0
+		self.started = time.time()
+
+class KafkaSource(object):
+	'''
+	Consumer group member of the topics with manual offset commits, buffered rows are flushed before a rebalance
+	'''
+	def __init__(self, brokers, group, topics, ingest=None):
+		from kafka import ConsumerRebalanceListener, KafkaConsumer, OffsetAndMetadata, TopicPartition
+		self.OffsetAndMetadata = OffsetAndMetadata
+		self.TopicPartition = TopicPartition
+		self.ingest = ingest
+		self.consumer = KafkaConsumer(bootstrap_servers=brokers, group_id=group, enable_auto_commit=False,
+		 auto_offset_reset='earliest', max_poll_records=10000)
+		source = self
+		class Listener(ConsumerRebalanceListener):
+			def on_partitions_revoked(self, revoked):
+				if source.ingest:
+					source.ingest.flush()
+			def on_partitions_assigned(self, assigned):
+				pass
+		self.consumer.subscribe(topics, listener=Listener())
+
+	def poll(self, timeout):
+		batches = self.consumer.poll(timeout_ms=int(timeout * 1000))
+		return [(record.topic, record.partition, record.offset, record.value) for records in batches.values() for record in records]
+
+	def commit(self, offsets):
+		self.consumer.commit(dict((self.TopicPartition(topic, partition), self.OffsetAndMetadata(offset, None))
+		 for (topic, partition), offset in offsets.items()))
+
+	def rewind(self, offsets):
+		assigned = self.consumer.assignment()
+		for (topic, partition), offset in offsets.items():
+			if self.TopicPartition(topic, partition) in assigned:
+				self.consumer.seek(self.TopicPartition(topic, partition), offset)
+
+	def lag(self):
+		partitions = list(self.consumer.assignment())
+		ends = self.consumer.end_offsets(partitions)
+		return dict(((tp.topic, tp.partition), ends[tp] - self.consumer.position(tp)) for tp in partitions)
+
+class PostgresSink(object):
+	'''
+	Write the rows of every table with COPY in one transaction
+	'''
+	def __init__(self, dsn):
+		import psycopg2
+		self.connect = lambda: psycopg2.connect(dsn)
+		self.conn = self.connect()
+
+	def write(self, buffer):
+		if self.conn.closed:
+			self.conn = self.connect()
+		try:
+			with self.conn.cursor() as cursor:
+				for (table, columns), rows in buffer.items():
+					data = io.StringIO()
+					csv.writer(data).writerows(rows)
+					data.seek(0)
+					cursor.copy_expert('COPY ' + table + ' (' + ', '.join(columns) + ') FROM STDIN WITH (FORMAT csv)', data)
+			self.conn.commit()
+		except Exception:
+			if not self.conn.closed:
+				self.conn.rollback()
+			raise
+
+class StandInSource(object):
+	'''
+	Broker stand-in of the test mode: partitions of generated records, committed offsets and rewinds
+	'''
+	def __init__(self, topic, partitions, records, seed=1):
+		self.random = random.Random(seed)
+		self.logs = dict(((topic, partition), [json.dumps({'header': {'endpointKeyHash': 'device-' + str(n % 50),
+		 'timestamp': 1546300800000 + n}, 'event': {'metric': 'temperature', 'value': n}}) for n in range(partition, records, partitions)])
+		 for partition in range(partitions))
+		self.logs[(topic, 0)].insert(3, 'not json')
+		self.positions = dict((key, 0) for key in self.logs)
+		self.committed = {}
+
+	def poll(self, timeout):
+		key = self.random.choice(sorted(self.logs))
+		start = self.positions[key]
+		self.positions[key] = min(start + self.random.randint(1, 200), len(self.logs[key]))
+		return [(key[0], key[1], offset, self.logs[key][offset]) for offset in range(start, self.positions[key])]
+
+	def commit(self, offsets):
+		self.committed.update(offsets)
+
+	def rewind(self, offsets):
+		self.positions.update(offsets)
+
+	def lag(self):
+		return dict((key, len(self.logs[key]) - self.positions[key]) for key in self.logs)
+
+class StandInSink(object):
+	'''
+	Database stand-in of the test mode, every third write fails
+	'''
+	def __init__(self):
+		self.rows = []
+		self.writes = 0
+
+	def write(self, buffer):
+		self.writes += 1
+		if self.writes % 3 == 0:
+			raise RuntimeError('stand-in write failure')
+		for (table, columns), rows in buffer.items():
+			self.rows += [dict(zip(columns, row)) for row in rows]
+
+def topicspecs(config):
+	'''
+	Target table and columns of every [topic_<name>] section
+	:return: dict of topic to spec
+	'''
+	topics = {}
+	for section in config.sections():
+		if section.startswith('topic_'):
+			settings = config[section]
+			topics[section[len('topic_'):]] = {
+				'table': settings['table'],
+				'columns': [(column.split(':')[0].strip(), column.split(':', 1)[-1].strip()) for column in settings['columns'].split(',')],
+				'epoch_ms': [column.strip() for column in settings.get('epoch_ms_columns', '').split(',') if column.strip()],
+			}
+	return topics
+
+def serve(metrics, port):
+	'''
+	Serve the metrics on /metrics in a background thread
+	:return:
+	'''
+	class Handler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			body = metrics.render().encode()
+			self.send_response(200 if self.path == '/metrics' else 404)
+			self.send_header('Content-Type', 'text/plain; version=0.0.4')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+		def log_message(self, *args):
+			pass
+	server = HTTPServer(('0.0.0.0', port), Handler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+def selftest():
+	'''
+	Run the ingest loop against the stand-ins and check every record is written once and only written offsets are committed,
+	the polls are seeded and batches are flushed by size or once the partitions are drained so every run is the same
+	:return: exit code
+	'''
+	records, partitions = 20000, 4
+	source = StandInSource('kaa-logs', partitions, records)
+	sink = StandInSink()
+	metrics = Metrics()
+	topics = {'kaa-logs': {'table': 'measurements', 'epoch_ms': ['time'], 'columns': [('time', 'header.timestamp'),
+	 ('device_id', 'header.endpointKeyHash'), ('metric', 'event.metric'), ('value', 'event.value')]}}
+	ingest = Ingest(source, sink, topics, 1000, 3600, metrics)
+	ingest.backoff = 0
+	server = serve(metrics, 0)
+	start = time.time()
+	while sum(source.committed.values()) < records + 1 and time.time() - start < 60:
+		ingest.step(0)
+		if not any(source.lag().values()):
+			ingest.flush()
+	scraped = metrics.render()
+	server.shutdown()
+	values = sorted(row['value'] for row in sink.rows)
+	checks = [
+		('every record written once', values == list(range(records))),
+		('offsets committed to the end of every partition', source.committed == dict((key, len(log)) for key, log in source.logs.items())),
+		('failed writes rewound and retried', metrics.values['failures'] > 0),
+		('undecodable record counted', metrics.values['decode_errors'] == 1),
+		('timestamps converted', sink.rows[0]['time'].startswith('2019-01-01T00:00:')),
+		('metrics served', 'kafkaingest_rows_total ' + str(records) in scraped and 'kafkaingest_lag{' in scraped),
+	]
+	for name, ok in checks:
+		sys.stdout.write(('ok      ' if ok else 'FAILED  ') + name + '\n')
+	sys.stdout.write("%d records, %d writes, %d failed and retried in %.2fs\n"\
+	 % (records, sink.writes, metrics.values['failures'], time.time() - start))
+	return 0 if all(ok for name, ok in checks) else 1
+
+def main():
+	parser = argparse.ArgumentParser(description='Kafka to TimescaleDB ingest service')
+	parser.add_argument('--config', default=CONFIG_FILE)
+	parser.add_argument('--test', action='store_true', help='run against a stand-in broker and database')
+	arguments = parser.parse_args()
+	if arguments.test:
+		return selftest()
+	config = configparser.ConfigParser()
+	if not config.read(arguments.config):
+		sys.stderr.write('configuration ' + arguments.config + ' not found\n')
+		return 1
+	settings = config['ingest']
+	topics = topicspecs(config)
+	metrics = Metrics()
+	serve(metrics, int(settings.get('metrics_port', '9898')))
+	source = KafkaSource([broker.strip() for broker in settings['brokers'].split(',')], settings.get('group', 'emsdeploy-ingest'),
+	 list(topics))
+	ingest = Ingest(source, PostgresSink(settings.get('dsn', 'dbname=' + settings['database'])), topics,
+	 int(settings.get('batch_rows', '5000')), float(settings.get('batch_seconds', '2')), metrics)
+	source.ingest = ingest
+	stop = threading.Event()
+	signal.signal(signal.SIGTERM, lambda *args: stop.set())
+	signal.signal(signal.SIGINT, lambda *args: stop.set())
+	ingest.run(stop)
+	source.consumer.close(autocommit=False)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,259 @@
+'''
+Tests of the shared deployment machinery against the simulated host: ledger skips, batch failures and the step graph
+'''
+
+import os
+import configparser
+import sys
+import threading
+import time
+import types
+
+import pytest
+from fabric import task
+from invoke import Context
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import emsdeploy
+from emsdeploy import session
+
+CONFIG = '''
+[node_test]
+user = username
+keyfile = key.pem
+host = 127.0.0.1
+port = 22
+greeting = hello
+'''
+
+events = []
+eventlock = threading.Lock()
+
+def event(name, kind):
+	with eventlock:
+		events.append((name, kind, time.time()))
+
+@task
+def prepare(ctx):
+	with session(ctx) as conn:
+		event('prepare', 'start')
+		conn.sudo('echo prepare')
+		time.sleep(0.05)
+		event('prepare', 'end')
+
+@task
+def install(ctx):
+	with session(ctx) as conn:
+		event('install', 'start')
+		conn.sudo('echo install')
+		time.sleep(0.05)
+		event('install', 'end')
+
+@task
+def configure(ctx):
+	with session(ctx) as conn:
+		event('configure', 'start')
+		conn.sudo('echo configure')
+		time.sleep(0.05)
+		event('configure', 'end')
+
+@task
+def upload(ctx):
+	with session(ctx) as conn:
+		emsdeploy.putcontent(conn, 'content\n', '/etc/emsdeploy-test')
+
+@pytest.fixture
+def ctx(monkeypatch):
+	config = configparser.RawConfigParser()
+	config.read_string(CONFIG)
+	role = types.ModuleType('testrole')
+	role.NAME = 'test'
+	role.SECTION = 'node_test'
+	role.config = config
+	role.DEPLOY_STEPS = [prepare, install, configure]
+	role.STEP_INPUTS = {'install': ['greeting']}
+	role.STEP_DEPENDS = {'configure': ['prepare']}
+	role.STEP_LOCKS = {'prepare': ['dpkg'], 'install': ['dpkg']}
+	role.artifacts = lambda: []
+	monkeypatch.setattr(emsdeploy, 'role', role)
+	monkeypatch.setattr(emsdeploy, 'SIMULATED_OUTPUTS', list(emsdeploy.SIMULATED_OUTPUTS))
+	del events[:]
+	context = Context()
+	context.simulate = True
+	context.simulate_latency = 0
+	context.simulate_bandwidth = 1e9
+	emsdeploy.stagehost(context, '127.0.0.1')
+	yield context
+	emsdeploy.closesession(context)
+	emsdeploy.report['steps'] = []
+	emsdeploy.report['ready'] = []
+
+def commands(ctx):
+	return emsdeploy.sessions[ctx.host]['conn'].commands
+
+def statuses(ctx):
+	return [(step['step'], step['status']) for step in emsdeploy.sessions[ctx.host]['steps']]
+
+def test_ledger_skips_completed_steps_with_the_same_inputs(ctx):
+	ledger = 'prepare ' + emsdeploy.stepdigest(prepare) + '\ninstall stale\n'
+	emsdeploy.SIMULATED_OUTPUTS.insert(0, (r'cat ' + emsdeploy.LEDGER_FILE, ledger, 0))
+	emsdeploy.runsteps(ctx, [prepare, install])
+	assert statuses(ctx) == [('prepare', 'skipped'), ('install', 'ok')]
+	assert 'sudo echo prepare' not in commands(ctx)
+	written = [command for command in commands(ctx) if emsdeploy.LEDGER_FILE in command and 'printf' in command]
+	assert len(written) == 1 and 'install ' + emsdeploy.stepdigest(install) in written[0] and 'prepare' not in written[0]
+
+def test_ledger_is_only_readable_by_root(ctx):
+	emsdeploy.runsteps(ctx, [install])
+	written = [command for command in commands(ctx) if emsdeploy.LEDGER_FILE in command and 'printf' in command]
+	assert written and 'umask 077' in written[0] and written[0].endswith('chmod 600 ' + emsdeploy.LEDGER_FILE + '"')
+
+def test_changed_input_runs_the_step_again(ctx):
+	digest = emsdeploy.stepdigest(install)
+	emsdeploy.role.config.set('node_test', 'greeting', 'goodbye')
+	assert emsdeploy.stepdigest(install) != digest
+	emsdeploy.SIMULATED_OUTPUTS.insert(0, (r'cat ' + emsdeploy.LEDGER_FILE, 'install ' + digest + '\n', 0))
+	emsdeploy.runsteps(ctx, [install])
+	assert statuses(ctx) == [('install', 'ok')]
+
+def test_section_and_file_inputs_are_hashed_by_content(ctx, tmp_path):
+	path = tmp_path / 'input.txt'
+	path.write_text('one')
+	emsdeploy.role.config.add_section('extra_one')
+	emsdeploy.role.config.set('extra_one', 'size', '1')
+	emsdeploy.role.STEP_INPUTS['install'] = ['[extra_*]', str(path)]
+	digest = emsdeploy.stepdigest(install)
+	emsdeploy.role.config.set('extra_one', 'size', '2')
+	assert emsdeploy.stepdigest(install) != digest
+	digest = emsdeploy.stepdigest(install)
+	path.write_text('two')
+	assert emsdeploy.stepdigest(install) != digest
+
+def test_batch_failure_names_the_step_and_records_only_completed_steps(ctx):
+	ctx.batch = True
+	emsdeploy.SIMULATED_OUTPUTS.insert(0, (r'bash emsdeploy-batch.sh', '*** batch failed at command 1\n', 1))
+	with pytest.raises(RuntimeError) as error:
+		emsdeploy.runsteps(ctx, [prepare, install, configure])
+	assert str(error.value) == 'install failed at line 7 of the batch script: echo install'
+	assert statuses(ctx) == [('prepare', 'ok'), ('install', 'failed'), ('batch', 'exit 1')]
+	written = [command for command in commands(ctx) if emsdeploy.LEDGER_FILE in command and 'printf' in command]
+	assert len(written) == 1 and 'prepare ' in written[0] and 'install' not in written[0]
+	assert ctx.host not in emsdeploy.batches
+
+def test_batch_records_steps_after_the_script_returned(ctx):
+	ctx.batch = True
+	emsdeploy.runsteps(ctx, [prepare, install])
+	script = commands(ctx).index('sudo bash emsdeploy-batch.sh')
+	ledger = [index for index, command in enumerate(commands(ctx)) if 'printf' in command]
+	assert ledger and all(index > script for index in ledger)
+	assert statuses(ctx) == [('prepare', 'ok'), ('install', 'ok'), ('batch', 'ok')]
+
+def test_uploads_count_as_round_trips(ctx):
+	ctx.force = True
+	emsdeploy.runsteps(ctx, [upload])
+	record = emsdeploy.sessions[ctx.host]['steps'][0]
+	assert record['commands'] == len([command for command in commands(ctx) if 'emsdeploy-test' in command])
+	assert record['bytes'] == len('content\n')
+
+def test_graph_respects_dependencies_and_locks(ctx):
+	ctx.parallel = True
+	emsdeploy.runsteps(ctx, [prepare, install, configure])
+	times = dict(((name, kind), stamp) for name, kind, stamp in events)
+	assert times[('prepare', 'end')] <= times[('configure', 'start')]
+	assert times[('prepare', 'end')] <= times[('install', 'start')] or times[('install', 'end')] <= times[('prepare', 'start')]
+	assert sorted(statuses(ctx)) == [('configure', 'ok'), ('install', 'ok'), ('prepare', 'ok')]
+
+def test_graph_starts_no_step_after_a_failure(ctx):
+	ctx.parallel = True
+	emsdeploy.SIMULATED_OUTPUTS.insert(0, (r'echo prepare', '', 1))
+	with pytest.raises(Exception):
+		emsdeploy.runsteps(ctx, [prepare, configure])
+	assert 'sudo echo configure' not in commands(ctx)
+	assert statuses(ctx) == [('prepare', 'exit 1')]
+
+def test_rollout_stops_after_the_group_with_a_failed_host(ctx, monkeypatch):
+	emsdeploy.role.config.set('node_test', 'hosts', '10.0.0.1, 10.0.0.2, 10.0.0.3, 10.0.0.4')
+	restarted = []
+	def rollhost(hostctx, upgrade):
+		restarted.append(hostctx.address)
+		if hostctx.address == '10.0.0.2':
+			raise RuntimeError('not healthy')
+	emsdeploy.role.rollhost = rollhost
+	monkeypatch.setattr(emsdeploy, 'writereport', lambda: None)
+	with pytest.raises(SystemExit):
+		emsdeploy.runrollout(ctx, 2, False, 'test nodes')
+	assert sorted(restarted) == ['10.0.0.1', '10.0.0.2']
+	rolled = [step for step in emsdeploy.report['steps'] if step['step'] == 'rollingrestart']
+	assert sorted((step['host'], step['status']) for step in rolled) == [('10.0.0.1:22', 'ok'), ('10.0.0.2:22', 'failed')]
+
+def test_seed_ports_are_only_open_to_the_fleet(ctx):
+	emsdeploy.role.config.set('node_test', 'hosts', '10.0.0.1, 10.0.0.2')
+	emsdeploy.seedhost(ctx)
+	rules = [command for command in commands(ctx) if 'iptables-save' in command]
+	assert len(rules) == 1
+	for port in (emsdeploy.APT_PROXY_PORT, emsdeploy.ARTIFACT_PORT):
+		assert port + ',10.0.0.1/32 ' + port + ',10.0.0.2/32' in rules[0] and port + ', ' not in rules[0]
+
+def test_reconnect_baseline_opens_a_connection_per_step(ctx, monkeypatch):
+	opened = []
+	monkeypatch.setattr(emsdeploy.SimulatedConnection, 'open', lambda self: opened.append(self.host))
+	ctx.reconnect = True
+	ctx.force = True
+	emsdeploy.runsteps(ctx, [prepare, install, configure])
+	assert len(opened) == 3
+
+class BlockedChannel(object):
+	'''
+	Channel of a remote command that writes its stderr before its stdout, the stdout only arrives once stderr was read
+	'''
+	def __init__(self, stdout=b'', stderr=b'', status=0):
+		self.stdout = [stdout] if stdout else []
+		self.stderr = [stderr[index:index + 65536] for index in range(0, len(stderr), 65536)]
+		self.drained = threading.Event()
+		self.status = status
+		self.received = b''
+		if not self.stderr:
+			self.drained.set()
+
+	def exec_command(self, command):
+		pass
+
+	def set_combine_stderr(self, combine):
+		pass
+
+	def recv_stderr(self, size):
+		if not self.stderr:
+			self.drained.set()
+			return b''
+		return self.stderr.pop(0)
+
+	def recv(self, size):
+		if not self.drained.wait(5):
+			raise AssertionError('stdout read while the remote command blocks on a full stderr')
+		return self.stdout.pop(0) if self.stdout else b''
+
+	def sendall(self, data):
+		self.received += data
+
+	def shutdown_write(self):
+		pass
+
+	def recv_exit_status(self):
+		return self.status
+
+	def close(self):
+		pass
+
+def sessionof(channel):
+	transport = types.SimpleNamespace(open_session=lambda: channel)
+	return types.SimpleNamespace(client=types.SimpleNamespace(get_transport=lambda: transport))
+
+def test_streams_drain_stderr_while_reading_stdout(tmp_path):
+	path = str(tmp_path / 'dump')
+	assert emsdeploy.pullfrom(sessionof(BlockedChannel(b'rows', b'w' * 1048576)), 'mysqldump', path) == 4
+	writer = BlockedChannel()
+	assert emsdeploy.relay(sessionof(BlockedChannel(b'rows', b'w' * 1048576)), 'mysqldump', sessionof(writer), 'mysql') == 4
+	assert writer.received == b'rows'
+	with pytest.raises(RuntimeError) as error:
+		emsdeploy.pullfrom(sessionof(BlockedChannel(b'', b'x' * 1048576 + b'failed', 2)), 'mysqldump', path)
+	assert str(error.value).endswith('failed') and len(str(error.value)) < 70000
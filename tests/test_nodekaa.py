@@ -0,0 +1,38 @@
+'''
+Tests of the Kaa node tasks against the simulated host: the restore answer as an input of initiatekaanode
+'''
+
+import os
+import importlib.util
+import sys
+
+import pytest
+from invoke import Context
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import emsdeploy
+
+NODE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'nodekaa')
+
+@pytest.fixture
+def kaa(monkeypatch):
+	monkeypatch.chdir(NODE)
+	spec = importlib.util.spec_from_file_location('kaafabfile', os.path.join(NODE, 'fabfile.py'))
+	module = importlib.util.module_from_spec(spec)
+	monkeypatch.setitem(sys.modules, 'kaafabfile', module)
+	spec.loader.exec_module(module)
+	with open(os.path.join(NODE, 'kaa-template.cfg')) as template:
+		module.config.read_string(template.read())
+	monkeypatch.setattr(emsdeploy, 'role', module)
+	return module
+
+def test_restore_answer_is_an_input_of_initiatekaanode(kaa, monkeypatch):
+	answers = iter(['maybe', 'n'])
+	monkeypatch.setattr('builtins.input', lambda: next(answers))
+	declined = Context()
+	first = emsdeploy.stepdigest(kaa.initiatekaanode, declined)
+	assert declined.restore == 'n' and emsdeploy.stepdigest(kaa.initiatekaanode, declined) == first
+	accepted = Context()
+	accepted.restore = 'yes'
+	assert emsdeploy.stepdigest(kaa.initiatekaanode, accepted) != first
+	assert accepted.restore == 'y'
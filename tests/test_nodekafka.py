@@ -0,0 +1,53 @@
+'''
+Tests of the Kafka node tasks against the simulated host: ZooKeeper of a single broker deployment
+'''
+
+import os
+import importlib.util
+import sys
+
+import pytest
+from invoke import Context
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import emsdeploy
+
+NODE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'nodekafka')
+
+@pytest.fixture
+def kafka(monkeypatch):
+	monkeypatch.chdir(NODE)
+	spec = importlib.util.spec_from_file_location('kafkafabfile', os.path.join(NODE, 'fabfile.py'))
+	module = importlib.util.module_from_spec(spec)
+	monkeypatch.setitem(sys.modules, 'kafkafabfile', module)
+	spec.loader.exec_module(module)
+	with open(os.path.join(NODE, 'kafka-template.cfg')) as template:
+		module.config.read_string(template.read().replace('#exporters = yes', 'exporters = yes')\
+		 .replace('#scrape_source', 'scrape_source'))
+	monkeypatch.setattr(module, 'verifyexporters', lambda ctx: None)
+	monkeypatch.setattr(emsdeploy, 'role', module)
+	context = Context()
+	context.simulate = True
+	context.simulate_latency = 0
+	context.simulate_bandwidth = 1e9
+	context.force = True
+	emsdeploy.stagehost(context, module.config._sections['node_kafka']['host'])
+	yield module, context
+	emsdeploy.closesession(context)
+	emsdeploy.report['steps'] = []
+	emsdeploy.report['ready'] = []
+
+def commands(ctx):
+	return emsdeploy.sessions[ctx.host]['conn'].commands
+
+def test_single_broker_moves_zookeeper_to_the_unit(kafka):
+	module, ctx = kafka
+	emsdeploy.runsteps(ctx, [module.installzookeeper, module.configurecluster, module.installexporters])
+	sent = commands(ctx)
+	stops = [index for index, command in enumerate(sent) if command == 'sudo /usr/share/zookeeper/bin/zkServer.sh stop']
+	restarts = [index for index, command in enumerate(sent) if command == 'sudo systemctl restart zookeeper']
+	assert len(restarts) == 2 and len(stops) == 2
+	assert all(stop < restart for stop, restart in zip(stops, restarts))
+	probes = [command for command in sent[restarts[-1]:] if 'imok' in command]
+	assert probes and 'systemctl is-active --quiet zookeeper' in probes[0]
+	assert sent.index('sudo systemctl enable zookeeper') > stops[0]